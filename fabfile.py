@@ -25,17 +25,12 @@ def create_dir():
 def create_dummy_user():
     "Create and remove a dummy user, be careful 'userdel' works!"
     
-    # Find the highest uid in the system and add 1000 to it
-    # skip uid's above 60000 since 'nobody' lives at the end of
-    # of the range.
-    users = platform.users(max_uid=60000)
-    max_uid = 0
-    for _, user_obj in users.iteritems():
-        if user_obj.uid > max_uid:
-            max_uid = user_obj.uid
+    # Find the lowest uid that is free on this host, ids below 1000
+    # are left to the system and 'nobody' lives above 60000.
+    uid = platform.id_allocator([env.host_string]).reserve()[0]
     
-    print "Found max uid: ", max_uid
-    platform.useradd('asdfghjk', max_uid + 1000, shell='/bin/bash')
+    print "Found free uid: ", uid
+    platform.useradd('asdfghjk', uid, shell='/bin/bash')
     asdf = platform.userget('asdfghjk')
     print "Dummy user created, %s %s" % (asdf.name, asdf.uid)
     platform.userdel('asdfghjk')
\ No newline at end of file
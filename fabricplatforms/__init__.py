@@ -1,26 +1,41 @@
 import logging
+import math
+import os
+import sys
+import threading
+import time
+import types
 
 from fabric.state import env
 from fabric.api import run, settings, hide
+from fabric.network import to_dict
 
-from linux import Linux
-from solaris import Solaris
-from darwin import Darwin
-from base import PlatformError
+from cache import HostCache
+from registry import PlatformRegistry, import_object
 
-def import_object(dotted_path):
-    """
-    Import an object from a dotted path string.
-
-    If dotted_path contains no dots, then try to import and return a module.
-    """
-    parts = dotted_path.rsplit('.', 1)
-    mod = __import__(parts[0])
-    mod_only = len(parts) == 1
-    if mod_only:
-        return mod
-    obj = getattr(mod, parts[1])
-    return obj
+# the rest of the package is imported where it's used, and these names of
+# it are only imported when first looked up here, see _package
+LAZY_NAMES = {
+    'Linux': 'fabricplatforms.linux.Linux',
+    'Solaris': 'fabricplatforms.solaris.Solaris',
+    'Darwin': 'fabricplatforms.darwin.Darwin',
+    'PlatformError': 'fabricplatforms.base.PlatformError',
+    'add_hook': 'fabricplatforms.base.add_hook',
+    'remove_hook': 'fabricplatforms.base.remove_hook',
+    'reloadreport': 'fabricplatforms.base.reloadreport',
+    'Metrics': 'fabricplatforms.metrics.Metrics',
+    'fanout': 'fabricplatforms.parallel.fanout',
+    'hostresult': 'fabricplatforms.parallel.hostresult',
+    'HostTimeout': 'fabricplatforms.parallel.HostTimeout',
+    'gather': 'fabricplatforms.eventloop.gather',
+    'AsyncSSHExecutor': 'fabricplatforms.eventloop.AsyncSSHExecutor',
+    'AsyncLocalExecutor': 'fabricplatforms.eventloop.AsyncLocalExecutor',
+    'FutureTimeout': 'fabricplatforms.eventloop.FutureTimeout',
+    'is_local': 'fabricplatforms.local.is_local',
+    'local_platform': 'fabricplatforms.local.local_platform',
+    'HostPlatform': 'fabricplatforms.handle.HostPlatform',
+    'IdAllocator': 'fabricplatforms.ids.IdAllocator',
+}
 
 class Platform(object):
     """
@@ -28,30 +43,68 @@ class Platform(object):
     
     Handles registration of platforms and hosts. Serves as a proxy
     to the underlining os specific classes. 
+
+    Discovered host platforms are remembered in cache, a HostCache, so
+    later runs don't have to ask the host again. Set it to None to turn
+    that off.
+
+    Unless use_local is turned off, tasks against this machine (as the
+    current user) use a local platform that works with os and pwd calls
+    instead of going through ssh. Hosts registered explicitly still win.
+
+    PLATFORMS is a PlatformRegistry: platforms registered by dotted path
+    are imported on first use, and those of other packages are found
+    through entry points, see registry.py.
     """
     
-    def __init__(self):
-        self.PLATFORMS = {}
+    use_local = True
+
+    def __init__(self, cache=None):
+        self.PLATFORMS = PlatformRegistry()
         self.HOSTS = {}
+        self.cache = cache if cache is not None else HostCache()
+        self._local = None
+        self._lock = threading.RLock()
+        self._handles = {}
     
-    def register_platform(self, platform):
-        if isinstance(platform, basestring):
+    def register_platform(self, platform, name=None):
+        """
+        Register a platform class, or the dotted path of one. Given its
+        name (what uname -s says, lower case), a path is only imported
+        when a host turns out to need it, otherwise it's imported now to
+        read the name attribute of the class.
+        """
+        if isinstance(platform, basestring) and name is None:
             platform = import_object(platform)
-        
-        name = getattr(platform, 'name', platform.__name__.lower())
-        self.PLATFORMS[name] = platform()
+        if name is None:
+            name = getattr(platform, 'name', platform.__name__.lower())
+        self.PLATFORMS.register(name, platform)
     
     def register(self, host, platform_name):
-        if platform_name not in self.PLATFORMS.iterkeys():
-            logging.error('Available platforms: %s', [x for x in self.PLATFORMS.iterkeys()])
+        from base import PlatformError
+        if platform_name not in self.PLATFORMS:
+            logging.error('Available platforms: %s', self.PLATFORMS.keys())
             raise PlatformError("Platform not registered")
         platform = self.PLATFORMS[platform_name]
         self.HOSTS[host] = platform
     
     def get_platform_for_host(self, host):
         try:
-            platform = self.HOSTS[host]
+            return self.HOSTS[host]
         except KeyError:
+            pass
+        from base import PlatformError
+        from local import is_local
+        if self.use_local and is_local(host):
+            return self.local_platform()
+        with self._lock:
+            # another thread may have discovered it while we waited
+            if host in self.HOSTS:
+                return self.HOSTS[host]
+            cached = self.cache.get(host) if self.cache is not None else None
+            if cached in self.PLATFORMS:
+                self.register(host, cached)
+                return self.HOSTS[host]
             # Try to discover the host platform type:
             with settings(hide('everything'), warn_only=True):
                 output = run('uname -sr')
@@ -64,20 +117,417 @@ class Platform(object):
                     self.register(host, uname)
                 except KeyError:
                     raise PlatformError("Platform for %s not registered" % uname)
+            if self.cache is not None:
+                self.cache.set(host, uname)
         return platform
-        
-        
+
+    def local_platform(self):
+        """The platform used for this machine, see use_local."""
+        if self._local is not None:
+            return self._local
+        from base import PlatformError
+        from local import local_platform
+        with self._lock:
+            if self._local is None:
+                uname = os.uname()[0].lower()
+                try:
+                    platform = self.PLATFORMS[uname]
+                except KeyError:
+                    raise PlatformError("Platform for %s not registered" % uname)
+                self._local = local_platform(type(platform))
+        return self._local
+
+    def invalidate(self, host=None):
+        """
+        Forget the discovered platform of host, or of every host, both
+        here and in the cache, so it is looked up again on next use.
+        """
+        with self._lock:
+            if host is None:
+                self.HOSTS.clear()
+                self._handles.clear()
+            else:
+                self.HOSTS.pop(host, None)
+                for host_string, handle in self._handles.items():
+                    if handle.host == host:
+                        del self._handles[host_string]
+            if self.cache is not None:
+                self.cache.invalidate(host)
+
+    def for_host(self, host_string=None):
+        """
+        Return a HostPlatform for host_string (env.host_string by default),
+        whose methods run against that host without going through this
+        proxy or the caller setting env for it, see handle.py. The
+        platform is discovered now if need be. Handles are kept until
+        invalidate().
+        """
+        host_string = host_string or env.host_string
+        handle = self._handles.get(host_string)
+        if handle is None:
+            from handle import HostPlatform
+            host = to_dict(host_string)['host']
+            with settings(**to_dict(host_string)):
+                platform = self.get_platform_for_host(host)
+            handle = self._handles[host_string] = HostPlatform(platform, host_string)
+        return handle
+
+    def discover(self, hosts=None, workers=None, timeout=None):
+        """
+        Work out the platform of all hosts (env.hosts by default) before a
+        task starts. Hosts that aren't registered or cached are probed all
+        at once with map(). Returns a dict of host -> platform name, None
+        for hosts that could not be probed.
+        """
+        from local import is_local
+        hosts = hosts if hosts is not None else env.hosts
+        names, unknown = {}, []
+        for host_string in hosts:
+            host = to_dict(host_string)['host']
+            if host not in self.HOSTS and self.use_local and is_local(host_string):
+                names[host] = 'local'
+                continue
+            if host not in self.HOSTS:
+                cached = self.cache.get(host) if self.cache is not None else None
+                if cached in self.PLATFORMS:
+                    self.register(host, cached)
+            if host in self.HOSTS:
+                names[host] = self.platform_name(self.HOSTS[host])
+            else:
+                unknown.append(host_string)
+
+        def probe():
+            self.get_platform_for_host(env.host)
+
+        discovered = {}
+        for host_string, result in self.map(unknown, probe, workers=workers,
+                                            timeout=timeout).iteritems():
+            host = to_dict(host_string)['host']
+            if result.failed:
+                logging.error("Could not discover platform of %s: %s", host, result.error)
+                names[host] = None
+            else:
+                names[host] = discovered[host] = self.platform_name(self.HOSTS.get(host))
+        if discovered and self.cache is not None:
+            self.cache.update(discovered)
+        return names
+
+    def facts(self, hosts=None, use_sudo=False, refresh=False, timeout=None):
+        """
+        Fetch the hostfacts of all hosts (env.hosts by default) at once,
+        one command per host, with the a*() machinery (see eventloop.py)::
+
+            for host, result in platform.facts(timeout=30).iteritems():
+                if result.failed or result.result.mounts['/'].capacity > 90:
+                    print host, result.error or 'disk full'
+
+        Hosts whose facts are younger than facts_ttl aren't asked again
+        unless refresh is set. Returns a dict of host -> hostresult, hosts
+        that didn't answer within timeout seconds get a HostTimeout error.
+        """
+        hosts = hosts if hosts is not None else env.hosts
+        platforms, results = self._resolve(hosts)
+        started = time.time()
+        futures = dict((host_string, platform.afacts(use_sudo, refresh, host=host_string))
+                       for host_string, platform in platforms.iteritems())
+        results.update(self._collect(futures, started, timeout))
+        return results
+
+    def id_allocator(self, hosts=None, use_sudo=True, timeout=None):
+        """
+        Return an IdAllocator for the uids and gids that are free on all
+        hosts (env.hosts by default), see ids.py. Their accounts are read
+        at once with aaccounts(). Raises PlatformError if a host can't be
+        read, an id picked without it wouldn't be safe.
+        """
+        from base import PlatformError
+        from ids import IdAllocator
+        hosts = hosts if hosts is not None else env.hosts
+        platforms, results = self._resolve(hosts)
+        started = time.time()
+        futures = dict((host_string, platform.aaccounts(use_sudo, host=host_string))
+                       for host_string, platform in platforms.iteritems())
+        results.update(self._collect(futures, started, timeout))
+        failed = sorted(host for host, result in results.iteritems() if result.failed)
+        if failed:
+            raise PlatformError("Could not read the accounts of %s: %s"
+                                % (', '.join(failed), results[failed[0]].error))
+        return IdAllocator(dict((host, result.result) for host, result in results.iteritems()))
+
+    def rolling_reload(self, server, hosts=None, window=None, min_in_service=0.5,
+                       health_check=None, use_sudo=True, timeout=None):
+        """
+        Gracefully reload server ('apache' or 'nginx') on all hosts
+        (env.hosts by default) without taking too many out of service::
+
+            def healthy(host):
+                return urllib2.urlopen('http://%s/health' % host, timeout=5).code == 200
+
+            report = platform.rolling_reload('nginx', window=5, health_check=healthy)
+            if report.failed:
+                abort('Reload stopped: %s' % report.failed)
+
+        The config is checked on every host at once first, nothing is
+        reloaded if it fails anywhere. Then the hosts are reloaded in
+        order, window at a time, so that at least min_in_service of them
+        (a fraction) keep serving; the biggest window that allows is used
+        if window isn't given, and one host at a time is the least. A
+        window is done once health_check(host) is true for all its hosts,
+        the checks run in parallel. The first failure stops the rollout.
+
+        timeout is in seconds per check or reload step. Returns a
+        reloadreport.
+        """
+        from base import reloadreport
+        hosts = list(hosts if hosts is not None else env.hosts)
+        platforms, results = self._resolve(hosts)
+        report = reloadreport()
+        report.failed.update((host, result.error) for host, result in results.iteritems())
+        if not report.failed:
+            # configtest everywhere, a broken config must not go live anywhere
+            failed = self._server(platforms, server, 0, use_sudo, timeout)
+            report.failed.update(failed)
+            report.tested = [host for host in hosts if host not in failed]
+        if report.failed:
+            report.skipped = [host for host in hosts if host not in report.failed]
+            return report
+
+        size = max(len(hosts) - int(math.ceil(len(hosts) * min_in_service)), 1)
+        if window:
+            size = min(window, size)
+        for index in range(0, len(hosts), size):
+            chunk = dict((host, platforms[host]) for host in hosts[index:index + size])
+            failed = self._server(chunk, server, 1, use_sudo, timeout)
+            if health_check is not None:
+                failed.update(self._check_health(health_check,
+                                                 [host for host in chunk if host not in failed]))
+            report.failed.update(failed)
+            report.reloaded.extend(host for host in hosts[index:index + size]
+                                   if host not in failed)
+            if failed:
+                report.skipped = hosts[index + size:]
+                break
+        return report
+
+    def _server(self, platforms, server, step, use_sudo, timeout):
+        """
+        Run the step (0: check the config, 1: reload) of server's
+        server_subcommands on the hosts of platforms at once, return a
+        dict of host -> error for those that failed.
+        """
+        from base import PlatformError
+        started = time.time()
+        futures = dict((host_string, getattr(platform, 'a' + server)(
+                            platform.server_subcommands[server][step], use_sudo,
+                            host=host_string))
+                       for host_string, platform in platforms.iteritems())
+        failed = {}
+        for host_string, result in self._collect(futures, started, timeout).iteritems():
+            if result.failed:
+                failed[host_string] = result.error
+            elif result.result.failed:
+                failed[host_string] = PlatformError("%s failed with status %s: %s" % (
+                    server, result.result.return_code, result.result))
+        return failed
+
+    def _check_health(self, health_check, hosts):
+        """health_check() hosts in threads, return a dict of host -> error for the failed."""
+        from base import PlatformError
+        failed = {}
+
+        def check(host_string):
+            try:
+                if not health_check(host_string):
+                    failed[host_string] = PlatformError("Health check failed")
+            except Exception, e:
+                failed[host_string] = e
+
+        threads = [threading.Thread(target=check, args=(host_string,))
+                   for host_string in hosts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return failed
+
+    def _resolve(self, hosts):
+        """
+        discover() the platforms of hosts and return a dict of host string
+        -> platform, and one of host string -> failed hostresult for the
+        hosts whose platform is unknown.
+        """
+        from base import PlatformError
+        from parallel import hostresult
+        names = self.discover(hosts)
+        platforms, failed = {}, {}
+        for host_string in hosts:
+            host = to_dict(host_string)['host']
+            if names.get(host) is None:
+                failed[host_string] = hostresult(
+                    host_string, error=PlatformError("Could not determine host type"))
+            else:
+                platforms[host_string] = self.get_platform_for_host(host)
+        return platforms, failed
+
+    def _collect(self, futures, started, timeout=None):
+        """
+        Wait for a dict of host string -> Future until timeout seconds
+        after started, return a dict of host string -> hostresult. Hosts
+        without a result by then get a HostTimeout error.
+        """
+        from eventloop import FutureTimeout
+        from parallel import hostresult, HostTimeout
+        finished = {}
+        for host_string, future in futures.iteritems():
+            future.add_done_callback(
+                lambda future, host_string=host_string:
+                    finished.setdefault(host_string, time.time()))
+
+        results = {}
+        deadline = started + timeout if timeout is not None else None
+        for host_string, future in futures.iteritems():
+            remaining = max(0, deadline - time.time()) if deadline is not None else None
+            try:
+                error = future.exception(remaining)
+            except FutureTimeout:
+                results[host_string] = hostresult(
+                    host_string, error=HostTimeout("No answer after %s seconds" % timeout),
+                    elapsed=time.time() - started)
+                continue
+            results[host_string] = hostresult(
+                host_string, future.result() if error is None else None, error,
+                finished.get(host_string, time.time()) - started)
+        return results
+
+    def set_executor(self, executor):
+        """
+        Have every registered platform run its commands with executor
+        (see executors.py) instead of fabric's run and sudo. None goes
+        back to fabric.
+        """
+        self.PLATFORMS.configure(executor=executor)
+
+    def set_async_executor(self, executor):
+        """
+        Have every registered platform run the commands of its a*() methods
+        with executor, an eventloop.AsyncExecutor. None goes back to the
+        shared AsyncSSHExecutor.
+        """
+        self.PLATFORMS.configure(async_executor=executor)
+
+    def set_read_cache(self, size=1000):
+        """
+        Remember up to size userget(), groupget(), stat() and hostname()
+        results per host and task on every registered platform. The
+        platform's own changes keep it up to date. 0 turns it off.
+        """
+        self.PLATFORMS.configure(read_cache_size=size)
+        for platform in self.PLATFORMS.loaded().itervalues():
+            platform.clear_read_cache()
+
+    def set_agent_mode(self, on=True):
+        """
+        Turn agent_mode on or off for every registered platform, see
+        agent.py. Helpers already running are stopped when turned off.
+        """
+        self.PLATFORMS.configure(agent_mode=on)
+        if not on:
+            self.close_agents()
+
+    def close_agents(self, host=None):
+        """Stop the helper agents of every registered platform."""
+        for platform in self.PLATFORMS.loaded().itervalues():
+            platform.close_agents(host)
+
+    def add_hook(self, hook):
+        """Install an execute() hook for every platform, see base.add_hook()."""
+        from base import add_hook
+        add_hook(hook)
+
+    def remove_hook(self, hook):
+        from base import remove_hook
+        remove_hook(hook)
+
+    def platform_name(self, platform):
+        """Return the name a platform instance is registered under."""
+        for name, registered in self.PLATFORMS.loaded().iteritems():
+            if registered is platform:
+                return name
+
+    def map(self, hosts, fn, args=(), kwargs=None, workers=None, timeout=None):
+        """
+        Run fn(*args, **kwargs) against many hosts at once. Each host gets
+        its own process with env set for it, so fn can use platform as it
+        would in a normal task::
+
+            def check(path):
+                return platform.stat(path)
+
+            results = platform.map(env.hosts, check, ('/srv/app',),
+                                   workers=20, timeout=60)
+            for host, result in results.iteritems():
+                if result.failed:
+                    print host, result.error
+
+        At most workers hosts run at once, a host that takes longer than
+        timeout seconds is killed and gets a HostTimeout error. Returns a
+        dict of host -> hostresult. Platforms discovered by the workers are
+        registered here too.
+        """
+        from parallel import fanout
+
+        def task(*args, **kwargs):
+            result = fn(*args, **kwargs)
+            return result, env.host, self.platform_name(self.HOSTS.get(env.host))
+
+        results = fanout(hosts, task, args, kwargs, workers, timeout)
+        for result in results.itervalues():
+            if not result.failed:
+                result.result, host, name = result.result
+                if name and host not in self.HOSTS:
+                    self.register(host, name)
+        return results
+
     def __getattr__(self, name):
-        """Proxies method calls on this connector to the underlying system."""
-        try:
-            return super(Platform, self).__getattr__(name)
-        except AttributeError:
-            platform = self.get_platform_for_host(env['host'])
-            return getattr(platform, name)
+        """
+        Proxies method calls on this connector to the underlying system.
+        Only called for names this object doesn't have, see for_host() for
+        code that calls a lot of them.
+        """
+        if name.startswith('__'):
+            raise AttributeError(name)
+        platform = self.get_platform_for_host(env['host'])
+        return getattr(platform, name)
            
 platform = Platform()
 
-# Register some default platform classes
-platform.register_platform(Linux)
-platform.register_platform(Solaris)
-platform.register_platform(Darwin)
\ No newline at end of file
+# Register the default platforms, they are made when a host needs them
+platform.register_platform('fabricplatforms.linux.Linux', 'linux')
+platform.register_platform('fabricplatforms.solaris.Solaris', 'sunos')
+platform.register_platform('fabricplatforms.darwin.Darwin', 'darwin')
+
+class _package(types.ModuleType):
+    """
+    The fabricplatforms module, whose LAZY_NAMES are imported the first
+    time they are looked up, e.g. by from fabricplatforms import Linux.
+    Python 2 modules have no __getattr__ of their own.
+    """
+
+    def __getattr__(self, name):
+        try:
+            path = LAZY_NAMES[name]
+        except KeyError:
+            raise AttributeError(name)
+        value = import_object(path)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(LAZY_NAMES))
+
+_module = _package(__name__, __doc__)
+_module.__dict__.update(globals())
+# the globals of a module are cleared once it's collected, and the
+# functions above still use these
+_module._original = sys.modules[__name__]
+sys.modules[__name__] = _module
@@ -0,0 +1,174 @@
+import json
+import os
+
+import helper
+
+# run on the host to start the helper: reads its source from stdin first,
+# then leaves stdin to the requests
+BOOTSTRAP = ('import sys; i = getattr(sys.stdin, "buffer", sys.stdin); '
+             'exec(compile(i.read(int(i.readline())), "fabricplatforms-helper", "exec"))')
+
+class AgentError(Exception):
+    """A request the helper answered with an error, e.g. a missing file."""
+    pass
+
+class AgentGone(Exception):
+    """The helper could not be started or stopped answering."""
+    pass
+
+def _encode(value):
+    """value with the unicode strings json gave us turned back into utf-8 str."""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_encode(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_encode(key), _encode(item)) for key, item in value.iteritems())
+    return value
+
+def helper_source():
+    with open(os.path.splitext(helper.__file__)[0] + '.py', 'rb') as source:
+        return source.read()
+
+class Agent(object):
+    """
+    A helper.py process on the current host, started with the spawn() of
+    an executor and kept running to answer requests on its stdin and
+    stdout, so that lookups and changes don't each need a new shell.
+    """
+
+    def __init__(self, process):
+        self.process = process
+        self.received = 0
+
+    @classmethod
+    def start(cls, executor, cmd, use_sudo=False):
+        """Start the helper with cmd, raise AgentGone if it doesn't answer."""
+        try:
+            process = executor.spawn(cmd, use_sudo)
+        except Exception, e:
+            raise AgentGone(str(e))
+        agent = cls(process)
+        try:
+            source = helper_source()
+            agent._write('%d\n%s' % (len(source), source))
+            hello = agent._read()
+        except AgentGone:
+            agent.close()
+            raise
+        if not hello.get('ok') or hello['result'].get('version') != helper.VERSION:
+            agent.close()
+            raise AgentGone("Unexpected answer from the helper: %r" % hello)
+        return agent
+
+    def _write(self, data):
+        try:
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+        except (IOError, OSError, EOFError, ValueError), e:
+            raise AgentGone(str(e) or "The helper went away")
+
+    def _read(self):
+        try:
+            line = self.process.stdout.readline()
+            data = self.process.stdout.read(int(line)) if line.strip() else ''
+        except (IOError, OSError, EOFError, ValueError), e:
+            raise AgentGone(str(e) or "The helper went away")
+        if not data:
+            raise AgentGone("The helper went away")
+        self.received += len(line) + len(data)
+        return _encode(json.loads(data))
+
+    def request(self, op, args, cwd=None):
+        """
+        Send op with the dict args and return the result. walk answers in
+        several frames, for it a generator of the chunks is returned.
+        """
+        data = json.dumps({'op': op, 'args': args, 'cwd': cwd})
+        self.received = 0
+        self._write('%d\n%s' % (len(data), data))
+        if op == 'walk':
+            return self._chunks()
+        return self._answer(self._read())
+
+    def _answer(self, message):
+        if not message.get('ok'):
+            raise AgentError(message.get('error'))
+        return message.get('result')
+
+    def _chunks(self):
+        message = {}
+        try:
+            while True:
+                message = self._read()
+                result = self._answer(message)
+                if not message.get('more'):
+                    return
+                yield result
+        finally:
+            # read the rest if we were abandoned half way, so the next
+            # answer doesn't get mixed up with it
+            try:
+                while message.get('ok') and message.get('more'):
+                    message = self._read()
+            except AgentGone:
+                pass
+
+    def close(self):
+        try:
+            self.process.close()
+        except Exception:
+            pass
+
+class InlineAgent(object):
+    """
+    Answers the same requests as Agent in this process, for the local
+    platform. Relative paths are taken from the cwd of the request, like
+    the helper does, without changing the cwd of the process, and the
+    answers name them the way they were asked for.
+    """
+
+    received = 0
+
+    def request(self, op, args, cwd=None):
+        resolve = (lambda path: os.path.join(os.path.expanduser(cwd), path)) if cwd \
+            else (lambda path: path)
+        resolved = dict(args)
+        if op == 'link':
+            # the target goes into the link as given, the link is made next to it
+            resolved['path'] = os.path.join(resolve(os.path.dirname(args['target'])),
+                                            args['path'])
+        else:
+            for name in ('path', 'target'):
+                if name in args:
+                    resolved[name] = resolve(args[name])
+            if 'paths' in args:
+                resolved['paths'] = [resolve(path) for path in args['paths']]
+        try:
+            result = getattr(helper, 'op_' + op)(**resolved)
+            if op in ('stat', 'digest'):
+                return dict((path, result[resolve(path)]) for path in args['paths'])
+            if op == 'walk':
+                return self._chunks(result, args['path'], resolved['path'])
+            if op == 'listdir':
+                return _renamed(result, args['path'], resolved['path'])
+            return result
+        except (OSError, IOError, KeyError), e:
+            raise AgentError(str(e))
+
+    def _chunks(self, chunks, path, resolved):
+        try:
+            for chunk in chunks:
+                yield _renamed(chunk, path, resolved)
+        except (OSError, IOError), e:
+            raise AgentError(str(e))
+
+def _renamed(entries, path, resolved):
+    """Entries of the helper below resolved, with their paths below path instead."""
+    if path != resolved:
+        for entry in entries:
+            entry[0] = path + entry[0][len(resolved):]
+    return entries
+
+    def close(self):
+        pass
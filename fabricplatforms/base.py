@@ -1,15 +1,68 @@
 from __future__ import with_statement
 
+import hashlib
+import logging
 import os
-
-from fabric.api import run, sudo, cd, settings, hide
-
-from common.utils import shell_escape
-from common.filesystem import dirnode, filenode
+import pipes
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import Queue
+from contextlib import contextmanager
+from itertools import chain, groupby
+
+from fabric.api import run, sudo, cd, settings, hide, put as fabric_put
+from fabric.state import env
+from fabric.utils import abort
+
+from common.utils import shell_escape, linestream, lrucache
+from common.filesystem import dirnode, filenode, nodestore
+from metrics import callrecord
+from cache import ManifestCache
+from executors import prefixed, FabricExecutor
+from agent import Agent, AgentError, AgentGone, BOOTSTRAP, helper_source
+from eventloop import Future, gather, shared_executor
+
+# callables that get a callrecord for every execute(), see add_hook()
+hooks = []
+
+def add_hook(hook):
+    """
+    Install hook, a callable that is passed a callrecord after every
+    command a platform executes, e.g. a metrics.Metrics instance.
+    """
+    if hook not in hooks:
+        hooks.append(hook)
+
+def remove_hook(hook):
+    if hook in hooks:
+        hooks.remove(hook)
+
+# what _via_agent() returns when there's no helper agent to ask
+NOT_SENT = object()
 
 class PlatformError(Exception):
     pass
 
+class BatchError(PlatformError):
+    """Raised when one of the steps of a batch fails on the host."""
+    def __init__(self, step, cmd, return_code, output):
+        self.step = step
+        self.cmd = cmd
+        self.return_code = return_code
+        self.output = output
+        PlatformError.__init__(self, 'Batch step %d (%s) failed with status %s: %s'
+                               % (step, cmd, return_code, output))
+
+    def __reduce__(self):
+        # rebuilt from the fields, e.g. when sent back by a fanout() worker,
+        # along with attributes set later, like the changes of ensure_users()
+        return (BatchError, (self.step, self.cmd, self.return_code, self.output),
+                self.__dict__)
+
 class groupstruct(object):
     """Group helper object for storing groupget results."""
     def __init__(self, name, gid, members=[]):
@@ -29,6 +82,221 @@ class userstruct(object):
         self.home = home
         self.shell = shell
 
+class mountstruct(object):
+    """A line of df output, sizes in bytes and capacity in percent."""
+    def __init__(self, filesystem, fstype, size, used, available, capacity, mountpoint):
+        self.filesystem = filesystem
+        self.fstype = fstype
+        self.size = size
+        self.used = used
+        self.available = available
+        self.capacity = capacity
+        self.mountpoint = mountpoint
+
+class hostfacts(object):
+    """
+    What facts() found out about a host. mounts maps mount points to
+    mountstructs, groups maps group names to groupstructs, gathered is
+    the time.time() they were fetched at.
+    """
+    def __init__(self, hostname, system, release, machine, mounts, user_count, groups,
+                 gathered=None):
+        self.hostname = hostname
+        self.system = system
+        self.release = release
+        self.machine = machine
+        self.mounts = mounts
+        self.user_count = user_count
+        self.groups = groups
+        self.gathered = gathered if gathered is not None else time.time()
+
+class reloadreport(object):
+    """
+    What Platform.rolling_reload() did: the hosts whose config checked
+    out, those reloaded (and healthy), a dict of host -> error for those
+    that failed and the hosts that were left alone because of them.
+    """
+    def __init__(self, tested=None, reloaded=None, failed=None, skipped=None):
+        self.tested = tested or []
+        self.reloaded = reloaded or []
+        self.failed = failed or {}
+        self.skipped = skipped or []
+
+class accountchange(object):
+    """
+    What ensure_users() or ensure_groups() did to one account. action is
+    'created', 'modified' or 'unchanged', or 'failed' or 'skipped' when
+    the script stopped. changes maps the attributes set to their values.
+    """
+    def __init__(self, name, action, changes=None):
+        self.name = name
+        self.action = action
+        self.changes = changes or {}
+        self.error = None
+
+class syncreport(object):
+    """
+    What sync() did, as paths relative to the synced directories. renamed
+    is a list of (old, new) pairs of files moved on the host instead of
+    being uploaded again.
+    """
+    def __init__(self, uploaded, renamed, deleted, unchanged):
+        self.uploaded = uploaded
+        self.renamed = renamed
+        self.deleted = deleted
+        self.unchanged = unchanged
+
+class releasereport(object):
+    """
+    What release() did: the release name and directory, the number of
+    files in it and the objects that had to be uploaded for it.
+    """
+    def __init__(self, name, path, files, uploaded):
+        self.name = name
+        self.path = path
+        self.files = files
+        self.uploaded = uploaded
+
+class prunereport(object):
+    """What prune_releases() did: the releases removed and the number of objects freed."""
+    def __init__(self, removed, objects):
+        self.removed = removed
+        self.objects = objects
+
+class compilereport(object):
+    """
+    What byte_compile() did: the files compiled, and a dict of file ->
+    error message for those that failed. Up to date files are in neither.
+    """
+    def __init__(self, compiled, failed):
+        self.compiled = compiled
+        self.failed = failed
+
+class accountsnapshot(object):
+    """
+    Client side copy of the passwd and group databases of a host.
+
+    Primary and supplementary groups are worked out the same way
+    'id -Gn' does, so the userstructs match what userget() returns.
+    """
+
+    separator = '__fabricplatforms_accounts__'
+
+    def __init__(self, passwd_lines, group_lines):
+        self.groups = {}
+        self.users = {}
+        group_names, member_of = {}, {}
+        for fields in self._entries(group_lines, 4):
+            name, _, gid, member_string = fields
+            if name in self.groups:
+                continue
+            members = set(member_string.split(',')) if member_string else set()
+            self.groups[name] = groupstruct(name, int(gid), members)
+            group_names.setdefault(int(gid), name)
+            for member in members:
+                member_of.setdefault(member, set()).add(name)
+        for fields in self._entries(passwd_lines, 7):
+            name, _, uid, gid, comment, home, shell = fields
+            if name in self.users:
+                continue
+            group = group_names.get(int(gid), gid)
+            groups = member_of.get(name, set()) - set([group])
+            self.users[name] = userstruct(name, int(uid), int(gid), group, groups,
+                                          comment, home, shell)
+
+    def _entries(self, lines, count):
+        """Yield the fields of every well formed database line."""
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith(('#', '+', '-')):
+                continue
+            fields = line.split(':')
+            if len(fields) == count:
+                yield fields
+
+class Batch(object):
+    """
+    Queue of commands that are sent to the host as a single shell script.
+
+    Each step runs in its own subshell with the cwd and prefixes that were
+    active when it was queued. The script stops at the first failing step.
+    Consecutive steps sharing the same use_sudo value go out in one call,
+    or in as few as keep each script under the max_cmd_length of the
+    platform.
+    """
+
+    marker = '__fabricplatforms_batch__'
+
+    def __init__(self, host):
+        self.host = host
+        self.steps = []
+        self.results = []
+
+    def add(self, cmd, use_sudo=False):
+        self.steps.append((prefixed(cmd), use_sudo))
+
+    def script(self, steps):
+        """Return the shell script for a list of (index, cmd) steps."""
+        lines = []
+        for index, cmd in steps:
+            lines.append("echo '%s start %d'; ( %s ) 2>&1; rc=$?; "
+                         "echo '%s end %d' $rc; [ $rc -eq 0 ] || exit $rc"
+                         % (self.marker, index, cmd, self.marker, index))
+        return '\n'.join(lines)
+
+    def split(self, steps, limit):
+        """Split a list of (index, cmd) steps into lists whose scripts stay under limit."""
+        parts, part, size = [], [], 0
+        for step in steps:
+            length = len(self.script([step])) + 1
+            if part and size + length > limit:
+                parts.append(part)
+                part, size = [], 0
+            part.append(step)
+            size += length
+        if part:
+            parts.append(part)
+        return parts
+
+    def parse(self, content):
+        """Split the script output into {index: (return_code, output)}."""
+        results, index, lines = {}, None, []
+        for line in content.splitlines():
+            if line.startswith(self.marker):
+                fields = line.split()
+                if fields[1] == 'start':
+                    index, lines = int(fields[2]), []
+                else:
+                    results[int(fields[2])] = (int(fields[3]), '\n'.join(lines))
+                    index = None
+            elif index is not None:
+                lines.append(line)
+        return results
+
+    def run(self, platform):
+        """
+        Send the queued steps to the host. Return the list of outputs,
+        one per step, or raise BatchError for the first step that failed.
+        """
+        steps = list(enumerate(self.steps))
+        self.results = []
+        with settings(hide('everything'), warn_only=True,
+                      host_string=self.host, cwd='', command_prefixes=[]):
+            for use_sudo, chunk in groupby(steps, lambda step: step[1][1]):
+                chunk = [(index, cmd) for index, (cmd, _) in chunk]
+                for part in self.split(chunk, platform.max_cmd_length):
+                    content = platform.execute(self.script(part), use_sudo, template='batch')
+                    results = self.parse(content)
+                    for index, cmd in part:
+                        try:
+                            return_code, output = results[index]
+                        except KeyError:
+                            raise BatchError(index, cmd, content.return_code, content)
+                        if return_code:
+                            raise BatchError(index, cmd, return_code, output)
+                        self.results.append(output)
+        return self.results
+
 class BasePlatform(object):
     """Subclass me to make platform specific changes."""
     
@@ -36,10 +304,27 @@ class BasePlatform(object):
     chgrp_cmd = '/bin/chgrp %(recursive)s %(gid)s %(path)s'
     chmod_cmd = '/bin/chmod %(recursive)s %(mode)s %(path)s'
     chown_cmd = '/bin/chown %(recursive)s %(uid)s%(gid)s %(path)s'
-    df_cmd = '/bin/df -T'
-    digest_cmd = "/usr/bin/sha256sum %s | /bin/gawk '{print $1}'"
-    find_cmd = "/usr/bin/find %(file)s -printf '%%p:%%y:%%m:%%u:%%g:%%l:%%s,%%A@,%%T@,%%C@\n'"
+    # only_changed: find picks the entries that differ, changes them in bulk
+    # and prints them to be counted
+    chgrp_changed_cmd = ('%(find)s %(path)s %(depth)s ! -group %(gid)s '
+                         '-exec /bin/chgrp -h %(gid)s {} + -print | /usr/bin/wc -l')
+    chmod_changed_cmd = ('%(find)s %(path)s %(depth)s ! -type l ! -perm %(perm)s '
+                         '-exec /bin/chmod %(mode)s {} + -print | /usr/bin/wc -l')
+    chown_changed_cmd = ('%(find)s %(path)s %(depth)s %(test)s '
+                         '-exec /bin/chown -h %(uid)s%(gid)s {} + -print | /usr/bin/wc -l')
+    df_cmd = '/bin/df -PkT'
+    # what df_cmd prints per filesystem, sizes in 1k blocks
+    df_columns = ('filesystem', 'fstype', 'size', 'used', 'available', 'capacity',
+                  'mountpoint')
+    digest_cmd = '/usr/bin/sha256sum %s | /usr/bin/cut -c1-64'
+    find_cmd = ("/usr/bin/find %(file)s %(options)s "
+                "-printf '%%y:%%m:%%u:%%g:%%s,%%A@,%%T@,%%C@:%%p\\t%%l\\n'")
+    # find_cmd output of a directory's entries sorted by path (the sixth
+    # field), then cut down to a page
+    listdir_cmd = ('/usr/bin/test -d %(path)s && %(find)s 2>/dev/null | '
+                   'LC_ALL=C /usr/bin/sort -t: -k6%(page)s')
     hostname_cmd = '/bin/hostname'
+    uname_cmd = '/bin/uname -srm'
     ln_cmd = '/bin/ln -fs %s %s'
     ls_cmd = '/bin/ls -ARl1 --time-style=+%%s %s'
     mkdir_cmd = '/bin/mkdir %(parents)s %(directory)s'
@@ -49,15 +334,32 @@ class BasePlatform(object):
     rmdir_cmd = '/bin/rmdir %s'
     rel_ln_cmd = 'cd %s && /bin/ln -fs %s %s'
     stat_cmd = '/usr/bin/stat -c %%F:%%a:%%U:%%G:%%s,%%X,%%Y,%%Z %s'
+    stat_many_cmd = ('for path in %(paths)s; do echo %(separator)s; '
+                     'if %(test)s; then %(stat)s && { %(readlink)s || :; }; fi; done')
     test_cmd = '/usr/bin/test -e %s'
     test_link_cmd = '/usr/bin/test -h %s'
     touch_cmd = '/bin/touch %s'
     untar_cmd = '/bin/tar -xf %(file)s -C %(path)s'
     untar_gz_cmd = '/bin/tar -xzf %(file)s -C %(path)s'
-    untar_bz2_cmd = '/bin/tar -xzf %(file)s -C %(path)s'
+    untar_bz2_cmd = '/bin/tar -xjf %(file)s -C %(path)s'
+    # stream_untar() reads the archive from stdin
+    stream_untar_cmd = '/bin/tar -xf - -C %(path)s'
+    stream_untar_gz_cmd = ('if command -v pigz >/dev/null; then pigz -dc; '
+                           'else /bin/gzip -dc; fi | /bin/tar -xf - -C %(path)s')
+    stream_untar_bz2_cmd = ('if command -v pbzip2 >/dev/null; then pbzip2 -dc; '
+                            'else /bin/bzip2 -dc; fi | /bin/tar -xf - -C %(path)s')
+    stream_untar_zst_cmd = '/usr/bin/zstd -dc -T0 | /bin/tar -xf - -C %(path)s'
     apache_cmd = '/usr/sbin/apache2ctl %(subcommand)s'
     nginx_cmd = '/usr/sbin/nginx %(subcommand)s'
-    byte_compile_cmd = '%(python_exe)s -m compileall %(path)s'
+    # the subcommands that check the config and reload it without dropping
+    # connections, used by Platform.rolling_reload()
+    server_subcommands = {'apache': ('configtest', 'graceful'),
+                          'nginx': ('-t', '-s reload')}
+    # byte_compile() hands the files to compile_script on all cores with
+    # xargs -P, which works with interpreters that have no compileall -j
+    byte_compile_cmd = "/usr/bin/find %(path)s -name '*.py' -print0 | %(compile)s"
+    compile_files_cmd = ('/usr/bin/xargs -0 -r -n 64 -P %(workers)s '
+                         '%(python_exe)s -c %(script)s %(force)s')
 
     # user and group operations
     groupadd_cmd = '/usr/sbin/groupadd %(options)s %(group)s'
@@ -71,147 +373,1429 @@ class BasePlatform(object):
     userget_groups_cmd = '/usr/bin/id -Gn %(name)s'
     usermod_cmd = '/usr/sbin/usermod %(options)s %(name)s'
     users_cmd = '/bin/cat /etc/passwd'
+
+    # upper bound on the size of generated commands, well below ARG_MAX
+    max_cmd_length = 65536
+    stat_separator = '__fabricplatforms_stat__'
+
+    # streamed commands keep at most this many lines queued in memory, and
+    # their output is read this many bytes at a time
+    stream_queue_size = 10000
+    stream_buffer_size = 4096
+
+    # find errors that don't fail walk(), only logged: the directories it
+    # can't read are left out like the helper agent leaves them out
+    find_ignored_errors = r'Permission denied$'
+
+    # find tests that walk() passes through to find_cmd
+    find_predicates = ('type', 'user', 'group', 'uid', 'gid', 'mtime', 'mmin',
+                       'newer', 'size', 'name', 'path', 'perm')
+    # file type letters of find -printf %y and names of bsd stat %HT
+    find_types = {'d': 'directory', 'f': 'file', 'l': 'link',
+                  'b': 'block special file', 'c': 'character special file',
+                  'p': 'fifo', 's': 'socket',
+                  'regular file': 'file', 'symbolic link': 'link'}
+
+    # sync() manifests: a signature of the sizes and mtimes of the files in
+    # a tree, then sha256 digests of the files when it isn't the cached one
+    manifest_cmd = ('cd %(path)s 2>/dev/null || exit 0; signature=$(%(signature)s); '
+                    'echo %(separator)s $signature; '
+                    '[ "$signature" = "%(cached)s" ] || %(digests)s')
+    tree_signature_cmd = ("cd %(path)s && /usr/bin/find . -type f -printf '%%s %%T@ %%p\\n' | "
+                          "/usr/bin/sort | /usr/bin/sha256sum | /usr/bin/cut -c1-64")
+    digests_cmd = ('/usr/bin/find . -type f -print0 | /usr/bin/xargs -0 -r -n 64 '
+                   '-P $(%(nproc)s 2>/dev/null || echo 4) /usr/bin/sha256sum')
+    nproc_cmd = '/usr/bin/nproc'
+    manifest_separator = '__fabricplatforms_manifest__'
+
+    # release(): read only files named by sha256 and mode under objects/,
+    # releases/<name> trees of hard links to them and a current symlink.
+    # The store is locked with the .lock directory while a release or the
+    # object gc runs, a taken lock exits with release_locked_status. The
+    # objects the host lacks are listed from the names fed on stdin.
+    release_objects_cmd = ('/bin/mkdir -p %(path)s/objects %(path)s/releases && cd %(path)s && '
+                           '{ /bin/mkdir .lock 2>/dev/null || exit %(locked)s; } && '
+                           '{ test ! -e releases/%(name)s || echo %(separator)s; } && '
+                           'while read name; do test -e "objects/$name" || echo "$name"; done')
+    # new objects are unpacked in a staging directory and renamed into
+    # objects/ whole, an interrupted upload never leaves a truncated object
+    release_commit_cmd = ('cd %(path)s/%(staging)s && for prefix in */; do '
+                          '/bin/mkdir -p ../objects/$prefix && /bin/mv $prefix* ../objects/$prefix '
+                          '|| exit 1; done && cd .. && /bin/rm -rf %(staging)s')
+    # renames the new symlink over current, which ln -fs doesn't do atomically
+    release_switch_cmd = '/bin/mv -T %(link)s %(current)s'
+    release_unlock_cmd = '/bin/rmdir %(path)s/.lock'
+    # an object no release links to any more has a link count of 1, staging
+    # directories left while the store isn't locked are from failed releases
+    release_orphans_cmd = '/usr/bin/find objects -type f -links 1 -print -delete'
+    release_gc_cmd = ('cd %(path)s && { /bin/mkdir .lock 2>/dev/null || exit %(locked)s; } && '
+                      '/bin/rm -rf .staging-* && %(orphans)s | /usr/bin/wc -l; /bin/rmdir .lock')
+    release_locked_status = 75
+    release_separator = '__fabricplatforms_release__'
+
+    # first bytes of the compressed archives stream_untar() recognizes
+    compression_magic = (('\x1f\x8b', 'gz'), ('BZh', 'bz2'), ('\x28\xb5\x2f\xfd', 'zst'))
+    pipe_chunk_size = 65536
+
+    # run by compile_files_cmd, prints a tab separated line per file
+    compile_script = """
+import os, sys, py_compile
+try:
+    from importlib.util import cache_from_source
+except ImportError:
+    cache_from_source = lambda path: path + "c"
+for path in sys.argv[2:]:
+    try:
+        cached = cache_from_source(path)
+        if sys.argv[1] == "0" and os.path.exists(cached) and (
+                os.stat(cached).st_mtime >= os.stat(path).st_mtime):
+            continue
+        py_compile.compile(path, doraise=True)
+        line = "compiled" + chr(9) + path
+    except Exception as e:
+        line = "failed" + chr(9) + path + chr(9) + " ".join(str(e).split())
+    sys.stdout.write(line + chr(10))
+    sys.stdout.flush()
+"""
+
+    # where sync() keeps remote manifests between runs, None turns it off
+    manifest_cache = ManifestCache()
+
+    accounts_cmd = ('if [ -x /usr/bin/getent ]; then /usr/bin/getent passwd; '
+                    'echo %(separator)s; /usr/bin/getent group; '
+                    'else %(users)s; echo %(separator)s; %(groups)s; fi')
+
+    # runs the commands, None means fabric's run and sudo (see executors)
+    executor = None
+    # runs the commands of the a*() methods, None means the AsyncSSHExecutor
+    # shared by all platforms (see eventloop)
+    async_executor = None
+
+    # lookups remembered per host and task by the read cache, 0 turns it off
+    read_cache_size = 0
+
+    # keep helper.py running on each host and send it requests instead of
+    # starting a shell per command, see agent.py. Hosts it can't be started
+    # on (no python, no sudo -n, an executor without spawn()) get commands.
+    agent_mode = False
+    agent_cmd = ('for python in python3 python python2; do '
+                 'command -v $python >/dev/null && exec $python -u -c %(bootstrap)s; '
+                 'done; exit 127')
+    # ops that don't change anything, only these go to the agent in a batch
+    agent_reads = ('stat', 'walk', 'listdir', 'digest', 'hostname', 'accounts', 'groups',
+                   'groupget', 'userget')
+
+    # facts(): everything a pre-flight check wants in one call, and how
+    # many seconds its answer is kept per host
+    facts_cmd = ('echo %(separator)s hostname; %(hostname)s; '
+                 'echo %(separator)s uname; %(uname)s; '
+                 'echo %(separator)s df; %(df)s 2>/dev/null; '
+                 'echo %(separator)s accounts; %(accounts)s')
+    facts_separator = '__fabricplatforms_facts__'
+    facts_ttl = 300
+
+    def __init__(self):
+        self._batches = {}
+        self._read_caches = {}
+        self._facts = {}
+        self._agents = {}
+        self._agents_pid = os.getpid()
     
-    def execute(self, cmd, use_sudo=False):
+    def execute(self, cmd, use_sudo=False, template=None, method=None, **kwargs):
         """
         Execute command, either with run or sudo depending on 
-        whether the use_sudo kwarg is passed.
+        whether the use_sudo kwarg is passed. Other kwargs are passed
+        on to run or sudo.
+
+        template names the *_cmd attribute cmd was made from, it is only
+        used to label the callrecord handed to the installed hooks.
+        """
+        if self.executor is not None:
+            func = lambda cmd, **kwargs: self.executor.run(cmd, use_sudo, **kwargs)
+        else:
+            func = sudo if use_sudo else run
+        if not hooks:
+            return func(cmd, **kwargs)
+        return self._recorded(func, cmd, use_sudo, template, method or self._caller(),
+                              **kwargs)
+
+    def _recorded(self, func, cmd, use_sudo, template, method, size=None, host=None,
+                  **kwargs):
+        """
+        Call func(cmd, **kwargs) and hand a callrecord of it to the hooks.
+        size, if given, is the number of bytes sent or a callable that
+        returns it once func is done. host defaults to env.host_string,
+        threads that must not read env pass it.
+        """
+        result, started, host = None, time.time(), host or env.host_string
+        try:
+            result = func(cmd, **kwargs)
+            return result
+        finally:
+            elapsed = time.time() - started
+            if callable(size):
+                size = size()
+            if size is None:
+                size = getattr(kwargs.get('stdout'), 'bytes', None)
+            if size is None and result is not None:
+                size = len(result) + len(getattr(result, 'stderr', '') or '')
+            record = callrecord(host, method, template, cmd, use_sudo,
+                                elapsed, getattr(result, 'return_code', None), size)
+            for hook in list(hooks):
+                hook(record)
+
+    def put(self, local_path, remote_path, use_sudo=False):
+        """
+        Upload a local file to remote_path on the host, with the put() of
+        the executor if it has one, otherwise with fabric's put.
+        """
+        uploader = getattr(self.executor, 'put', None)
+        if uploader is None:
+            uploader = lambda local_path, remote_path, use_sudo: \
+                fabric_put(local_path, remote_path, use_sudo=use_sudo)
+        func = lambda cmd: uploader(local_path, remote_path, use_sudo)
+        if not hooks:
+            return func(None)
+        return self._recorded(func, 'put %s %s' % (local_path, remote_path), use_sudo,
+                              'put', self._caller(), size=os.path.getsize(local_path))
+
+    def pipe(self, cmd, chunks, use_sudo=False, template=None):
+        """
+        Run cmd on the host with the strings from the iterable chunks
+        written to its stdin, with the pipe() of the executor if it has one.
+        """
+        executor = self.executor if hasattr(self.executor, 'pipe') else FabricExecutor()
+        if not hooks:
+            return executor.pipe(cmd, chunks, use_sudo)
+        sent = [0]
+        def counted():
+            for chunk in chunks:
+                sent[0] += len(chunk)
+                yield chunk
+        func = lambda cmd: executor.pipe(cmd, counted(), use_sudo)
+        return self._recorded(func, cmd, use_sudo, template, self._caller(),
+                              size=lambda: sent[0])
+
+    def _agent(self, use_sudo=False):
+        """
+        The helper agent of the current host, started on first use. None if
+        agent_mode is off or the helper can't be started there, which is
+        remembered until close_agents().
         """
-        func = sudo if use_sudo else run
-        return func(cmd)
+        if not self.agent_mode:
+            return None
+        if self._agents_pid != os.getpid():
+            # forked by map(), the channels belong to the parent
+            self._agents, self._agents_pid = {}, os.getpid()
+        key = (env.host_string, bool(use_sudo))
+        agent = self._agents.get(key)
+        if agent is None:
+            agent = self._agents[key] = self._start_agent(use_sudo) or False
+        return agent or None
+
+    def _start_agent(self, use_sudo):
+        executor = self.executor if self.executor is not None else FabricExecutor()
+        if not hasattr(executor, 'spawn'):
+            return None
+        cmd = self.agent_cmd % {'bootstrap': pipes.quote(BOOTSTRAP)}
+        func = lambda cmd: Agent.start(executor, cmd, use_sudo)
+        try:
+            with settings(cwd='', command_prefixes=[]):
+                if not hooks:
+                    return func(cmd)
+                return self._recorded(func, cmd, use_sudo, 'agent_cmd', self._caller(),
+                                      size=len(helper_source()))
+        except AgentGone, e:
+            logging.warning("Could not start the helper on %s, using commands: %s",
+                            env.host_string, e)
+            return None
+
+    def _via_agent(self, op, use_sudo=False, **args):
+        """
+        Send op to the helper agent of the host and return its result, or
+        NOT_SENT if there is no agent or a batch is open and op changes
+        something. An error answer aborts like a failed command would,
+        unless warn_only is set.
+        """
+        if op not in self.agent_reads and env.host_string in self._batches:
+            return NOT_SENT
+        agent = self._agent(use_sudo)
+        if agent is None:
+            return NOT_SENT
+        func = lambda cmd: agent.request(op, args, env.cwd)
+        try:
+            if not hooks:
+                return func(op)
+            return self._recorded(func, 'agent %s' % op, use_sudo, 'agent_' + op,
+                                  self._caller(), size=lambda: agent.received)
+        except AgentGone, e:
+            # start a new one next time, commands do this one
+            logging.warning("Lost the helper on %s: %s", env.host_string, e)
+            agent.close()
+            self._agents.pop((env.host_string, bool(use_sudo)), None)
+            return NOT_SENT
+        except AgentError, e:
+            if env.warn_only:
+                logging.warning("%s", e)
+                return None
+            abort(str(e))
+
+    def close_agents(self, host=None):
+        """Stop the helper agents of host, or of every host."""
+        for key in self._agents.keys():
+            if host is None or key[0] == host:
+                agent = self._agents.pop(key)
+                if agent:
+                    agent.close()
+
+    def _caller(self):
+        """Name of the innermost public method of this platform on the stack."""
+        frame = sys._getframe(2)
+        while frame is not None:
+            name = frame.f_code.co_name
+            if not name.startswith('_') and frame.f_locals.get('self') is self:
+                return name
+            frame = frame.f_back
+
+    def _stream(self, cmd, use_sudo=False, template=None, ignored=None):
+        """
+        Execute cmd and yield its output line by line as it arrives.
+
+        The command is started here, with the start() of the executor if it
+        has one, and read by a background thread that feeds a bounded queue,
+        so the full output is never held in memory. The thread neither
+        reads nor changes env, and sudo must not ask for a password.
+
+        Raises PlatformError if the command fails, unless every line of its
+        stderr matches the regular expression ignored, then they are only
+        logged. Closing the generator early stops the command. Don't run
+        other commands on the host while consuming the lines.
+        """
+        lines = Queue.Queue(self.stream_queue_size)
+        done, cancelled, result = object(), threading.Event(), {}
+        method, host = (self._caller() if hooks else None), env.host_string
+        executor = self.executor if hasattr(self.executor, 'start') else FabricExecutor()
+        process = executor.start(cmd, use_sudo)
+
+        def put(line):
+            if not cancelled.is_set():
+                lines.put(line)
+
+        def target():
+            stream = linestream(put)
+            def read(cmd):
+                for data in iter(lambda: process.read(self.stream_buffer_size), ''):
+                    stream.write(data)
+                stream.close()
+                return process.wait()
+            try:
+                if hooks:
+                    result['output'] = self._recorded(read, cmd, use_sudo, template, method,
+                                                      size=lambda: stream.bytes, host=host)
+                else:
+                    result['output'] = read(cmd)
+            except BaseException:
+                result['error'] = sys.exc_info()
+            finally:
+                lines.put(done)
+
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        finished = False
+        try:
+            while True:
+                line = lines.get()
+                if line is done:
+                    finished = True
+                    break
+                yield line
+        finally:
+            if not finished:
+                # abandoned half way: end the command, and keep the queue
+                # empty so the reader thread isn't blocked until it is done
+                cancelled.set()
+                process.stop()
+                while thread.is_alive():
+                    while not lines.empty():
+                        lines.get_nowait()
+                    thread.join(0.05)
+        thread.join()
+        if 'error' in result:
+            raise result['error'][0], result['error'][1], result['error'][2]
+        output = result['output']
+        if output.failed:
+            errors = output.stderr.splitlines()
+            if not (ignored and errors and all(re.search(ignored, error) for error in errors)):
+                raise PlatformError(output.stderr or "%s failed with status %s"
+                                    % (cmd, output.return_code))
+            for error in errors:
+                logging.warning("%s: %s", host, error)
+
+    def _mutate(self, cmd, use_sudo=False, template=None):
+        """Queue cmd if a batch is open for the host, otherwise execute it."""
+        batch = self._batches.get(env.host_string)
+        if batch is None:
+            return self.execute(cmd, use_sudo, template=template)
+        batch.add(cmd, use_sudo)
+
+    @contextmanager
+    def batch(self):
+        """
+        Queue filesystem changes and send them to the host in one script::
+
+            with platform.batch():
+                platform.mkdir('/srv/app/releases/1', parents=True)
+                platform.chown('/srv/app/releases/1', 'app', 'app', use_sudo=True)
+                platform.link('/srv/app/releases/1', '/srv/app/current')
+
+        The script runs when the block exits without an exception. A step
+        that fails raises BatchError and the remaining steps are skipped.
+        Nested batches are merged into the outermost one.
+        """
+        host = env.host_string
+        if host in self._batches:
+            yield self._batches[host]
+            return
+        batch = self._batches[host] = Batch(host)
+        try:
+            yield batch
+        finally:
+            del self._batches[host]
+        if batch.steps:
+            try:
+                batch.run(self)
+            finally:
+                self.clear_read_cache(host)
+
+    def _reads(self):
+        """
+        The lookup cache of the current host, None if read_cache_size is 0.
+        A new cache is started whenever fabric moves on to another task.
+        """
+        if not self.read_cache_size:
+            return None
+        task = env.get('command')
+        entry = self._read_caches.get(env.host_string)
+        if entry is None or entry[0] != task:
+            entry = self._read_caches[env.host_string] = (task, lrucache(self.read_cache_size))
+        return entry[1]
+
+    def _cached(self, key, fetch, *args):
+        """Return the cached value for key, calling fetch(*args) on a miss."""
+        cache = self._reads()
+        if cache is None:
+            return fetch(*args)
+        if key in cache:
+            return cache[key]
+        value = cache[key] = fetch(*args)
+        return value
+
+    def _forget(self, test):
+        """Drop the cached lookups of the current host test(key) is true for."""
+        cache = self._reads()
+        if cache is not None:
+            cache.discard(test)
+
+    def _forget_paths(self, *paths):
+        """Drop cached stats of paths and of everything above or below them."""
+        paths = [self._cache_path(path) for path in paths]
+        def related(key):
+            if key[0] != 'stat':
+                return False
+            for path in paths:
+                if key[1] == path or key[1].startswith(path.rstrip('/') + '/') \
+                        or path.startswith(key[1].rstrip('/') + '/'):
+                    return True
+            return False
+        self._forget(related)
+
+    def _forget_accounts(self, users=(), groups=(), all_users=False, all_groups=False):
+        """Drop the cached userget() and groupget() results named, and the facts."""
+        self._facts.pop(env.host_string, None)
+        def related(key):
+            if key[0] == 'userget':
+                return all_users or key[1] in users
+            if key[0] == 'groupget':
+                return all_groups or key[1] in groups
+            return False
+        self._forget(related)
+
+    def _cache_path(self, path):
+        return os.path.normpath(os.path.join(env.cwd or '', path))
+
+    def clear_read_cache(self, host=None):
+        """
+        Forget the cached lookups of host, or of every host. Needed after
+        changing a host by other means than this platform's methods.
+        """
+        if host is None:
+            self._read_caches.clear()
+        else:
+            self._read_caches.pop(host, None)
     
     def apache(self,  subcommand, use_sudo=False):
         """Executes apachectl command with the passed subcommand."""
-        self.execute(self.apache_cmd % {'subcommand': subcommand})
+        return self.execute(self.apache_cmd % {'subcommand': subcommand}, use_sudo,
+                            template='apache_cmd')
 
     def nginx(self, subcommand, use_sudo=False):
-        self.execute(self.nginx_cmd % {'subcommand': subcommand}, use_sudo)
+        return self.execute(self.nginx_cmd % {'subcommand': subcommand}, use_sudo,
+                            template='nginx_cmd')
+
+    def chgrp(self, path, gid, recursive=False, use_sudo=False, only_changed=False):
+        """Changes the group owner of the specified filesystem path.
 
-    def chgrp(self, path, gid, recursive=False, use_sudo=False):
-        """Changes the group owner of the specified filesystem path."""
+        With only_changed, entries that already belong to gid are left
+        alone, ctime included, and the number of entries changed is
+        returned (None when queued in a batch).
+        """
+        result = self._via_agent('chgrp', use_sudo, path=path, gid=gid, recursive=recursive,
+                                 only_changed=only_changed)
+        if result is not NOT_SENT:
+            self._forget_paths(path)
+            return result
+        if only_changed:
+            return self._change_some('chgrp_changed_cmd', path, recursive, {'gid': gid},
+                                     use_sudo)
 
         recursive = ('-R' if recursive else '')
         args = {'recursive': recursive, 'gid': gid, 'path': shell_escape(path)}
-        self.execute(self.chgrp_cmd % args, use_sudo)
+        self._mutate(self.chgrp_cmd % args, use_sudo, template='chgrp_cmd')
+        self._forget_paths(path)
 
-    def chmod(self, path, mode, recursive=False, use_sudo=False):
+    def chmod(self, path, mode, recursive=False, use_sudo=False, only_changed=False):
         """Changes the permission mode of the specified filesystem path.
         mode can be an int or symbolic mode representation (e.g. g+rw)
+
+        only_changed works like for chgrp(), for octal modes and symbolic
+        ones that only add permissions.
         """
+        if str(mode).isdigit():
+            result = self._via_agent('chmod', use_sudo, path=path, mode=str(mode),
+                                     recursive=recursive, only_changed=only_changed)
+            if result is not NOT_SENT:
+                self._forget_paths(path)
+                return result
+        if only_changed:
+            mode = str(mode)
+            if mode.isdigit():
+                perm = mode
+            elif re.match(r'^([ugoa]*\+[rwxst]+,?)+$', mode):
+                perm = '-' + mode.rstrip(',')
+            else:
+                raise PlatformError("only_changed needs an octal mode or one that "
+                                    "only adds permissions, not %s" % mode)
+            return self._change_some('chmod_changed_cmd', path, recursive,
+                                     {'mode': mode, 'perm': perm}, use_sudo)
         args = {'recursive': '-R' if recursive else '', 
                 'mode': mode, 
                 'path': shell_escape(path)}
-        self.execute(self.chmod_cmd % args, use_sudo)
+        self._mutate(self.chmod_cmd % args, use_sudo, template='chmod_cmd')
+        self._forget_paths(path)
+
+    def chown(self, path, uid, gid=None, recursive=False, use_sudo=False, only_changed=False):
+        """Changes the user and possibly the group owner of the specified filesystem path.
 
-    def chown(self, path, uid, gid=None, recursive=False, use_sudo=False):
-        """Changes the user and possibly the group owner of the specified filesystem path."""
+        only_changed works like for chgrp().
+        """
+        result = self._via_agent('chown', use_sudo, path=path, uid=uid, gid=gid,
+                                 recursive=recursive, only_changed=only_changed)
+        if result is not NOT_SENT:
+            self._forget_paths(path)
+            return result
+        if only_changed:
+            test = '! -user %s' % uid
+            if gid:
+                test = '\\( %s -o ! -group %s \\)' % (test, gid)
+            args = {'uid': uid, 'gid': ':%s' % gid if gid else '', 'test': test}
+            return self._change_some('chown_changed_cmd', path, recursive, args, use_sudo)
         args = {
             'recursive': '-R' if recursive else '',
             'gid': ':%s' % gid if gid else '',
             'uid': uid, 
             'path': shell_escape(path)}
-        self.execute(self.chown_cmd % args, use_sudo)
+        self._mutate(self.chown_cmd % args, use_sudo, template='chown_cmd')
+        self._forget_paths(path)
+
+    def _change_some(self, template, path, recursive, args, use_sudo):
+        """Run a *_changed_cmd template and return the count it printed."""
+        args = dict(args, find=self.find_cmd.split()[0], path=shell_escape(path),
+                    depth='' if recursive else '-prune')
+        result = self._mutate(getattr(self, template) % args, use_sudo, template=template)
+        self._forget_paths(path)
+        if result is None:
+            return None
+        lines = result.strip().splitlines()
+        if len(lines) != 1 or not lines[0].strip().isdigit():
+            # find or the change complained about something
+            raise PlatformError(result)
+        return int(lines[0])
+
+    def df(self, use_sudo=False):
+        """
+        Return a dict of the mounted filesystems::
+
+            {'/': mountstruct(/), '/srv': mountstruct(/srv)}
+        """
+        with settings(hide('everything'), warn_only=True):
+            content = self.execute(self.df_cmd, use_sudo, template='df_cmd')
+        mounts = self._parse_df(content)
+        if not mounts and content.failed:
+            raise PlatformError(content)
+        return mounts
+
+    def _parse_df(self, content):
+        """mountstructs from df_cmd output, laid out as df_columns says."""
+        mounts, pending = {}, []
+        count = len(self.df_columns)
+        for line in content.splitlines():
+            fields = pending + line.split(None, count - 1 - len(pending))
+            if len(fields) < count:
+                # a long filesystem name is put on a line of its own
+                pending = fields
+                continue
+            pending = []
+            values = dict(zip(self.df_columns, fields))
+            try:
+                sizes = [int(values[name]) * 1024 for name in ('size', 'used', 'available')]
+            except ValueError:
+                # the header, or a filesystem without sizes
+                continue
+            capacity = values['capacity'].rstrip('%')
+            mounts[values['mountpoint']] = mountstruct(
+                values['filesystem'], values.get('fstype'), sizes[0], sizes[1], sizes[2],
+                int(capacity) if capacity.isdigit() else None, values['mountpoint'])
+        return mounts
+
+    def facts(self, use_sudo=False, refresh=False):
+        """
+        Return the hostfacts of the host: its hostname, uname, filesystems,
+        number of users and groups, fetched with a single command. They are
+        kept for facts_ttl seconds unless refresh is set, account changes
+        made by this platform drop them. Platform.facts() gets them for
+        many hosts at once.
+        """
+        host = env.host_string
+        facts = self._fresh_facts(host)
+        if facts is not None and not refresh:
+            return facts
+        with settings(hide('everything'), warn_only=True):
+            content = self.execute(self._facts_cmd(), use_sudo, template='facts_cmd')
+        return self._remember_facts(host, self._parse_facts(content))
+
+    def _fresh_facts(self, host):
+        facts = self._facts.get(host)
+        if facts is not None and time.time() - facts.gathered < self.facts_ttl:
+            return facts
+        return None
+
+    def _remember_facts(self, host, facts):
+        self._facts[host] = facts
+        return facts
+
+    def _facts_cmd(self):
+        return self.facts_cmd % {'separator': self.facts_separator,
+                                 'hostname': self.hostname_cmd, 'uname': self.uname_cmd,
+                                 'df': self.df_cmd, 'accounts': self._accounts_cmd()}
+
+    def _parse_facts(self, content):
+        sections, lines = {}, None
+        for line in content.splitlines():
+            if line.startswith(self.facts_separator + ' '):
+                lines = sections[line.split()[1]] = []
+            elif lines is not None:
+                lines.append(line)
+        if 'accounts' not in sections:
+            raise PlatformError(content)
+        uname = ' '.join(sections['uname']).split()
+        uname += [None] * (3 - len(uname))
+        passwd, _, group = '\n'.join(sections['accounts']).partition(accountsnapshot.separator)
+        snapshot = accountsnapshot(passwd.splitlines(), group.splitlines())
+        return hostfacts(self._parse_hostname('\n'.join(sections['hostname']).strip()),
+                         uname[0], uname[1], uname[2],
+                         self._parse_df('\n'.join(sections['df'])),
+                         len(snapshot.users), snapshot.groups)
 
     def hostname(self, use_sudo=False):
+        return self._cached(('hostname',), self._hostname, use_sudo)
+
+    def _hostname(self, use_sudo):
+        # reading the name needs no sudo, the agent is asked without it
+        hostname = self._via_agent('hostname')
+        if hostname is not NOT_SENT:
+            return hostname or "Unknown"
         with settings(hide('everything'), warn_only=True):
-            hostname = self.execute(self.hostname_cmd, use_sudo)
-        return hostname or "Unknown"
+            hostname = self.execute(self.hostname_cmd, use_sudo, template='hostname_cmd')
+        return self._parse_hostname(hostname)
+
+    def _parse_hostname(self, content):
+        return content or "Unknown"
 
     def link(self, target, path, absolute=False, use_sudo=False):
         """Creates the specified symbolic link."""
         
         head, tail = os.path.split(target)
         
+        if self._via_agent('link', use_sudo, target=target, path=path,
+                           absolute=absolute) is not NOT_SENT:
+            self._forget_paths(os.path.join(head, path))
+            return
+
         if absolute:
             target = tail
         
         with cd(head):
-            self.execute(self.ln_cmd % (target, path), use_sudo)
+            self._mutate(self.ln_cmd % (target, path), use_sudo, template='ln_cmd')
+        self._forget_paths(os.path.join(head, path))
 
 
 
 
     def mkdir(self, path, parents=False, use_sudo=False):
         """Creates the specified directory."""
+        self._forget_paths(path)
+        if self._via_agent('mkdir', use_sudo, path=path, parents=parents) is not NOT_SENT:
+            return
         args = {'parents': '-p' if parents else '', 
                 'directory': shell_escape(path)}
-        self.execute(self.mkdir_cmd % args, use_sudo)
+        self._mutate(self.mkdir_cmd % args, use_sudo, template='mkdir_cmd')
 
     def move(self, path, target, use_sudo=False):
         """Moves the specified filesystem path to the specified target."""
+        self._forget_paths(path, target)
+        if self._via_agent('move', use_sudo, path=path, target=target) is not NOT_SENT:
+            return
         args = {'path': shell_escape(path), 'target': shell_escape(target)}
-        self.execute(self.mv_cmd % args, use_sudo)
+        self._mutate(self.mv_cmd % args, use_sudo, template='mv_cmd')
 
     def remove(self, path, recursive=False, force=False, link=False, use_sudo=False):
         """Removes the specified filesystem path."""
+        self._forget_paths(path)
+        if self._via_agent('remove', use_sudo, path=path, recursive=recursive, force=force,
+                           link=link) is not NOT_SENT:
+            return
+        template = 'test_link_cmd' if link else 'test_cmd'
+        test = getattr(self, template)
+        recursive, force = ('-r' if recursive else ''), ('-f' if force else '')
+        cmd = self.rm_cmd % (recursive, force, shell_escape(path))
+        if env.host_string in self._batches:
+            # the test has to happen on the host when the batch runs
+            test = test % shell_escape(path)
+            return self._mutate('if %s; then %s; fi' % (test, cmd), use_sudo,
+                                template='rm_cmd')
         # first test if the file is there.
-        cmd = self.test_link_cmd if link else self.test_cmd
         with settings(hide('everything'), warn_only=True):
-            if self.execute(cmd % shell_escape(path), use_sudo=use_sudo).failed:
+            if self.execute(test % shell_escape(path), use_sudo=use_sudo,
+                            template=template).failed:
                 return
-        recursive, force = ('-r' if recursive else ''), ('-f' if force else '')
-        self.execute(self.rm_cmd % (recursive, force, shell_escape(path)), use_sudo=use_sudo)
+        self.execute(cmd, use_sudo=use_sudo, template='rm_cmd')
 
     def rmdir(self, path, use_sudo=False):
         """Removes the directory at path."""
-        self.execute(self.rmdir_cmd % shell_escape(path), use_sudo=use_sudo)
+        self._forget_paths(path)
+        if self._via_agent('rmdir', use_sudo, path=path) is not NOT_SENT:
+            return
+        self._mutate(self.rmdir_cmd % shell_escape(path), use_sudo=use_sudo,
+                     template='rmdir_cmd')
 
     def stat(self, path, link=False, use_sudo=False):
-        """Generates status information on the specified filesystem path."""
-        path = shell_escape(path)
-        cmd = self.test_link_cmd if link else self.test_cmd
-        # do we even exist?
-        with settings(hide('everything'), warn_only=True):
-            if self.execute(cmd % path, use_sudo=use_sudo).failed:
-                return
-        
+        """
+        Generates status information on the specified filesystem path.
+        Returns None if the path does not exist.
+        """
+        return self.stat_many([path], link, use_sudo)[path]
+
+    def stat_many(self, paths, link=False, use_sudo=False):
+        """
+        Generates status information on several filesystem paths at once.
+
+        Return a dict of path -> dirnode/filenode, or None for paths that do
+        not exist. Existence, metadata and link targets for all paths come
+        back from a single call, split up only to stay under max_cmd_length.
+        With the read cache on, only paths not looked up before are sent.
+        """
+        cache = self._reads()
+        if cache is None:
+            return self._lazy_dirs(self._stat_many(paths, link, use_sudo), use_sudo)
+        keys = dict((path, ('stat', self._cache_path(path), link, use_sudo))
+                    for path in paths)
+        nodes = dict((path, cache[key]) for path, key in keys.iteritems() if key in cache)
+        missing = [path for path in paths if path not in nodes]
+        if missing:
+            fetched = self._lazy_dirs(self._stat_many(missing, link, use_sudo), use_sudo)
+            for path, node in fetched.iteritems():
+                cache[keys[path]] = node
+            nodes.update(fetched)
+        return nodes
+
+    def _lazy_dirs(self, nodes, use_sudo):
+        """Give the dirnodes in the dict nodes a loader for their children."""
+        for node in nodes.itervalues():
+            if isinstance(node, dirnode):
+                node.set_loader(self._child_loader(node.path, use_sudo))
+        return nodes
+
+    def _child_loader(self, path, use_sudo):
+        """A dirnode loader that lists path with listdir() on this host."""
+        host = env.host_string
+        def load(prefix, limit, offset):
+            with settings(host_string=host):
+                return self.listdir(path, prefix, limit, offset, use_sudo)
+        return load
+
+    def listdir(self, path, prefix=None, limit=None, offset=0, use_sudo=False):
+        """
+        The nodes of the entries directly in the directory at path, sorted
+        by name: those whose name starts with prefix if given, and only
+        limit of them from offset on. Filtering, sorting and paging happen
+        on the host, so a page of a huge directory costs only its own
+        transfer. The directories returned load their children the same
+        way when used, see dirnode.load().
+        """
+        path = path.rstrip('/') or '/'
         with settings(hide('everything'), warn_only=True):
-            content = self.execute(self.stat_cmd % path, use_sudo=use_sudo)
-        filetype, mode, user, group, values = content.strip().split(':')
+            found = self._via_agent('listdir', use_sudo, path=path, prefix=prefix, limit=limit,
+                                    offset=offset)
+        if found is None:
+            raise PlatformError("Not a directory: %s" % path)
+        if found is not NOT_SENT:
+            nodes = [self._entry_node(*entry) for entry in found]
+        else:
+            options = '-mindepth 1 -maxdepth 1'
+            if prefix:
+                pattern = re.sub(r'([*?\[\]\\])', r'\\\1', prefix) + '*'
+                options += ' -name %s' % shell_escape(pattern)
+            page = ''
+            if offset:
+                page += ' | /usr/bin/tail -n +%d' % (offset + 1)
+            if limit is not None:
+                page += ' | /usr/bin/head -n %d' % limit
+            args = {'path': shell_escape(path), 'page': page,
+                    'find': self.find_cmd % {'file': shell_escape(path), 'options': options}}
+            with settings(hide('everything'), warn_only=True):
+                content = self.execute(self.listdir_cmd % args, use_sudo, template='listdir_cmd')
+            if content.failed:
+                raise PlatformError("Not a directory: %s" % path)
+            nodes = [node for node in map(self._find_node, content.splitlines()) if node]
+        self._lazy_dirs(dict((node.path, node) for node in nodes), use_sudo)
+        return nodes
+
+    def _stat_many(self, paths, link, use_sudo):
+        found = self._via_agent('stat', use_sudo, paths=list(paths), link=link)
+        if found is not NOT_SENT:
+            found = found or {}
+            return dict((path, self._entry_node(path, *found[path]) if found.get(path) else None)
+                        for path in paths)
+        nodes = {}
+        for chunk, cmd in self._stat_many_cmds(paths, link):
+            with settings(hide('everything'), warn_only=True):
+                content = self.execute(cmd, use_sudo=use_sudo, template='stat_many_cmd')
+            nodes.update(self._stat_chunk(chunk, content))
+        return nodes
+
+    def _stat_many_cmds(self, paths, link):
+        """Yield a (paths, stat_many_cmd) pair for every chunk of paths."""
+        test = self.test_link_cmd if link else self.test_cmd
+        args = {'separator': self.stat_separator,
+                'test': test % '"$path"',
+                'stat': self.stat_cmd % '"$path"',
+                'readlink': self.readlink_cmd % '"$path"'}
+        for chunk in self._chunk_paths(paths):
+            args['paths'] = ' '.join(shell_escape(path) for path in chunk)
+            yield chunk, self.stat_many_cmd % args
+
+    def _stat_chunk(self, chunk, content):
+        """The nodes of a chunk of paths from the output of its stat_many_cmd."""
+        results = content.split(self.stat_separator)[1:]
+        if len(results) != len(chunk):
+            raise PlatformError(content)
+        return dict((path, self._stat_node(path, result))
+                    for path, result in zip(chunk, results))
+
+    def _chunk_paths(self, paths):
+        """Split paths into lists that fit in a single command."""
+        chunk, length = [], 0
+        for path in paths:
+            if chunk and length + len(path) > self.max_cmd_length:
+                yield chunk
+                chunk, length = [], 0
+            chunk.append(path)
+            length += len(path) + 3
+        if chunk:
+            yield chunk
+
+    def _stat_node(self, path, content):
+        """Build a node from the stat_cmd line and optional readlink line."""
+        lines = content.strip().splitlines()
+        if not lines:
+            return None
+        filetype, mode, user, group, values = lines[0].strip().split(':')
         #mode, values = int(mode, 8), [ int(value) for value in values.split(',') ]
         values = [ int(value) for value in values.split(',') ]
-        if filetype.lower() == 'directory':
+        filetype = filetype.lower()
+        if filetype == 'directory':
             return dirnode(path, mode, user, group, *values)
-        elif filetype.lower() == 'regular file':
+        elif filetype in ('regular file', 'regular empty file'):
             return filenode(path, mode, user, group, *values)
-        elif filetype.lower() == 'symbolic link':
-            with settings(hide('everything'), warn_only=True):
-                target = self.execute(self.readlink_cmd % path, use_sudo)
-            return filenode(path, mode, user, group, *values, ftype='link', target=target.strip())
+        elif filetype == 'symbolic link':
+            target = lines[1].strip() if len(lines) > 1 else None
+            return filenode(path, mode, user, group, *values, ftype='link', target=target)
         else:
             return filenode(path, mode, user, group, *values, ftype=filetype)
 
+    def iterwalk(self, path, maxdepth=None, predicates=None, use_sudo=False):
+        """
+        Yield a dirnode or filenode for path and everything below it, as
+        the output of find_cmd arrives.
+
+        predicates is a dict of find tests and their find style values,
+        which are evaluated on the host, e.g.::
+
+            platform.iterwalk('/srv/app', predicates={'type': 'f',
+                                                      'mtime': '-1',
+                                                      'size': '+10M'})
+
+        Directories that can't be read are left out, with a warning in the
+        log, instead of failing the walk.
+        """
+        if not predicates and self._agent(use_sudo) is not None:
+            nodes = self._agent_walk(path, maxdepth, use_sudo)
+            try:
+                first = next(nodes)
+            except AgentGone:
+                # lost before anything arrived, find can still do it
+                pass
+            else:
+                for node in chain([first], nodes):
+                    yield node
+                return
+        options = []
+        if maxdepth is not None:
+            options.append('-maxdepth %d' % maxdepth)
+        for name, value in sorted((predicates or {}).iteritems()):
+            if name not in self.find_predicates:
+                raise PlatformError("Unsupported find predicate: %s" % name)
+            options.append('-%s %s' % (name, shell_escape(str(value))))
+        cmd = self.find_cmd % {'file': shell_escape(path), 'options': ' '.join(options)}
+        for line in self._stream(cmd, use_sudo, template='find_cmd',
+                                 ignored=self.find_ignored_errors):
+            node = self._find_node(line)
+            if node is not None:
+                yield node
+
+    def _agent_walk(self, path, maxdepth, use_sudo):
+        """iterwalk() done by the helper agent, which sends the nodes in chunks."""
+        agent, started, error = self._agent(use_sudo), time.time(), None
+        try:
+            for chunk in agent.request('walk', {'path': path, 'maxdepth': maxdepth}, env.cwd):
+                for entry in chunk:
+                    yield self._entry_node(*entry)
+        except AgentGone, e:
+            error = e
+            logging.warning("Lost the helper on %s: %s", env.host_string, e)
+            agent.close()
+            self._agents.pop((env.host_string, bool(use_sudo)), None)
+            raise
+        except AgentError, e:
+            error = e
+            raise PlatformError(str(e))
+        finally:
+            if hooks:
+                record = callrecord(env.host_string, self._caller(), 'agent_walk',
+                                    'agent walk', use_sudo, time.time() - started,
+                                    1 if error else 0, agent.received)
+                for hook in list(hooks):
+                    hook(record)
+
+    def walk(self, path, maxdepth=None, predicates=None, use_sudo=False):
+        """
+        Return a dirnode for path with the tree below it filled into the
+        dirs and files maps, e.g. platform.walk('/srv/app').static.css.
+
+        Takes the same arguments as iterwalk(). Directories that were
+        filtered out but have matching entries below them are filled in
+        as dirnodes without status information. Without predicates, the
+        directories at maxdepth load their children when used, see
+        dirnode.load().
+        """
+        root = path.rstrip('/') or '/'
+        tree = {}
+
+        def directory(key):
+            node = tree.get(key)
+            if node is None:
+                node = tree[key] = dirnode(key)
+                if key != root:
+                    directory(os.path.dirname(key)).add(node)
+            return node
+
+        for node in self.iterwalk(path, maxdepth, predicates, use_sudo):
+            key = node.path.rstrip('/') or '/'
+            if node.ftype == 'directory':
+                placeholder = tree.get(key)
+                tree[key] = node
+                if placeholder is not None:
+                    for child in placeholder.dirs.values() + placeholder.files.values():
+                        node.add(child)
+                if key == root:
+                    continue
+            directory(os.path.dirname(key)).add(node)
+            if maxdepth is not None and not predicates and node.ftype == 'directory':
+                relative = key[len(root):].strip('/')
+                if relative.count('/') + 1 == maxdepth:
+                    node.set_loader(self._child_loader(key, use_sudo))
+        return directory(root)
+
+    def listing(self, path, maxdepth=None, predicates=None, use_sudo=False):
+        """
+        Like walk(), but return the nodes in a nodestore, which keeps them
+        in columns instead of one object per node. Meant for listings of
+        millions of entries.
+        """
+        return nodestore(self.iterwalk(path, maxdepth, predicates, use_sudo))
+
+    def _find_node(self, line):
+        """Build a node from a line of find_cmd output, None if malformed."""
+        fields = line.split(':', 5)
+        if len(fields) != 6:
+            return None
+        filetype, mode, user, group, values, rest = fields
+        path, _, target = rest.rpartition('\t')
+        try:
+            values = [ int(float(value)) for value in values.split(',') ]
+        except ValueError:
+            return None
+        return self._entry_node(path, filetype, mode, user, group, values, target)
+
+    def _entry_node(self, path, filetype, mode, user, group, values, target=None):
+        """Build a node from a find -printf %y file type and the stat fields."""
+        filetype = self.find_types.get(filetype.lower(), filetype.lower())
+        if filetype == 'directory':
+            return dirnode(path, mode, user, group, *values)
+        elif filetype == 'link':
+            return filenode(path, mode, user, group, *values, ftype='link', target=target)
+        return filenode(path, mode, user, group, *values, ftype=filetype)
 
     def touch(self, path, use_sudo=False):
         """Touches the specified filesystem path."""
-        self.execute(self.touch_cmd % shell_escape(path), use_sudo)
+        self._forget_paths(path)
+        if self._via_agent('touch', use_sudo, path=path) is not NOT_SENT:
+            return
+        self._mutate(self.touch_cmd % shell_escape(path), use_sudo, template='touch_cmd')
 
     def untar(self, file, path=None, use_sudo=False):
         """Untar a file into path. If Path is None will untar in place."""
 
         if not path:
             path = os.path.dirname(file)
-
-        file = shell_escape(file)
-        path = shell_escape(path)
+        self._forget_paths(path)
 
         if file.endswith('bz2'):
-            cmd = self.untar_bz2_cmd % {'file': file, 'path': path}
+            template = 'untar_bz2_cmd'
         elif file.endswith('gz'):
-            cmd = self.untar_gz_cmd % {'file': file, 'path': path}
+            template = 'untar_gz_cmd'
         else:
-            cmd = self.untar_cmd % {'file': file, 'path': path}
+            template = 'untar_cmd'
+        args = {'file': shell_escape(file), 'path': shell_escape(path)}
+        cmd = getattr(self, template) % args
 
-        self.execute(cmd, use_sudo)
+        self.execute(cmd, use_sudo, template=template)
 
-    def byte_compile(self, python_exe, path, use_sudo=False):
+    def stream_untar(self, source, path, compression=None, use_sudo=False):
+        """
+        Extract a local tar archive, given as a filename or a file object,
+        into path on the host. The archive is streamed into tar over ssh
+        instead of being uploaded and written to the host's disk first.
+
+        compression is 'gz', 'bz2', 'zst' or None for a plain tar, and is
+        recognized from the data when not given. pigz and pbzip2 are used
+        when the host has them. With use_sudo, sudo has to be allowed
+        without a password since stdin carries the archive.
+        """
+        if isinstance(source, basestring):
+            with open(source, 'rb') as fileobj:
+                return self.stream_untar(fileobj, path, compression, use_sudo)
+        head = source.read(self.pipe_chunk_size)
+        if compression is None:
+            for magic, name in self.compression_magic:
+                if head.startswith(magic):
+                    compression = name
+                    break
+        template = 'stream_untar_%s_cmd' % compression if compression else 'stream_untar_cmd'
+        if not hasattr(self, template):
+            raise PlatformError("Unsupported compression: %s" % compression)
+        cmd = getattr(self, template) % {'path': shell_escape(path)}
+        chunks = chain([head], iter(lambda: source.read(self.pipe_chunk_size), ''))
+        self._forget_paths(path)
+        return self.pipe(cmd, chunks, use_sudo, template=template)
+
+    def byte_compile(self, python_exe, path, use_sudo=False, files=None, workers=None,
+                     force=False):
         """
         Byte compile all the code in a directory.
         Useful for speeding the initial load times of wsgi apps.
+
+        The files are compiled by workers processes at once, as many as the
+        host has cores by default. Modules whose compiled file is newer
+        than the source are skipped unless force is set. files limits the
+        work to some paths relative to path: a list, the keys of a
+        manifest, or the syncreport of the sync() that changed them.
+
+        Return a compilereport.
         """
+        if isinstance(files, syncreport):
+            files = files.uploaded + [new for old, new in files.renamed]
         args = {'python_exe': shell_escape(python_exe),
-                'path': shell_escape(path)}
-        self.execute(self.byte_compile_cmd % args, use_sudo)
+                'path': shell_escape(path),
+                'workers': int(workers) if workers else
+                           '$(%s 2>/dev/null || echo 4)' % self.nproc_cmd,
+                'script': pipes.quote(self.compile_script),
+                'force': '1' if force else '0'}
+        compile = self.compile_files_cmd % args
+        with settings(hide('everything'), warn_only=True):
+            if files is None:
+                args['compile'] = compile
+                content = self.execute(self.byte_compile_cmd % args, use_sudo,
+                                       template='byte_compile_cmd')
+            else:
+                paths = [os.path.join(path, name) for name in files if name.endswith('.py')]
+                if not paths:
+                    return compilereport([], {})
+                content = self.pipe(compile, ['\0'.join(paths)], use_sudo,
+                                    template='compile_files_cmd')
+            if content.failed:
+                raise PlatformError(content)
+        self._forget_paths(path)
+        compiled, failed = [], {}
+        for line in content.splitlines():
+            fields = line.split('\t')
+            if fields[0] == 'compiled' and len(fields) == 2:
+                compiled.append(fields[1])
+            elif fields[0] == 'failed' and len(fields) == 3:
+                failed[fields[1]] = fields[2]
+        return compilereport(compiled, failed)
+
+    def digest(self, path, use_sudo=False):
+        """The sha256 hex digest of the file at path, None if it can't be read."""
+        digests = self._via_agent('digest', use_sudo, paths=[path])
+        if digests is not NOT_SENT:
+            return (digests or {}).get(path)
+        with settings(hide('everything'), warn_only=True):
+            content = self.execute(self.digest_cmd % shell_escape(path), use_sudo,
+                                   template='digest_cmd')
+        return self._parse_digest(content)
+
+    def _parse_digest(self, content):
+        digest = content.strip()
+        if len(digest) != 64 or digest.strip('0123456789abcdef'):
+            return None
+        return digest
+
+    def sync(self, local_dir, remote_dir, delete=True, use_sudo=False):
+        """
+        Make the files under remote_dir the same as those under local_dir,
+        sending only what changed::
+
+            platform.sync('build/app', '/srv/app/current', use_sudo=True)
+
+        The remote manifest (sha256 of every file, hashed on all cores) is
+        fetched in one call, or reused from manifest_cache when the sizes
+        and mtimes of the remote tree haven't changed since. Files that
+        differ are uploaded as a single archive. Files that moved are moved
+        on the host, and with delete those missing locally are removed, all
+        in one batch together with the unpacking. Empty directories are
+        left alone. Raises PlatformError if local_dir isn't a directory,
+        before anything is read from the host.
+
+        Return a syncreport.
+        """
+        local = self._local_manifest(local_dir)
+        remote = self._remote_manifest(remote_dir, use_sudo)
+        deleted = set(remote) - set(local) if delete else set()
+        sources = {}
+        for path in sorted(deleted):
+            sources.setdefault(remote[path], []).append(path)
+        uploaded, renamed = [], []
+        for path in sorted(local):
+            if remote.get(path) == local[path]:
+                continue
+            if sources.get(local[path]):
+                renamed.append((sources[local[path]].pop(0), path))
+            else:
+                uploaded.append(path)
+        report = syncreport(uploaded, renamed,
+                            sorted(deleted - set(old for old, new in renamed)),
+                            len(local) - len(uploaded) - len(renamed))
+        manifest = dict((path, digest) for path, digest in remote.iteritems()
+                        if path not in deleted)
+        manifest.update(local)
+        if not (uploaded or renamed or report.deleted):
+            return report
+
+        archive = remote_archive = None
+        if uploaded:
+            archive = self._pack(local_dir, uploaded)
+            remote_archive = '/tmp/fabricplatforms-sync-%s.tar.gz' % uuid.uuid4().hex
+        try:
+            if archive:
+                self.put(archive, remote_archive)
+            with self.batch() as batch:
+                self.mkdir(remote_dir, parents=True, use_sudo=use_sudo)
+                directories = set()
+                for old, new in renamed:
+                    directory = os.path.dirname(os.path.join(remote_dir, new))
+                    if directory not in directories:
+                        directories.add(directory)
+                        self.mkdir(directory, parents=True, use_sudo=use_sudo)
+                    self.move(os.path.join(remote_dir, old), os.path.join(remote_dir, new),
+                              use_sudo=use_sudo)
+                if archive:
+                    args = {'file': shell_escape(remote_archive), 'path': shell_escape(remote_dir)}
+                    self._mutate(self.untar_gz_cmd % args, use_sudo, template='untar_gz_cmd')
+                    self.remove(remote_archive, force=True, use_sudo=use_sudo)
+                for path in report.deleted:
+                    self.remove(os.path.join(remote_dir, path), force=True, use_sudo=use_sudo)
+                self._mutate(self.tree_signature_cmd % {'path': shell_escape(remote_dir)},
+                             use_sudo, template='tree_signature_cmd')
+                signature_step = len(batch.steps) - 1
+            self._forget_paths(remote_dir)
+        finally:
+            if archive:
+                os.remove(archive)
+        # inside an outer batch nothing has run yet, there is no signature
+        if self.manifest_cache is not None and len(batch.results) > signature_step:
+            self.manifest_cache.set(env.host_string, remote_dir,
+                                    batch.results[signature_step].strip(), manifest)
+        return report
+
+    def _local_manifest(self, local_dir):
+        """
+        Dict of relative path -> sha256 of the files under local_dir.
+        Raises PlatformError if local_dir isn't a directory, which would
+        otherwise look like one with nothing in it.
+        """
+        if not os.path.isdir(local_dir):
+            raise PlatformError("%s is not a local directory" % local_dir)
+        manifest = {}
+        for directory, dirs, files in os.walk(local_dir):
+            for name in files:
+                path = os.path.join(directory, name)
+                if not os.path.isfile(path):
+                    continue
+                digest = hashlib.sha256()
+                with open(path, 'rb') as source:
+                    for block in iter(lambda: source.read(65536), ''):
+                        digest.update(block)
+                manifest[os.path.relpath(path, local_dir)] = digest.hexdigest()
+        return manifest
+
+    def _remote_manifest(self, remote_dir, use_sudo=False):
+        """Like _local_manifest() for remote_dir on the host, in one call."""
+        signature, manifest = None, None
+        if self.manifest_cache is not None:
+            signature, manifest = self.manifest_cache.get(env.host_string, remote_dir)
+        args = {'path': shell_escape(remote_dir),
+                'separator': self.manifest_separator,
+                'signature': self.tree_signature_cmd % {'path': '.'},
+                'cached': signature or '',
+                'digests': self.digests_cmd % {'nproc': self.nproc_cmd}}
+        with settings(hide('everything'), warn_only=True):
+            content = self.execute(self.manifest_cmd % args, use_sudo, template='manifest_cmd')
+            if content.failed:
+                raise PlatformError(content)
+        lines = content.splitlines()
+        if not lines or not lines[0].startswith(self.manifest_separator):
+            return {}
+        current = lines[0][len(self.manifest_separator):].strip()
+        if current == signature and manifest is not None:
+            return manifest
+        manifest = {}
+        for line in lines[1:]:
+            digest, _, path = line.partition('  ')
+            if path.startswith('./'):
+                manifest[path[2:]] = digest.lstrip('\\')
+        if self.manifest_cache is not None:
+            self.manifest_cache.set(env.host_string, remote_dir, current, manifest)
+        return manifest
+
+    def release(self, local_dir, store_dir, name=None, use_sudo=False, allow_empty=False):
+        """
+        Deploy local_dir as a new release in the release store store_dir
+        and make it current::
+
+            platform.release('build/app', '/srv/app', use_sudo=True)
+            # /srv/app/current -> /srv/app/releases/20240101120000
+
+        Every file is kept once in store_dir/objects, named by its sha256
+        (what digest() says) and mode, and a release directory is a tree of
+        hard links to them. Only the objects the host doesn't have yet are
+        sent, together with the links, in one streamed archive, so a deploy
+        costs what changed. The files of a release are read only, as they
+        are shared with the other releases.
+
+        name defaults to the current UTC time, YYYYmmddHHMMSS, an existing
+        release isn't touched. current is switched with a rename, requests
+        never see it missing. See prune_releases() for cleaning up.
+        Raises PlatformError if local_dir isn't a directory, has no files
+        unless allow_empty, or another release or prune_releases() has the
+        store locked. Returns a releasereport.
+        """
+        name = name or time.strftime('%Y%m%d%H%M%S', time.gmtime())
+        manifest, sources, directories = self._release_manifest(local_dir)
+        if not manifest and not allow_empty:
+            raise PlatformError("No files to release in %s" % local_dir)
+        args = {'path': shell_escape(store_dir), 'name': shell_escape(name),
+                'separator': self.release_separator, 'locked': self.release_locked_status}
+        with settings(hide('everything'), warn_only=True):
+            content = self.pipe(self.release_objects_cmd % args,
+                                ('%s\n' % object_name for object_name in sorted(sources)),
+                                use_sudo, template='release_objects_cmd')
+        if content.failed:
+            if content.return_code == self.release_locked_status:
+                raise PlatformError(self._release_locked(store_dir))
+            raise PlatformError(content.stderr or content)
+
+        locked = True
+        try:
+            missing = content.splitlines()
+            if self.release_separator in missing:
+                raise PlatformError("Release %s already exists in %s" % (name, store_dir))
+            staging = '.staging-%s' % uuid.uuid4().hex
+            archive = self._pack_release(local_dir, name, manifest, sources, directories,
+                                         missing, staging)
+            try:
+                self.stream_untar(archive, store_dir, use_sudo=use_sudo)
+            finally:
+                os.remove(archive)
+
+            release_dir = os.path.join(store_dir, 'releases', name)
+            current = os.path.join(store_dir, 'current')
+            temporary = '.current-%s' % uuid.uuid4().hex
+            with self.batch():
+                if missing:
+                    self._mutate(self.release_commit_cmd % {
+                        'path': shell_escape(store_dir), 'staging': staging},
+                        use_sudo, template='release_commit_cmd')
+                # link() makes the symlink relative to the release's directory
+                self.link(release_dir, os.path.join('..', temporary), use_sudo=use_sudo)
+                self._mutate(self.release_switch_cmd % {
+                    'link': shell_escape(os.path.join(store_dir, temporary)),
+                    'current': shell_escape(current)}, use_sudo, template='release_switch_cmd')
+                self._mutate(self.release_unlock_cmd % {'path': shell_escape(store_dir)},
+                             use_sudo, template='release_unlock_cmd')
+            locked = False
+        finally:
+            if locked:
+                with settings(hide('everything'), warn_only=True):
+                    self.execute(self.release_unlock_cmd % {'path': shell_escape(store_dir)},
+                                 use_sudo, template='release_unlock_cmd')
+        self._forget_paths(current)
+        return releasereport(name, release_dir, len(manifest), sorted(missing))
+
+    def _release_locked(self, store_dir):
+        return ("The release store %s is locked by another release or prune, "
+                "remove %s if that was interrupted"
+                % (store_dir, os.path.join(store_dir, '.lock')))
+
+    def _release_manifest(self, local_dir):
+        """
+        Dict of relative path -> object name of the files under local_dir,
+        one of object name -> a path with that content and mode, and the
+        list of relative directories.
+        """
+        digests = self._local_manifest(local_dir)
+        manifest, sources = {}, {}
+        for path, digest in digests.iteritems():
+            mode = os.stat(os.path.join(local_dir, path)).st_mode & 0555
+            object_name = '%s/%s.%o' % (digest[:2], digest, mode | 0444)
+            manifest[path] = object_name
+            sources.setdefault(object_name, path)
+        directories = []
+        for directory, dirs, files in os.walk(local_dir):
+            directories.extend(os.path.relpath(os.path.join(directory, name), local_dir)
+                               for name in dirs)
+        return manifest, sources, directories
+
+    def _pack_release(self, local_dir, name, manifest, sources, directories, missing, staging):
+        """
+        Write a temporary .tar.gz with the missing objects under staging
+        and the release directory, its files as hard links to the objects.
+        Return its name.
+        """
+        import tarfile
+        fd, archive = tempfile.mkstemp(prefix='fabricplatforms-release-', suffix='.tar.gz')
+        os.close(fd)
+        release = 'releases/%s' % name
+        missing = set(missing)
+        location = lambda object_name: '%s/%s' % (staging if object_name in missing
+                                                   else 'objects', object_name)
+        with tarfile.open(archive, 'w:gz', dereference=True) as packed:
+            for object_name in sorted(missing):
+                local_path = os.path.join(local_dir, sources[object_name])
+                info = packed.gettarinfo(local_path, location(object_name))
+                info.mode = int(object_name.rsplit('.', 1)[1], 8)
+                info.uid = info.gid = 0
+                info.uname = info.gname = 'root'
+                with open(local_path, 'rb') as source:
+                    packed.addfile(info, source)
+            for directory in [''] + sorted(directories):
+                info = tarfile.TarInfo(('%s/%s' % (release, directory)).rstrip('/'))
+                info.type, info.mode, info.mtime = tarfile.DIRTYPE, 0755, time.time()
+                packed.addfile(info)
+            for path, object_name in sorted(manifest.iteritems()):
+                info = tarfile.TarInfo('%s/%s' % (release, path))
+                info.type, info.linkname = tarfile.LNKTYPE, location(object_name)
+                packed.addfile(info)
+        return archive
+
+    def prune_releases(self, store_dir, keep=5, use_sudo=False):
+        """
+        Remove the releases of the store_dir of release() but the keep
+        newest ones (by name) and the current one, then the objects no
+        release links to any more, in one batch. The objects are collected
+        with the store locked, so a release() running at the same time
+        doesn't lose the objects it found there; prune_releases() raises
+        PlatformError if the store is locked. Returns a prunereport.
+        """
+        releases = [os.path.basename(node.path.rstrip('/'))
+                    for node in self.listdir(os.path.join(store_dir, 'releases'),
+                                             use_sudo=use_sudo)
+                    if node.ftype == 'directory']
+        current = self.stat(os.path.join(store_dir, 'current'), link=True, use_sudo=use_sudo)
+        kept = set(releases[-keep:] if keep else [])
+        if current is not None:
+            kept.add(os.path.basename(current.target.rstrip('/')))
+        removed = [release for release in releases if release not in kept]
+        try:
+            with self.batch() as batch:
+                for release in removed:
+                    self.remove(os.path.join(store_dir, 'releases', release), recursive=True,
+                                force=True, use_sudo=use_sudo)
+                self._mutate(self.release_gc_cmd % {
+                    'path': shell_escape(store_dir), 'orphans': self.release_orphans_cmd,
+                    'locked': self.release_locked_status}, use_sudo, template='release_gc_cmd')
+                gc_step = len(batch.steps) - 1
+        except BatchError, e:
+            if e.step != gc_step or e.return_code != self.release_locked_status:
+                raise
+            raise PlatformError(self._release_locked(store_dir))
+        finally:
+            self._forget_paths(store_dir)
+        # inside an outer batch nothing has run yet
+        objects = int(batch.results[gc_step]) if len(batch.results) > gc_step else None
+        return prunereport(removed, objects)
+
+    def _pack(self, local_dir, paths):
+        """Write paths under local_dir to a temporary .tar.gz, return its name."""
+        # imported here, it's a good part of the package's import time
+        import tarfile
+        fd, archive = tempfile.mkstemp(prefix='fabricplatforms-sync-', suffix='.tar.gz')
+        os.close(fd)
+        with tarfile.open(archive, 'w:gz', dereference=True) as packed:
+            for path in paths:
+                packed.add(os.path.join(local_dir, path), path, recursive=False)
+        return archive
     
 
     def _attrs_incorrect(self, obj, new_attrs):
@@ -245,13 +1829,17 @@ class BasePlatform(object):
     # Group methods.
     #
 
-    def groupadd(self, group, gid=None, members=[], use_sudo=True):
-        """Creates the specified system group."""
+    def _groupadd_cmd(self, group, gid=None):
         options = []
         if gid:
             options.append('-g %d' % gid)
-        cmd = self.groupadd_cmd % {'options': ' '.join(options), 'group': group}
-        self.execute(cmd, use_sudo)
+        return self.groupadd_cmd % {'options': ' '.join(options), 'group': group}
+
+    def groupadd(self, group, gid=None, members=[], use_sudo=True):
+        """Creates the specified system group."""
+        cmd = self._groupadd_cmd(group, gid)
+        self.execute(cmd, use_sudo, template='groupadd_cmd')
+        self._forget_accounts(groups=[group])
         for member in members:
             self.usermod(member, groups=[group], use_sudo=use_sudo)
 
@@ -263,29 +1851,54 @@ class BasePlatform(object):
         group = self.groupget(name)
         if not group:
             return
-        self.execute(self.groupdel_cmd % name, use_sudo)
+        self.execute(self.groupdel_cmd % name, use_sudo, template='groupdel_cmd')
+        self._forget_accounts(groups=[name], all_users=True)
 
-    def groupget(self, group, use_sudo=True):
-        """Gets information on the specified system group."""
+    def groupget(self, group, use_sudo=True, snapshot=None):
+        """
+        Gets information on the specified system group.
+
+        If snapshot (from accounts()) is given the group is looked up in it
+        instead of on the host.
+        """
+        if snapshot is not None:
+            found = snapshot.groups.get(group)
+            if found is None:
+                return None
+            return groupstruct(found.name, found.gid, sorted(found.members))
+        return self._cached(('groupget', group), self._groupget, group, use_sudo)
 
+    def _groupget(self, group, use_sudo):
+        found = self._via_agent('groupget', group=group)
+        if found is not NOT_SENT:
+            return groupstruct(*found) if found else None
         with settings(hide('everything'), warn_only=True):
             cmd = self.groupget_cmd % {'group': group}
-            content = self.execute(cmd, use_sudo)
-            if content.failed or not content:
-                return None
+            content = self.execute(cmd, use_sudo, template='groupget_cmd')
+        return self._parse_groupget(content)
+
+    def _parse_groupget(self, content):
+        if content.failed or not content:
+            return None
         name, _, gid, users = content.strip().split(':')
         return groupstruct(name, int(gid), users.split(',') if users else [])
 
-    def groupmod(self, group, gid=None, new_name=None, members=[], use_sudo=True):
-        """Modifies the specified system group."""
+    def _groupmod_cmd(self, group, gid=None, new_name=None):
+        """The groupmod command for the changes, None if there are none."""
         options = []
         if gid:
             options.append('-g %d' % gid)
         if new_name:
             options.append('-n %s' % new_name)
         if options:
-            cmd = self.groupmod_cmd % {'options': ' '.join(options), 'group': group}
-            self.execute(cmd, use_sudo)
+            return self.groupmod_cmd % {'options': ' '.join(options), 'group': group}
+
+    def groupmod(self, group, gid=None, new_name=None, members=[], use_sudo=True):
+        """Modifies the specified system group."""
+        cmd = self._groupmod_cmd(group, gid, new_name)
+        if cmd:
+            self.execute(cmd, use_sudo, template='groupmod_cmd')
+            self._forget_accounts(groups=[group, new_name], all_users=True)
         for member in members:
             self.usermod(member, groups=[group], use_sudo=use_sudo)
 
@@ -326,13 +1939,64 @@ class BasePlatform(object):
             return True
         return False
 
-    def groups(self, use_sudo=False):
+    def ensure_groups(self, specs, use_sudo=True):
+        """
+        Converge many groups at once. specs is a list of dicts with a name
+        and optionally gid and members, as passed to groupsync().
+
+        The group database is read once with accounts() and compared on
+        the client, then every groupadd, groupmod and usermod needed is sent
+        in a single batch script. Members are only added, the same as
+        groupsync() does; names that aren't users on the host are skipped.
+
+        Return a dict of name -> accountchange. If a step fails BatchError
+        is raised with the report of what was done as its changes attribute.
+        """
+        snapshot = self.accounts(use_sudo=use_sudo)
+        report, steps = {}, []
+        for spec in specs:
+            name, gid = spec['name'], spec.get('gid')
+            members = [member for member in spec.get('members') or []
+                       if member in snapshot.users]
+            group = snapshot.groups.get(name)
+            changes = {}
+            if group is None:
+                steps.append((name, self._groupadd_cmd(name, gid), 'groupadd_cmd'))
+                action = 'created'
+                if gid:
+                    changes['gid'] = gid
+            else:
+                action = 'modified'
+                changes = self.group_incorrect(group, name, gid=gid)
+                if changes:
+                    steps.append((name, self._groupmod_cmd(name, **changes), 'groupmod_cmd'))
+                members = [member for member in members if member not in group.members]
+            for member in members:
+                steps.append((name, self._usermod_cmd(member, groups=[name]), 'usermod_cmd'))
+            if members:
+                changes['members'] = sorted(members)
+            report[name] = accountchange(name, action if changes or group is None
+                                         else 'unchanged', changes)
+        self._converge(steps, report, use_sudo)
+        return report
+
+    def groups(self, use_sudo=False, snapshot=None):
         """Return a dict of all groups: groupname -> [group_struct, ...]"""
+        if snapshot is not None:
+            return dict(snapshot.groups)
+
+        found = self._via_agent('groups')
+        if found is not NOT_SENT and found is not None:
+            return dict((name, groupstruct(name, gid, set(members)))
+                        for name, gid, members in found)
+
         with settings(hide('everything'), warn_only=True):
-            content = self.execute(self.groups_cmd, use_sudo)
-            if content.failed:
-                raise PlatformError(content)
+            content = self.execute(self.groups_cmd, use_sudo, template='groups_cmd')
+        return self._parse_groups(content)
 
+    def _parse_groups(self, content):
+        if content.failed:
+            raise PlatformError(content)
         groups = {}
         for line in content.splitlines():
             name, _, gid, member_string = line.strip().split(':')
@@ -363,6 +2027,13 @@ class BasePlatform(object):
         * use_sudo (bool): Use sudo for this command. (True)
         """
 
+        cmd = self._useradd_cmd(name, uid, group, groups, home, shell, comment,
+                                create_home)
+        self.execute(cmd, use_sudo, template='useradd_cmd')
+        self._forget_accounts(users=[name], groups=groups or ())
+
+    def _useradd_cmd(self, name, uid=None, group=None, groups=None, home=None,
+                     shell=None, comment=None, create_home=False):
         options = []
         if create_home:
             options.append('-m')
@@ -378,10 +2049,7 @@ class BasePlatform(object):
             options.append('-s %s' % shell)
         if comment:
             options.append('-c "%s"' % comment)
-        
-        cmd = self.useradd_cmd % {'options': options, 'name': name}
-        
-        self.execute(cmd, use_sudo)
+        return self.useradd_cmd % {'options': ' '.join(options), 'name': name}
 
     def userdel(self, name, use_sudo=True):
         """
@@ -391,18 +2059,41 @@ class BasePlatform(object):
         user = self.userget(name)
         if not user:
             return
-        self.execute(self.userdel_cmd % name, use_sudo)
+        self.execute(self.userdel_cmd % name, use_sudo, template='userdel_cmd')
+        self._forget_accounts(users=[name], all_groups=True)
 
-    def userget(self, name, use_sudo=True):
-        """Gets information on the specified system user."""
+    def userget(self, name, use_sudo=True, snapshot=None):
+        """
+        Gets information on the specified system user.
 
+        If snapshot (from accounts()) is given the user is looked up in it
+        instead of on the host.
+        """
+        if snapshot is not None:
+            return snapshot.users.get(name)
+        return self._cached(('userget', name), self._userget, name, use_sudo)
+
+    def _userget(self, name, use_sudo):
+        found = self._via_agent('userget', name=name)
+        if found is not NOT_SENT:
+            if not found:
+                return None
+            name, uid, gid, group, groups, comment, home, shell = found
+            return userstruct(name, uid, gid, group, set(groups), comment, home, shell)
         with settings(hide('everything'), warn_only=True):
-            content = self.execute(self.userget_cmd % {'name': name}, use_sudo)
+            content = self.execute(self.userget_cmd % {'name': name}, use_sudo,
+                                   template='userget_cmd')
             if content.failed:
                 return None
-        name, _, uid, gid, comment, home, shell = content.strip().split(':')
+        fields = content.strip().split(':')
         with settings(hide('everything')):
-            content = self.execute(self.userget_groups_cmd % {'name': name}, use_sudo)
+            content = self.execute(self.userget_groups_cmd % {'name': fields[0]}, use_sudo,
+                                   template='userget_groups_cmd')
+        return self._parse_userget(fields, content)
+
+    def _parse_userget(self, fields, content):
+        """userstruct from the userget_cmd fields and userget_groups_cmd output."""
+        name, _, uid, gid, comment, home, shell = fields
         content = content.strip().split(' ')
         group, groups = content[ 0 ], set(content[ 1: ])
         return userstruct(name, int(uid), int(gid), group, groups, comment, home, shell)
@@ -428,6 +2119,15 @@ class BasePlatform(object):
         if self.userget(name) is None:
             return
         
+        cmd = self._usermod_cmd(name, uid, group, groups, home, shell, comment,
+                                create_home)
+        if cmd:
+            self.execute(cmd, use_sudo, template='usermod_cmd')
+            self._forget_accounts(users=[name], groups=groups or ())
+
+    def _usermod_cmd(self, name, uid=None, group=None, groups=None, home=None,
+                     shell=None, comment=None, create_home=False):
+        """The usermod command for the changes, None if there are none."""
         options = []
         if create_home:
             options.append('-m')
@@ -444,8 +2144,7 @@ class BasePlatform(object):
         if groups:
             options.append('-aG %s' % ','.join(groups))
         if options:
-            cmd = self.usermod_cmd % {'options': ' '.join(options), 'name': name}
-            self.execute(cmd, use_sudo)
+            return self.usermod_cmd % {'options': ' '.join(options), 'name': name}
 
     def user_incorrect(self, user, name, **new_attrs):
         """Determine which user attributes given are not correct.
@@ -486,33 +2185,222 @@ class BasePlatform(object):
             return True
         return False
 
-    def users(self, min_uid=None, max_uid=None, use_sudo=True):
+    def ensure_users(self, specs, use_sudo=True):
+        """
+        Converge many users at once. specs is a list of dicts with a name
+        and any of the other arguments of usersync()::
+
+            platform.ensure_users([
+                {'name': 'app', 'uid': 500, 'shell': '/bin/bash'},
+                {'name': 'deploy', 'groups': ['app'], 'create_home': True},
+            ])
+
+        The passwd and group databases are read once with accounts() and
+        compared on the client, then every useradd and usermod needed is
+        sent in a single batch script. Groups the users refer to should
+        exist first, see ensure_groups().
+
+        Return a dict of name -> accountchange. If a step fails BatchError
+        is raised with the report of what was done as its changes attribute.
+        """
+        snapshot = self.accounts(use_sudo=use_sudo)
+        report, steps = {}, []
+        for spec in specs:
+            attrs = dict(spec)
+            name = attrs.pop('name')
+            create_home = attrs.pop('create_home', False)
+            user = snapshot.users.get(name)
+            if user is None:
+                cmd = self._useradd_cmd(name, create_home=create_home, **attrs)
+                steps.append((name, cmd, 'useradd_cmd'))
+                changes = dict((attr, value) for attr, value in attrs.iteritems()
+                               if value is not None)
+                report[name] = accountchange(name, 'created', changes)
+                continue
+            changes = self.user_incorrect(user, name, **attrs)
+            if changes:
+                steps.append((name, self._usermod_cmd(name, **changes), 'usermod_cmd'))
+                report[name] = accountchange(name, 'modified', changes)
+            else:
+                report[name] = accountchange(name, 'unchanged')
+        self._converge(steps, report, use_sudo)
+        return report
+
+    def _converge(self, steps, report, use_sudo):
+        """
+        Run the (name, cmd, template) steps of ensure_users() or
+        ensure_groups() as one batch and mark the accounts in report that
+        failed or were skipped when a step fails.
+        """
+        if not steps:
+            return
+        self._forget_accounts(all_users=True, all_groups=True)
+        try:
+            with self.batch() as batch:
+                offset = len(batch.steps)
+                for name, cmd, template in steps:
+                    self._mutate(cmd, use_sudo, template=template)
+        except BatchError, e:
+            failed = e.step - offset
+            for index, (name, cmd, template) in enumerate(steps):
+                if index == failed:
+                    report[name].action = 'failed'
+                    report[name].error = e.output
+                elif index > failed and report[name].action != 'failed':
+                    report[name].action = 'skipped'
+            e.changes = report
+            raise
+
+    def accounts(self, use_sudo=True):
+        """
+        Fetch the passwd and group databases in a single call.
+
+        getent is used when the host has it so that network accounts are
+        included. The snapshot can be passed to users(), groups(), userget()
+        and groupget() to answer lookups without going back to the host.
+        """
+        # the agent reads them with pwd and grp, which needs no sudo
+        found = self._via_agent('accounts')
+        if found is not NOT_SENT and found is not None:
+            return accountsnapshot(found['passwd'], found['group'])
+        with settings(hide('everything'), warn_only=True):
+            content = self.execute(self._accounts_cmd(), use_sudo=use_sudo,
+                                   template='accounts_cmd')
+        return self._parse_accounts(content)
+
+    def _accounts_cmd(self):
+        return self.accounts_cmd % {'users': self.users_cmd, 'groups': self.groups_cmd,
+                                    'separator': accountsnapshot.separator}
+
+    def _parse_accounts(self, content):
+        if content.failed:
+            raise PlatformError(content)
+        passwd, _, group = content.partition(accountsnapshot.separator)
+        return accountsnapshot(passwd.splitlines(), group.splitlines())
+
+    def users(self, min_uid=None, max_uid=None, use_sudo=True, snapshot=None):
         """
         Return a dict of all users::
         
             {'user1':  userstruct(user1), 'user2':  userstruct(user2)}
         
+        The passwd and group databases are fetched in one call with
+        accounts(), unless a snapshot is passed in.
         """
-        with settings(hide('everything'), warn_only=True):
-            content = self.execute(self.users_cmd, use_sudo=use_sudo)
-            if content.failed:
-                raise PlatformError(content)
+        if snapshot is None:
+            snapshot = self.accounts(use_sudo=use_sudo)
 
         users = {}
-        for line in content.splitlines():
-            name, _, uid, gid, comment, home, shell = line.strip().split(':')
-            uid = int(uid)
+        for name, user in snapshot.users.iteritems():
             # Skip over users outside specified min/max uid.
-            if min_uid is not None and uid < min_uid:
+            if min_uid is not None and user.uid < min_uid:
                 continue
-            if max_uid is not None and uid > max_uid:
+            if max_uid is not None and user.uid > max_uid:
                 continue
-            with settings(hide('everything'), warn_only=True):
-                content = self.execute(self.userget_groups_cmd % name, use_sudo=use_sudo)
-                if content.failed:
-                    raise PlatformError(content)
-            content = content.strip().split(' ')
-            group, groups = content[0], set(content[1:])
-            user = userstruct(name, uid, int(gid), group, groups, comment, home, shell)
             users[name] = user
         return users
+
+    #
+    # Async methods, see eventloop.py.
+    #
+
+    def _arun(self, cmd, use_sudo=False, template=None, host=None):
+        """Future of the commandresult of cmd on host, run by async_executor."""
+        host = host or env.host_string
+        executor = self.async_executor or shared_executor()
+        future = executor.run(host, cmd, use_sudo)
+        if hooks:
+            method, started = self._caller(), time.time()
+            def record(future):
+                result = future.result() if future.exception() is None else None
+                record = callrecord(host, method, template, cmd, use_sudo,
+                                    time.time() - started, getattr(result, 'return_code', None),
+                                    len(result) if result is not None else None)
+                for hook in list(hooks):
+                    hook(record)
+            future.add_done_callback(record)
+        return future
+
+    def astat(self, path, link=False, use_sudo=False, host=None):
+        """
+        stat() that returns an eventloop.Future instead of waiting for the
+        host, so lookups on many hosts can all be in flight at once::
+
+            futures = [platform.astat('/srv/app', host=host) for host in hosts]
+            nodes = gather(futures).result(timeout=60)
+
+        host is a host string, env.host_string by default. The a*() methods
+        always run commands with async_executor, without the read cache or
+        the agent, and return the same structs as the methods they mirror.
+        """
+        return self.astat_many([path], link, use_sudo, host).then(lambda nodes: nodes[path])
+
+    def astat_many(self, paths, link=False, use_sudo=False, host=None):
+        """stat_many() returning a Future, see astat()."""
+        futures = [self._arun(cmd, use_sudo, 'stat_many_cmd', host).then(
+                       lambda content, chunk=chunk: self._stat_chunk(chunk, content))
+                   for chunk, cmd in self._stat_many_cmds(paths, link)]
+
+        def merge(results):
+            nodes = {}
+            for result in results:
+                nodes.update(result)
+            return nodes
+        return gather(futures).then(merge)
+
+    def ahostname(self, use_sudo=False, host=None):
+        return self._arun(self.hostname_cmd, use_sudo, 'hostname_cmd', host).then(
+            self._parse_hostname)
+
+    def adigest(self, path, use_sudo=False, host=None):
+        return self._arun(self.digest_cmd % shell_escape(path), use_sudo, 'digest_cmd',
+                          host).then(self._parse_digest)
+
+    def aaccounts(self, use_sudo=True, host=None):
+        return self._arun(self._accounts_cmd(), use_sudo, 'accounts_cmd', host).then(
+            self._parse_accounts)
+
+    def ausers(self, min_uid=None, max_uid=None, use_sudo=True, host=None):
+        """users() returning a Future, see astat()."""
+        return self.aaccounts(use_sudo, host).then(
+            lambda snapshot: self.users(min_uid, max_uid, snapshot=snapshot))
+
+    def aapache(self, subcommand, use_sudo=False, host=None):
+        """apache() returning a Future of the commandresult, which may have failed."""
+        return self._arun(self.apache_cmd % {'subcommand': subcommand}, use_sudo,
+                          'apache_cmd', host)
+
+    def anginx(self, subcommand, use_sudo=False, host=None):
+        return self._arun(self.nginx_cmd % {'subcommand': subcommand}, use_sudo,
+                          'nginx_cmd', host)
+
+    def afacts(self, use_sudo=False, refresh=False, host=None):
+        """facts() returning a Future, which shares the facts kept per host."""
+        host = host or env.host_string
+        facts = self._fresh_facts(host)
+        if facts is not None and not refresh:
+            future = Future()
+            future.set_result(facts)
+            return future
+        return self._arun(self._facts_cmd(), use_sudo, 'facts_cmd', host).then(
+            lambda content: self._remember_facts(host, self._parse_facts(content)))
+
+    def agroups(self, use_sudo=False, host=None):
+        return self._arun(self.groups_cmd, use_sudo, 'groups_cmd', host).then(
+            self._parse_groups)
+
+    def agroupget(self, group, use_sudo=True, host=None):
+        return self._arun(self.groupget_cmd % {'group': group}, use_sudo, 'groupget_cmd',
+                          host).then(self._parse_groupget)
+
+    def auserget(self, name, use_sudo=True, host=None):
+        """userget() returning a Future, see astat()."""
+        def _groups(content):
+            if content.failed:
+                return None
+            fields = content.strip().split(':')
+            cmd = self.userget_groups_cmd % {'name': fields[0]}
+            return self._arun(cmd, use_sudo, 'userget_groups_cmd', host).then(
+                lambda groups: self._parse_userget(fields, groups))
+        return self._arun(self.userget_cmd % {'name': name}, use_sudo, 'userget_cmd',
+                          host).then(_groups)
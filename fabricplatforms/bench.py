@@ -0,0 +1,231 @@
+import json
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+from fabric.api import settings, hide
+
+import base
+from linux import Linux
+from executors import LocalExecutor
+from cache import ManifestCache
+from metrics import Metrics
+
+def sandbox_platform(root, platform_class=Linux, executor=None):
+    """
+    Return a platform that runs its commands locally in root, with the
+    passwd and group databases read from root and the account changes
+    only written to root/accounts.log. Nothing outside root is touched.
+    """
+    passwd, group = os.path.join(root, 'passwd'), os.path.join(root, 'group')
+    log = os.path.join(root, 'accounts.log')
+
+    class Sandbox(platform_class):
+        users_cmd = '/bin/cat %s' % passwd
+        groups_cmd = '/bin/cat %s' % group
+        accounts_cmd = '%(users)s; echo %(separator)s; %(groups)s'
+        userget_cmd = '/bin/grep ^%%(name)s: %s' % passwd
+        groupget_cmd = '/bin/grep ^%%(group)s: %s' % group
+        userget_groups_cmd = ("/usr/bin/awk -F: -v user=%%(name)s "
+                              "'{n = split($4, m, \",\"); for (i = 1; i <= n; i++) "
+                              "if (m[i] == user) printf \"%%%%s \", $1} END {print \"\"}' %s"
+                              % group)
+        useradd_cmd = '/bin/echo useradd %%(options)s %%(name)s >> %s' % log
+        usermod_cmd = '/bin/echo usermod %%(options)s %%(name)s >> %s' % log
+        userdel_cmd = '/bin/echo userdel %%s >> %s' % log
+        groupadd_cmd = '/bin/echo groupadd %%(options)s %%(group)s >> %s' % log
+        groupmod_cmd = '/bin/echo groupmod %%(options)s %%(group)s >> %s' % log
+        groupdel_cmd = '/bin/echo groupdel %%s >> %s' % log
+        manifest_cache = ManifestCache(os.path.join(root, 'manifests'))
+
+    platform = Sandbox()
+    platform.executor = executor or LocalExecutor(cwd=root)
+    return platform
+
+def populate(root, size):
+    """Fill root with account databases, a file tree and a tarball."""
+    with open(os.path.join(root, 'passwd'), 'w') as passwd:
+        for uid in range(1000, 1000 + size * 10):
+            passwd.write('user%d:x:%d:%d:User %d:/home/user%d:/bin/sh\n'
+                         % (uid, uid, 1000 + uid % 50, uid, uid))
+    with open(os.path.join(root, 'group'), 'w') as group:
+        for gid in range(1000, 1050):
+            members = ','.join('user%d' % uid for uid in range(1000 + gid % 7, 1000 + size * 10, 37))
+            group.write('group%d:x:%d:%s\n' % (gid, gid, members))
+    tree = os.path.join(root, 'tree')
+    files = []
+    for directory in range(max(size / 10, 1)):
+        path = os.path.join(tree, 'dir%d' % directory)
+        os.makedirs(path)
+        for number in range(10):
+            files.append(os.path.join(path, 'file%d.py' % number))
+            with open(files[-1], 'w') as source:
+                source.write('x = %d\n' % number)
+    tarball = os.path.join(root, 'tree.tar.gz')
+    with tarfile.open(tarball, 'w:gz') as archive:
+        archive.add(tree, 'tree')
+    return files, tree, tarball
+
+def scenarios(platform, root, size):
+    """List of (name, callable) pairs, one per benchmarked operation."""
+    files, tree, tarball = populate(root, size)
+    existing = ['user%d' % uid for uid in range(1000, 1000 + size / 2)]
+    missing = ['new%d' % number for number in range(size / 2)]
+    untar_to = os.path.join(root, 'untar')
+    os.makedirs(untar_to)
+    stream_to = os.path.join(root, 'stream_untar')
+    os.makedirs(stream_to)
+    return [
+        ('stat', lambda: [platform.stat(path) for path in files]),
+        ('stat_many', lambda: platform.stat_many(files)),
+        ('users', lambda: platform.users()),
+        ('groups', lambda: platform.groups()),
+        ('facts', lambda: platform.facts(refresh=True)),
+        ('usersync', lambda: [platform.usersync(name, shell='/bin/bash')
+                              for name in existing + missing]),
+        ('groupsync', lambda: [platform.groupsync('group%d' % gid, gid, members=existing[:5])
+                               for gid in range(1000, 1000 + size / 10)]),
+        ('ensure_users', lambda: platform.ensure_users(
+            [{'name': name, 'shell': '/bin/bash'} for name in existing + missing])),
+        ('ensure_groups', lambda: platform.ensure_groups(
+            [{'name': 'group%d' % gid, 'gid': gid, 'members': existing[:5]}
+             for gid in range(1000, 1000 + size / 10)])),
+        ('untar', lambda: platform.untar(tarball, untar_to)),
+        ('stream_untar', lambda: platform.stream_untar(tarball, stream_to)),
+        ('byte_compile', lambda: platform.byte_compile(sys.executable, tree, workers=4)),
+        ('sync', lambda: platform.sync(tree, os.path.join(root, 'synced'))),
+        ('walk', lambda: platform.walk(tree)),
+        ('listing', lambda: platform.listing(tree)),
+    ]
+
+def run_benchmarks(size=100, rtts=(0.001, 0.05, 0.15), names=None, platform_class=Linux):
+    """
+    Run every scenario against a fresh sandbox and return a dict of
+    name -> round trips, bytes, local time and simulated wall time per
+    round trip time (local time plus one rtt per round trip).
+    """
+    results = {}
+    root = tempfile.mkdtemp(prefix='fabricplatforms-bench-')
+    try:
+        platform = sandbox_platform(root, platform_class)
+        for name, operation in scenarios(platform, root, size):
+            if names and name not in names:
+                continue
+            metrics = Metrics()
+            base.add_hook(metrics)
+            try:
+                with settings(hide('everything'), host_string='sandbox'):
+                    started = time.time()
+                    operation()
+                    elapsed = time.time() - started
+            finally:
+                base.remove_hook(metrics)
+            total = metrics.report()['total']
+            results[name] = {
+                'round_trips': total['round_trips'],
+                'bytes': total['bytes'],
+                'local_time': elapsed,
+                'simulated': dict(('%g' % rtt, elapsed + total['round_trips'] * rtt)
+                                  for rtt in rtts),
+            }
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+# run in a fresh interpreter by startup(): the time import fabricplatforms
+# takes on top of fabric, which fab has loaded anyway, and the modules it
+# pulls in
+startup_script = """
+import json, sys, time
+import fabric.api
+before = set(sys.modules)
+started = time.time()
+import fabricplatforms
+elapsed = time.time() - started
+print(json.dumps({'seconds': elapsed, 'modules': sorted(
+    name for name in set(sys.modules) - before if sys.modules[name] is not None)}))
+"""
+
+def startup(repeat=5):
+    """
+    Import the package in repeat new interpreters, return the fastest
+    import time, the wall time of the fastest interpreter run and the
+    modules the import loaded.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([root] + [path for path in [env.get('PYTHONPATH')]
+                                                  if path])
+    result = {'seconds': None, 'total_seconds': None}
+    for _ in range(repeat):
+        started = time.time()
+        output = subprocess.Popen([sys.executable, '-W', 'ignore', '-c', startup_script],
+                                  stdout=subprocess.PIPE, cwd=root, env=env).communicate()[0]
+        total = time.time() - started
+        run = json.loads(output.strip().splitlines()[-1])
+        result['seconds'] = min(run['seconds'], result['seconds'] or run['seconds'])
+        result['total_seconds'] = min(total, result['total_seconds'] or total)
+        result['modules'] = run['modules']
+    return result
+
+def regressions(results, baseline):
+    """
+    Names of the scenarios that need more round trips than in baseline,
+    and 'startup' if the import loads modules it didn't or takes more
+    than twice as long.
+    """
+    worse = sorted(name for name, result in results.iteritems()
+                   if name in baseline and 'round_trips' in result
+                   and result['round_trips'] > baseline[name]['round_trips'])
+    if 'startup' in results and 'startup' in baseline:
+        result, before = results['startup'], baseline['startup']
+        if set(result['modules']) - set(before['modules']) \
+                or result['seconds'] > 2 * before['seconds']:
+            worse.append('startup')
+    return worse
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='python -m fabricplatforms.bench [options] [scenario ...]')
+    parser.add_option('--size', type='int', default=100,
+                      help='number of files, users, ... to work on')
+    parser.add_option('--rtt', action='append', type='float',
+                      help='round trip time in seconds to simulate, repeatable')
+    parser.add_option('--json', help='write the results to this file')
+    parser.add_option('--baseline', help='fail if round trips went up compared to this file')
+    parser.add_option('--startup', action='store_true',
+                      help='also time importing the package in a new interpreter')
+    options, names = parser.parse_args(argv)
+    rtts = options.rtt or (0.001, 0.05, 0.15)
+    results = run_benchmarks(options.size, rtts, names)
+    startup_result = startup() if options.startup else None
+
+    print '%-13s %8s %10s %8s  %s' % ('scenario', 'trips', 'bytes', 'local',
+                                     '  '.join('rtt=%gs' % rtt for rtt in rtts))
+    for name in sorted(results):
+        result = results[name]
+        print '%-13s %8d %10d %7.2fs  %s' % (name, result['round_trips'], result['bytes'],
+            result['local_time'],
+            '  '.join('%7.2fs' % result['simulated']['%g' % rtt] for rtt in rtts))
+    if startup_result is not None:
+        results['startup'] = startup_result
+        print '\nimport fabricplatforms: %.1fms after fabric, %.0fms in all, %d modules' % (
+            startup_result['seconds'] * 1000, startup_result['total_seconds'] * 1000,
+            len(startup_result['modules']))
+    if options.json:
+        with open(options.json, 'w') as results_file:
+            json.dump(results, results_file, indent=1, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            worse = regressions(results, json.load(baseline_file))
+        if worse:
+            print 'Worse than the baseline: %s' % ', '.join(worse)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+def write_json(path, data):
+    """Atomically replace path with data as JSON, creating its directory."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, temp_path = tempfile.mkstemp(dir=directory or '.', prefix='.tmp')
+    with os.fdopen(fd, 'w') as json_file:
+        json.dump(data, json_file, indent=1, sort_keys=True)
+    os.rename(temp_path, path)
+
+class HostCache(object):
+    """
+    On disk record of which platform each host runs, so that uname only
+    has to be run again once an entry is older than ttl seconds.
+
+    The file lives at $FABRICPLATFORMS_CACHE or ~/.fabricplatforms/hosts.json
+    and is rewritten atomically, merging in entries written by other fab
+    processes in the meantime.
+    """
+
+    default_path = os.path.join('~', '.fabricplatforms', 'hosts.json')
+
+    def __init__(self, path=None, ttl=86400):
+        path = path or os.environ.get('FABRICPLATFORMS_CACHE') or self.default_path
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self._entries = None
+        self._changed = {}
+        self._removed = set()
+
+    def _read(self):
+        try:
+            with open(self.path) as cache_file:
+                entries = json.load(cache_file)
+        except (IOError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = self._read()
+        return self._entries
+
+    def get(self, host):
+        """Return the cached platform name for host, None if unknown or stale."""
+        entry = self.entries.get(host)
+        if not entry or time.time() - entry.get('time', 0) > self.ttl:
+            return None
+        return entry.get('platform')
+
+    def set(self, host, platform_name):
+        self.update({host: platform_name})
+
+    def update(self, platforms):
+        """Record several host -> platform name pairs with a single write."""
+        now = time.time()
+        for host, platform_name in platforms.iteritems():
+            entry = {'platform': platform_name, 'time': now}
+            self.entries[host] = self._changed[host] = entry
+            self._removed.discard(host)
+        self.save()
+
+    def invalidate(self, host=None):
+        """Forget host, or every host if none is given."""
+        hosts = [host] if host is not None else self.entries.keys() + self._read().keys()
+        for host in hosts:
+            self.entries.pop(host, None)
+            self._changed.pop(host, None)
+            self._removed.add(host)
+        self.save()
+
+    def save(self):
+        entries = self._read()
+        entries.update(self._changed)
+        for host in self._removed:
+            entries.pop(host, None)
+        try:
+            write_json(self.path, entries)
+        except (IOError, OSError), e:
+            logging.warning("Could not write platform cache %s: %s", self.path, e)
+            return
+        self._entries = entries
+
+class ManifestCache(object):
+    """
+    On disk copy of the manifests sync() fetched, one file per host and
+    remote directory under $FABRICPLATFORMS_MANIFESTS or
+    ~/.fabricplatforms/manifests. A manifest is stored with the signature
+    of the sizes and mtimes of the tree it was made from and is only used
+    while the tree still has that signature.
+    """
+
+    default_path = os.path.join('~', '.fabricplatforms', 'manifests')
+
+    def __init__(self, path=None):
+        path = path or os.environ.get('FABRICPLATFORMS_MANIFESTS') or self.default_path
+        self.path = os.path.expanduser(path)
+
+    def _file(self, host, directory):
+        key = hashlib.sha1('%s:%s' % (host, directory.rstrip('/') or '/')).hexdigest()
+        return os.path.join(self.path, key + '.json')
+
+    def get(self, host, directory):
+        """Return (signature, manifest) for directory, (None, None) if unknown."""
+        try:
+            with open(self._file(host, directory)) as cache_file:
+                entry = json.load(cache_file)
+            manifest = dict((path.encode('utf-8'), digest.encode('utf-8'))
+                            for path, digest in entry['manifest'].iteritems())
+            return entry['signature'].encode('utf-8'), manifest
+        except (IOError, ValueError, KeyError, TypeError, AttributeError):
+            return None, None
+
+    def set(self, host, directory, signature, manifest):
+        try:
+            write_json(self._file(host, directory),
+                       {'signature': signature, 'manifest': manifest})
+        except (IOError, OSError), e:
+            logging.warning("Could not write manifest cache %s: %s", self.path, e)
+
+    def invalidate(self, host, directory):
+        try:
+            os.remove(self._file(host, directory))
+        except OSError:
+            pass
@@ -1,51 +1,335 @@
 import os
+from array import array
 
-class dirnode(object):
-    """Directory helper object for storing results from stat and find commands."""
+def _intern(value):
+    """Share a single copy of often repeated strings like user names."""
+    if type(value) is str:
+        return intern(value)
+    return value
 
-    def __init__(self, path, mode = None, user = None, group = None, size = None,
-        atime = None, mtime = None, ctime = None):
-        """Constructor."""
+class basenode(object):
+    """
+    Attributes shared by directory and file nodes.
+
+    Nodes use __slots__ and only keep their own name when they have a
+    parent, the path, name and container are worked out from the parent
+    chain when asked for. This keeps large trees small in memory.
+    """
+
+    __slots__ = ('parent', '_name', 'mode', 'user', 'group', 'size',
+                 'atime', 'mtime', 'ctime')
 
+    def __init__(self, path, mode, user, group, size, atime, mtime, ctime, parent):
+        self.parent = parent
+        self._name = os.path.basename(path) if parent is not None else path
+        self.mode = _intern(mode)
+        self.user = _intern(user)
+        self.group = _intern(group)
+        self.size = size
         self.atime = atime
-        self.container = '%s/' % os.path.dirname(path.rstrip('/'))
-        self.ctime = ctime
-        self.dirs = {}
-        self.files = {}
-        self.group = group
-        self.mode = mode
         self.mtime = mtime
-        self.name = '%s/' % os.path.basename(path.rstrip('/'))
-        self.path = '%s/' % path.rstrip('/')
-        self.size = size
-        self.ftype = 'directory'
-        self.user = user
+        self.ctime = ctime
+
+    def _fullpath(self):
+        """The path of the node without a trailing slash."""
+        if self.parent is None:
+            return self._name
+        return self.parent.path + self._name
+
+class _lazychildren(object):
+    """How a dirnode loads its children, and the pages loaded so far."""
+
+    __slots__ = ('loader', 'pages', 'complete')
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.pages = {}
+        self.complete = False
+
+    def covers(self, name):
+        """True if a page already has every child whose name could be name."""
+        return any(name.startswith(prefix) for prefix, limit, offset in self.pages
+                   if prefix and limit is None and not offset)
+
+class dirnode(basenode):
+    """
+    Directory helper object for storing results from stat and find commands.
+
+    A dirnode with a loader (see set_loader()) fetches its children from
+    the host when they are first used, instead of having them filled in.
+    """
+
+    __slots__ = ('_dirs', '_files', '_lazy')
+
+    ftype = 'directory'
+    # so code handling both kinds of nodes doesn't look for children
+    digest = target = None
+
+    def __init__(self, path, mode = None, user = None, group = None, size = None,
+        atime = None, mtime = None, ctime = None, parent = None):
+        """Constructor."""
+        basenode.__init__(self, path.rstrip('/'), mode, user, group, size,
+                          atime, mtime, ctime, parent)
+        self._dirs = None
+        self._files = None
+        self._lazy = None
+
+    def __getstate__(self):
+        # the loader can't be pickled, an unpickled node keeps what it loaded
+        slots = dict((name, getattr(self, name))
+                     for name in basenode.__slots__ + dirnode.__slots__)
+        slots['_lazy'] = None
+        return None, slots
+
+    @property
+    def path(self):
+        return '%s/' % self._fullpath()
+
+    @property
+    def name(self):
+        return '%s/' % os.path.basename(self._fullpath())
+
+    @property
+    def container(self):
+        return '%s/' % os.path.dirname(self._fullpath())
+
+    @property
+    def dirs(self):
+        self._load_all()
+        if self._dirs is None:
+            self._dirs = {}
+        return self._dirs
+
+    @dirs.setter
+    def dirs(self, value):
+        self._dirs = value
+
+    @property
+    def files(self):
+        self._load_all()
+        if self._files is None:
+            self._files = {}
+        return self._files
+
+    @files.setter
+    def files(self, value):
+        self._files = value
+
+    def add(self, node):
+        """Attach node as a child of this directory and return it."""
+        name = os.path.basename(node._fullpath())
+        node.parent, node._name = self, name
+        if isinstance(node, dirnode):
+            if self._dirs is None:
+                self._dirs = {}
+            self._dirs[name] = node
+        else:
+            if self._files is None:
+                self._files = {}
+            self._files[name] = node
+        return node
+
+    def set_loader(self, loader):
+        """
+        Load the children from the host on first use with loader(prefix,
+        limit, offset), which returns their nodes sorted by name, like
+        BasePlatform.listdir() does.
+        """
+        self._lazy = _lazychildren(loader)
+
+    def load(self, prefix=None, limit=None, offset=0):
+        """
+        Return the children whose names start with prefix, sorted by name,
+        limit of them from offset on. Each page is fetched from the host
+        once and the nodes are added to dirs and files. Without arguments
+        everything is loaded, after which dirs and files are complete.
+        """
+        lazy = self._lazy
+        if lazy is None or lazy.complete:
+            children = sorted((self._dirs or {}).items() + (self._files or {}).items())
+            children = [node for name, node in children
+                        if not prefix or name.startswith(prefix)]
+            return children[offset:offset + limit if limit is not None else None]
+        key = (prefix, limit, offset)
+        if key not in lazy.pages:
+            lazy.pages[key] = [self.add(node) for node in lazy.loader(prefix, limit, offset)]
+            if not prefix and limit is None and not offset:
+                lazy.complete = True
+        return lazy.pages[key]
+
+    def _load_all(self):
+        if self._lazy is not None and not self._lazy.complete:
+            self.load()
+
+    def refresh(self):
+        """Forget the loaded children, they are fetched again on next use."""
+        if self._lazy is not None:
+            self._lazy = _lazychildren(self._lazy.loader)
+            self._dirs = self._files = None
 
     def __getattr__(self, name):
         """Acquires the specified attribute."""
+        # guard against lookups made before the slots are filled in,
+        # e.g. by pickle or copy.
+        if name.startswith('__') or name in dirnode.__slots__:
+            raise AttributeError(name)
+        lazy = self._lazy
+        if (lazy is not None and not lazy.complete and '/' not in name
+                and not name.startswith('_') and not lazy.covers(name)):
+            # only fetch the entries that could be it, once
+            self.load(prefix=name)
         try:
-            return self.files[ name ]
+            return (self._files or {})[ name ]
         except KeyError:
             try:
-                return self.dirs[ name ]
+                return (self._dirs or {})[ name ]
             except KeyError:
                 raise AttributeError("'dirnode' object has no attribute '%s'" % name)
 
-class filenode(object):
+class filenode(basenode):
     """File helper object for storing results from stat and find commands."""
 
-    def __init__(self, path, mode=None, user=None, group=None, size=None, 
-                 atime=None, mtime=None, ctime=None, **parameters):
-        self.atime = atime
-        self.ctime = ctime
-        self.container = '%s/' % os.path.dirname(path)
+    __slots__ = ('digest', 'target', 'ftype')
+
+    def __init__(self, path, mode=None, user=None, group=None, size=None,
+                 atime=None, mtime=None, ctime=None, parent=None, **parameters):
+        basenode.__init__(self, path, mode, user, group, size, atime, mtime,
+                          ctime, parent)
         self.digest = parameters.get('digest', None)
-        self.group = group
-        self.mode = mode
-        self.mtime = mtime
-        self.name = os.path.basename(path)
-        self.path = path
-        self.size = size
         self.target = parameters.get('target', None)
-        self.ftype = parameters.get('ftype', 'file')
-        self.user = user
\ No newline at end of file
+        self.ftype = _intern(parameters.get('ftype', 'file'))
+
+    @property
+    def path(self):
+        return self._fullpath()
+
+    @property
+    def name(self):
+        return os.path.basename(self._fullpath())
+
+    @property
+    def container(self):
+        return '%s/' % os.path.dirname(self._fullpath())
+
+class nodestore(object):
+    """
+    Columnar storage for bulk listings.
+
+    Keeps one row per node in parallel arrays (names, parents, mode, size,
+    times, ...) instead of one object per node. User, group and type names
+    are stored once and referenced by number. dirnode and filenode objects
+    are built on demand when indexing or iterating. Rows are indexed by
+    parent and name as they are added, so index() and children() don't
+    scan the whole listing.
+    """
+
+    def __init__(self, nodes=()):
+        self.names = []
+        self.parents = array('l')
+        self.ftypes = array('H')
+        self.modes = array('i')
+        self.users = array('H')
+        self.groups = array('H')
+        self.sizes = array('l')
+        self.atimes = array('l')
+        self.mtimes = array('l')
+        self.ctimes = array('l')
+        self.targets = {}
+        self.digests = {}
+        self._values = []
+        self._value_index = {}
+        self._dirs = {}
+        self._rows = {}
+        self._children = {}
+        self.extend(nodes)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        for row in xrange(len(self.names)):
+            yield self.node(row)
+
+    def __getitem__(self, row):
+        if row < 0 or row >= len(self.names):
+            raise IndexError(row)
+        return self.node(row)
+
+    def _value(self, value):
+        """Number for a user, group or type name, stored once."""
+        try:
+            return self._value_index[value]
+        except KeyError:
+            self._value_index[value] = len(self._values)
+            self._values.append(value)
+            return self._value_index[value]
+
+    def append(self, node):
+        """Add a row for node. Parents have to be added before children."""
+        path = node.path.rstrip('/') or '/'
+        parent = self._dirs.get(os.path.dirname(path), -1)
+        row = len(self.names)
+        name = os.path.basename(path) if parent != -1 else path
+        self.names.append(name)
+        self.parents.append(parent)
+        self._rows.setdefault((parent, name), row)
+        self._children.setdefault(parent, array('l')).append(row)
+        self.ftypes.append(self._value(node.ftype))
+        self.modes.append(int(node.mode, 8) if node.mode is not None else -1)
+        self.users.append(self._value(node.user))
+        self.groups.append(self._value(node.group))
+        for column, value in ((self.sizes, node.size), (self.atimes, node.atime),
+                              (self.mtimes, node.mtime), (self.ctimes, node.ctime)):
+            column.append(value if value is not None else -1)
+        if node.ftype == 'directory':
+            self._dirs[path] = row
+        else:
+            if node.target is not None:
+                self.targets[row] = node.target
+            if node.digest is not None:
+                self.digests[row] = node.digest
+        return row
+
+    def extend(self, nodes):
+        for node in nodes:
+            self.append(node)
+
+    def path(self, row):
+        """The path of a row, without a trailing slash for directories."""
+        parts = []
+        while row != -1:
+            parts.append(self.names[row])
+            row = self.parents[row]
+        if len(parts) == 1:
+            return parts[0]
+        parts[-1] = parts[-1].rstrip('/')
+        return '/'.join(reversed(parts))
+
+    def index(self, path):
+        """Row number of path, raises KeyError if it isn't stored."""
+        path = path.rstrip('/') or '/'
+        if path in self._dirs:
+            return self._dirs[path]
+        parent = self._dirs.get(os.path.dirname(path), -1)
+        name = os.path.basename(path) if parent != -1 else path
+        try:
+            return self._rows[(parent, name)]
+        except KeyError:
+            raise KeyError(path)
+
+    def children(self, row):
+        """Row numbers of the entries directly below row."""
+        return list(self._children.get(row, ()))
+
+    def node(self, row):
+        """Build a dirnode or filenode for row."""
+        mode = self.modes[row]
+        values = [ value if value != -1 else None for value in
+                   (self.sizes[row], self.atimes[row], self.mtimes[row], self.ctimes[row]) ]
+        ftype = self._values[self.ftypes[row]]
+        args = [self.path(row), '%o' % mode if mode != -1 else None,
+                self._values[self.users[row]], self._values[self.groups[row]]] + values
+        if ftype == 'directory':
+            return dirnode(*args)
+        return filenode(*args, ftype=ftype, target=self.targets.get(row),
+                        digest=self.digests.get(row))
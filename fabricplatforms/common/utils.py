@@ -1,4 +1,5 @@
-
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 
 
 def shell_escape(text):
@@ -17,3 +18,125 @@ def shell_escape(text):
     text = text.replace("`", "\\`")
     text = text.replace('"', '\\"')
     return '"%s"' % text
+
+
+class linestream(object):
+    """
+    File-like object that passes every complete line written to it to
+    callback. Used as the stdout of commands whose output is parsed as it
+    arrives instead of after the command finishes.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.buffer = ''
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            self.callback(line.rstrip('\r'))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buffer:
+            self.callback(self.buffer.rstrip('\r'))
+            self.buffer = ''
+
+
+class lrucache(object):
+    """
+    Mapping that holds at most size entries, dropping the least recently
+    used one when it grows past that.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, key):
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.entries.pop(key, default)
+
+    def discard(self, test):
+        """Drop every entry whose key test() is true for."""
+        for key in [key for key in self.entries if test(key)]:
+            del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+
+
+class idranges(object):
+    """
+    Set of integer ids kept as sorted lists of the first and last id of
+    runs of consecutive ids. Runs are merged as ids are added, so the id
+    after a run is always free and lookups are a bisect away.
+    """
+
+    def __init__(self, ids=()):
+        self.starts = []
+        self.ends = []
+        for id in sorted(set(ids)):
+            if self.ends and id == self.ends[-1] + 1:
+                self.ends[-1] = id
+            else:
+                self.starts.append(id)
+                self.ends.append(id)
+
+    def __contains__(self, id):
+        index = bisect_right(self.starts, id) - 1
+        return index >= 0 and self.ends[index] >= id
+
+    def __len__(self):
+        return sum(end - start + 1 for start, end in zip(self.starts, self.ends))
+
+    def __iter__(self):
+        for start, end in zip(self.starts, self.ends):
+            for id in xrange(start, end + 1):
+                yield id
+
+    def add(self, start, end=None):
+        """Add the ids from start to end (start alone by default)."""
+        end = start if end is None else end
+        # the runs that overlap or touch start..end become one
+        first = bisect_left(self.ends, start - 1)
+        last = bisect_right(self.starts, end + 1)
+        if first < last:
+            start = min(start, self.starts[first])
+            end = max(end, self.ends[last - 1])
+        self.starts[first:last] = [start]
+        self.ends[first:last] = [end]
+
+    def update(self, other):
+        """Add the ids of the idranges other."""
+        for start, end in zip(other.starts, other.ends):
+            self.add(start, end)
+
+    def lowest_free(self, low, high):
+        """The lowest id from low to high that isn't in the set, or None."""
+        index = bisect_right(self.starts, low) - 1
+        if index >= 0 and self.ends[index] >= low:
+            low = self.ends[index] + 1
+        return low if low <= high else None
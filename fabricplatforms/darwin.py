@@ -4,4 +4,37 @@ class Darwin(BasePlatform):
 	
 	name = 'darwin'
 	
+	# bsd stat, %HT gives the same file type names as gnu %F
+	stat_cmd = '/usr/bin/stat -f %%HT:%%Lp:%%Su:%%Sg:%%z,%%a,%%m,%%c %s'
+	# bsd find has no -printf, hand the files to stat instead
+	find_cmd = ("/usr/bin/find %(file)s %(options)s -exec /usr/bin/stat "
+	            "-f '%%HT:%%Lp:%%Su:%%Sg:%%z,%%a,%%m,%%c:%%N%%t%%Y' {} +")
+	chgrp_changed_cmd = ('%(find)s %(path)s %(depth)s ! -group %(gid)s '
+	                     '-exec /usr/bin/chgrp -h %(gid)s {} + -print | /usr/bin/wc -l')
+	chown_changed_cmd = ('%(find)s %(path)s %(depth)s %(test)s '
+	                     '-exec /usr/sbin/chown -h %(uid)s%(gid)s {} + -print | /usr/bin/wc -l')
+	
+	tree_signature_cmd = ("cd %(path)s && /usr/bin/find . -type f -exec /usr/bin/stat "
+	                      "-f '%%z %%m %%N' {} + | /usr/bin/sort | /usr/bin/shasum -a 256 | "
+	                      "/usr/bin/cut -c1-64")
+	digests_cmd = ('/usr/bin/find . -type f -print0 | /usr/bin/xargs -0 -n 64 '
+	               '-P $(%(nproc)s 2>/dev/null || echo 4) /usr/bin/shasum -a 256')
+	nproc_cmd = '/usr/sbin/sysctl -n hw.ncpu'
+	
+	# -T means something else to bsd df, the type isn't shown
+	df_cmd = '/bin/df -Pk'
+	df_columns = ('filesystem', 'size', 'used', 'available', 'capacity', 'mountpoint')
+	uname_cmd = '/usr/bin/uname -srm'
+	# bsd xargs has no -r, it doesn't run the command without input anyway
+	compile_files_cmd = ('/usr/bin/xargs -0 -n 64 -P %(workers)s '
+	                     '%(python_exe)s -c %(script)s %(force)s')
+	
+	stream_untar_cmd = '/usr/bin/tar -xf - -C %(path)s'
+	stream_untar_gz_cmd = ('if command -v pigz >/dev/null; then pigz -dc; '
+	                       'else /usr/bin/gzip -dc; fi | /usr/bin/tar -xf - -C %(path)s')
+	stream_untar_bz2_cmd = ('if command -v pbzip2 >/dev/null; then pbzip2 -dc; '
+	                        'else /usr/bin/bzip2 -dc; fi | /usr/bin/tar -xf - -C %(path)s')
+	stream_untar_zst_cmd = 'zstd -dc -T0 | /usr/bin/tar -xf - -C %(path)s'
+	release_switch_cmd = '/bin/mv -h %(link)s %(current)s'
+	
 	# TODO: override user/group commands
\ No newline at end of file
@@ -0,0 +1,352 @@
+from __future__ import with_statement
+
+import collections
+import errno
+import fcntl
+import logging
+import os
+import select
+import subprocess
+import sys
+import threading
+import time
+
+from fabric.state import connections
+
+from executors import channel_command, commandresult, prefixed
+
+class FutureTimeout(Exception):
+    """Raised by Future.result() when the result isn't there in time."""
+    pass
+
+class Future(object):
+    """
+    The result of a command the event loop runs, or of a computation on
+    such results. result() waits for it and raises what went wrong.
+
+    Callbacks run in the event loop thread and must not wait on other
+    futures themselves.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._finished = False
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def done(self):
+        return self._finished
+
+    def _wait(self, timeout):
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._condition:
+            while not self._finished:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise FutureTimeout("No result after %s seconds" % timeout)
+                self._condition.wait(remaining)
+
+    def result(self, timeout=None):
+        self._wait(timeout)
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """What result() would raise, None if it succeeded."""
+        self._wait(timeout)
+        return self._error[1] if self._error is not None else None
+
+    def _set(self, result, error):
+        with self._condition:
+            self._result, self._error, self._finished = result, error, True
+            callbacks, self._callbacks = self._callbacks, []
+            self._condition.notify_all()
+        for callback in callbacks:
+            self._call(callback)
+
+    def set_result(self, result):
+        self._set(result, None)
+
+    def set_exception(self, error=None):
+        """Fail with the exc_info tuple error, the exception being handled by default."""
+        self._set(None, error or sys.exc_info())
+
+    def add_done_callback(self, callback):
+        """Call callback(future) once it's done, right away if it already is."""
+        with self._condition:
+            if not self._finished:
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            logging.exception("Future callback %r failed", callback)
+
+    def then(self, func):
+        """
+        A Future of func(result), which may return a Future itself to chain
+        another command. Errors are passed along without calling func.
+        """
+        chained = Future()
+        def callback(future):
+            if future._error is not None:
+                return chained._set(None, future._error)
+            try:
+                value = func(future._result)
+            except Exception:
+                return chained.set_exception()
+            if isinstance(value, Future):
+                value.add_done_callback(lambda inner: chained._set(inner._result, inner._error))
+            else:
+                chained.set_result(value)
+        self.add_done_callback(callback)
+        return chained
+
+def gather(futures):
+    """A Future of the list of results of futures, or of the first error."""
+    futures = list(futures)
+    gathered = Future()
+    results, remaining, lock = [None] * len(futures), [len(futures)], threading.Lock()
+    if not futures:
+        gathered.set_result([])
+
+    def collect(index):
+        def callback(future):
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                results[index] = future._result
+                remaining[0] = -1 if future._error is not None else remaining[0] - 1
+                finished = remaining[0] <= 0
+            if finished:
+                gathered._set(results if future._error is None else None, future._error)
+        return callback
+
+    for index, future in enumerate(futures):
+        future.add_done_callback(collect(index))
+    return gathered
+
+class _channeltask(object):
+    """A command running in an ssh channel, stderr combined into stdout."""
+
+    def __init__(self, channel, cmd):
+        self.channel = channel
+        self.cmd = cmd
+        self.output = []
+
+    def fileno(self):
+        return self.channel.fileno()
+
+    def pump(self):
+        """Read what arrived, True once the command is done."""
+        # checked first: output arriving with the eof while we read would
+        # otherwise be left behind
+        eof = self.channel.eof_received
+        while self.channel.recv_ready():
+            self.output.append(self.channel.recv(65536))
+        return bool(eof)
+
+    def result(self):
+        return commandresult(''.join(self.output).rstrip('\n'),
+                             self.channel.recv_exit_status(), '', self.cmd)
+
+    def close(self):
+        self.channel.close()
+
+class _processtask(object):
+    """A local command, stderr combined into stdout."""
+
+    def __init__(self, process, cmd):
+        self.process = process
+        self.cmd = cmd
+        self.output = []
+
+    def fileno(self):
+        return self.process.stdout.fileno()
+
+    def pump(self):
+        data = os.read(self.fileno(), 65536)
+        if data:
+            self.output.append(data)
+            return False
+        self.process.wait()
+        return True
+
+    def result(self):
+        return commandresult(''.join(self.output).rstrip('\n'), self.process.returncode,
+                             '', self.cmd)
+
+    def close(self):
+        self.process.stdout.close()
+
+class EventLoop(object):
+    """
+    A thread that waits on the output of all running commands at once, so
+    thousands of them on many hosts don't need a thread each. At most
+    max_per_host commands run on a host at a time, the others wait their
+    turn in the order they were submitted. The thread is started when
+    there is something to do and stops when there isn't.
+    """
+
+    def __init__(self, max_per_host=8):
+        self.max_per_host = max_per_host
+        self._lock = threading.Lock()
+        self._queued = {}
+        self._running = {}
+        self._tasks = {}
+        self._wakeup = os.pipe()
+        self._thread = None
+        fcntl.fcntl(self._wakeup[1], fcntl.F_SETFL,
+                    fcntl.fcntl(self._wakeup[1], fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def submit(self, host, start):
+        """
+        Call start() in the loop once host has a free slot. It starts the
+        command and returns a task for it. Returns a Future of the
+        commandresult.
+        """
+        future = Future()
+        with self._lock:
+            self._queued.setdefault(host, collections.deque()).append((start, future))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='fabricplatforms-eventloop')
+                self._thread.daemon = True
+                self._thread.start()
+        try:
+            os.write(self._wakeup[1], 'x')
+        except OSError, e:
+            # full, the loop has plenty of wakeups to read already
+            if e.errno != errno.EAGAIN:
+                raise
+        return future
+
+    def _ready(self):
+        """(host, start, future) for the queued commands that may start now."""
+        ready = []
+        with self._lock:
+            for host, queue in self._queued.items():
+                while queue and self._running.get(host, 0) < self.max_per_host:
+                    start, future = queue.popleft()
+                    self._running[host] = self._running.get(host, 0) + 1
+                    ready.append((host, start, future))
+                if not queue:
+                    del self._queued[host]
+        return ready
+
+    def _release(self, host):
+        with self._lock:
+            self._running[host] -= 1
+            if not self._running[host]:
+                del self._running[host]
+
+    def _select(self, fds):
+        """The fds that can be read from, waiting until there is one."""
+        if hasattr(select, 'poll'):
+            # not limited to FD_SETSIZE descriptors like select()
+            poller = select.poll()
+            for fd in fds:
+                poller.register(fd, select.POLLIN)
+            return [fd for fd, event in poller.poll()]
+        return select.select(fds, [], [])[0]
+
+    def _run(self):
+        while True:
+            for host, start, future in self._ready():
+                try:
+                    task = start()
+                except Exception:
+                    self._release(host)
+                    future.set_exception()
+                    continue
+                self._tasks[task.fileno()] = (host, task, future)
+            with self._lock:
+                if not self._tasks and not self._queued:
+                    self._thread = None
+                    return
+            for fd in self._select(self._tasks.keys() + [self._wakeup[0]]):
+                if fd == self._wakeup[0]:
+                    os.read(fd, 4096)
+                    continue
+                host, task, future = self._tasks[fd]
+                try:
+                    finished = task.pump()
+                    result = task.result() if finished else None
+                except Exception:
+                    finished, result = None, sys.exc_info()
+                if finished is False:
+                    continue
+                del self._tasks[fd]
+                task.close()
+                self._release(host)
+                if finished:
+                    future.set_result(result)
+                else:
+                    future.set_exception(result)
+
+class AsyncExecutor(object):
+    """
+    Runs commands on an EventLoop and returns Futures of commandresults,
+    with the same output and return_code a platform's executor would give.
+    Subclasses say how a command is started.
+    """
+
+    def __init__(self, max_per_host=8, loop=None):
+        self.loop = loop or EventLoop(max_per_host)
+
+    def run(self, host, cmd, use_sudo=False):
+        """Run cmd on host, in the cwd and prefixes of the calling context."""
+        return self.loop.submit(host, self._starter(host, cmd, use_sudo))
+
+class AsyncSSHExecutor(AsyncExecutor):
+    """
+    Runs commands in channels of fabric's ssh connections, which are shared
+    with everything else. Hosts are host strings, as in env.host_string,
+    and are connected to on first use, by the thread that calls run(), so
+    connecting (and a password prompt) never holds up the event loop.
+    """
+
+    def _starter(self, host, cmd, use_sudo):
+        command = channel_command(cmd, use_sudo)
+        transport = connections[host].get_transport()
+        def start():
+            channel = transport.open_session()
+            channel.set_combine_stderr(True)
+            channel.exec_command(command)
+            return _channeltask(channel, cmd)
+        return start
+
+class AsyncLocalExecutor(AsyncExecutor):
+    """
+    Runs commands with a local shell, inside cwd if given, whatever the
+    host. For tests and the local platform, use_sudo is ignored unless
+    sudo_prefix is set.
+    """
+
+    def __init__(self, cwd=None, shell='/bin/bash', sudo_prefix=None, max_per_host=8,
+                 loop=None):
+        super(AsyncLocalExecutor, self).__init__(max_per_host, loop)
+        self.cwd = cwd
+        self.shell = shell
+        self.sudo_prefix = sudo_prefix
+
+    def _starter(self, host, cmd, use_sudo):
+        args = [self.shell, '-c', prefixed(cmd)]
+        if use_sudo and self.sudo_prefix:
+            args = self.sudo_prefix.split() + args
+        return lambda: _processtask(subprocess.Popen(args, cwd=self.cwd, stdout=subprocess.PIPE,
+                                                     stderr=subprocess.STDOUT), cmd)
+
+_shared_executor = None
+
+def shared_executor():
+    """The AsyncSSHExecutor platforms use unless given their own."""
+    global _shared_executor
+    if _shared_executor is None:
+        _shared_executor = AsyncSSHExecutor()
+    return _shared_executor
@@ -0,0 +1,374 @@
+import json
+import os
+import pipes
+import signal
+import socket
+import subprocess
+import tempfile
+import time
+
+from fabric.api import run, sudo, put
+from fabric.state import env, connections
+from fabric.utils import abort
+
+def prefixed(cmd):
+    """cmd with the cwd and prefixes of the cd() and prefix() contexts."""
+    prefixes = list(env.command_prefixes)
+    if env.cwd:
+        prefixes.insert(0, 'cd %s' % env.cwd)
+    return ' && '.join(prefixes + [cmd])
+
+def channel_command(cmd, use_sudo=False):
+    """
+    cmd the way it's run in a channel opened without fabric's help, in
+    env.shell. sudo is run with -n, so it has to be allowed without a
+    password.
+    """
+    command = '%s %s' % (env.shell, pipes.quote(prefixed(cmd)))
+    if use_sudo:
+        user = ' -u %s' % env.sudo_user if env.sudo_user else ''
+        command = 'sudo -n%s %s' % (user, command)
+    return command
+
+class commandresult(str):
+    """Command output with the same attributes as fabric's run() result."""
+    def __new__(cls, output, return_code=0, stderr='', command=None):
+        result = str.__new__(cls, output)
+        result.return_code = return_code
+        result.failed = return_code != 0
+        result.succeeded = not result.failed
+        result.stderr = stderr
+        result.command = command
+        return result
+
+def _finish(result, kwargs):
+    """Abort on failure the way fabric does unless warn_only is set."""
+    if result.failed and not (env.warn_only or kwargs.get('warn_only')):
+        abort("Command failed with status %s: %s\n%s"
+              % (result.return_code, result.command, result.stderr or result))
+    return result
+
+class spawned(object):
+    """A command started by spawn(), talked to through stdin and stdout."""
+    def __init__(self, stdin, stdout, stop):
+        self.stdin = stdin
+        self.stdout = stdout
+        self._stop = stop
+
+    def close(self):
+        for stream in (self.stdin, self.stdout):
+            try:
+                stream.close()
+            except (IOError, OSError):
+                pass
+        self._stop()
+
+class started(object):
+    """
+    A command started by start(). read(size) returns its output as it
+    arrives, '' at the end, and wait() its commandresult once the output
+    is read, without the output and never aborting. stop() ends the
+    command early, a blocked read() then returns ''. None of them touch
+    env, so they can be called from any thread.
+    """
+    def __init__(self, read, wait, stop):
+        self.read = read
+        self.wait = wait
+        self.stop = stop
+
+class FabricExecutor(object):
+    """
+    Runs commands on env.host_string with fabric's run and sudo, which is
+    what platforms do without an executor. Other executors have the same
+    run() signature and return a commandresult, and may have a put() for
+    uploads, a pipe() for commands fed from the client, a start() for
+    commands whose output is read as it arrives and a spawn() for commands
+    that are kept running.
+    """
+    def run(self, cmd, use_sudo=False, **kwargs):
+        func = sudo if use_sudo else run
+        return func(cmd, **kwargs)
+
+    def put(self, local_path, remote_path, use_sudo=False):
+        return put(local_path, remote_path, use_sudo=use_sudo)
+
+    def _channel(self, cmd, use_sudo):
+        """Start cmd in a channel of its own."""
+        channel = connections[env.host_string].get_transport().open_session()
+        try:
+            channel.exec_command(channel_command(cmd, use_sudo))
+        except Exception:
+            channel.close()
+            raise
+        return channel
+
+    def spawn(self, cmd, use_sudo=False):
+        """Start cmd and keep it running, its stderr is dropped."""
+        channel = self._channel(cmd, use_sudo)
+        return spawned(channel.makefile('wb'), channel.makefile('rb'), channel.close)
+
+    def start(self, cmd, use_sudo=False):
+        """Start cmd in a channel of its own, see started."""
+        channel = self._channel(cmd, use_sudo)
+        def wait():
+            try:
+                return_code = channel.recv_exit_status()
+                errors = ''.join(iter(lambda: channel.recv_stderr(65536), ''))
+            finally:
+                channel.close()
+            return commandresult('', return_code, errors.rstrip('\n'), cmd)
+        return started(channel.recv, wait, channel.close)
+
+    def pipe(self, cmd, chunks, use_sudo=False, **kwargs):
+        """
+        Run cmd in a channel of its own with the strings from chunks
+        written to its stdin, which fabric's run can't do.
+        """
+        output, errors = [], []
+        channel = self._channel(cmd, use_sudo)
+        try:
+            try:
+                for chunk in chunks:
+                    channel.sendall(chunk)
+                    while channel.recv_ready():
+                        output.append(channel.recv(65536))
+                    while channel.recv_stderr_ready():
+                        errors.append(channel.recv_stderr(65536))
+            except socket.error:
+                # the command exited without reading everything
+                pass
+            channel.shutdown_write()
+            return_code = channel.recv_exit_status()
+            for receive, received in ((channel.recv, output), (channel.recv_stderr, errors)):
+                for data in iter(lambda: receive(65536), ''):
+                    received.append(data)
+        finally:
+            channel.close()
+        result = commandresult(''.join(output).rstrip('\n'), return_code,
+                               ''.join(errors).rstrip('\n'), cmd)
+        return _finish(result, kwargs)
+
+class LocalExecutor(object):
+    """
+    Runs commands with a local shell instead of over ssh, inside cwd if
+    given. latency seconds are slept before every call to stand in for a
+    network round trip. use_sudo is ignored unless sudo_prefix is set.
+    """
+
+    def __init__(self, cwd=None, latency=0, shell='/bin/bash', sudo_prefix=None):
+        self.cwd = cwd
+        self.latency = latency
+        self.shell = shell
+        self.sudo_prefix = sudo_prefix
+
+    def _args(self, cmd, use_sudo):
+        args = [self.shell, '-c', prefixed(cmd)]
+        if use_sudo and self.sudo_prefix:
+            args = self.sudo_prefix.split() + args
+        return args
+
+    def run(self, cmd, use_sudo=False, stdout=None, combine_stderr=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        args = self._args(cmd, use_sudo)
+        combine = combine_stderr if combine_stderr is not None else env.combine_stderr
+        if stdout is not None:
+            # hand the output over as it arrives, like fabric does
+            errors = None if combine else tempfile.TemporaryFile()
+            process = subprocess.Popen(args, cwd=self.cwd, stdout=subprocess.PIPE,
+                                       stderr=errors or subprocess.STDOUT)
+            output = []
+            for line in iter(process.stdout.readline, ''):
+                stdout.write(line)
+            process.wait()
+            if errors is not None:
+                errors.seek(0)
+                errors = errors.read()
+        else:
+            process = subprocess.Popen(args, cwd=self.cwd, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT if combine else subprocess.PIPE)
+            output, errors = process.communicate()
+            output = [output]
+        result = commandresult(''.join(output).rstrip('\n'), process.returncode,
+                               (errors or '').rstrip('\n'), cmd)
+        return _finish(result, kwargs)
+
+    def put(self, local_path, remote_path, use_sudo=False):
+        """Copy local_path to remote_path, relative to cwd."""
+        return self.run('/bin/cp %s %s' % (pipes.quote(local_path), pipes.quote(remote_path)),
+                        use_sudo)
+
+    def pipe(self, cmd, chunks, use_sudo=False, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        output, errors = tempfile.TemporaryFile(), tempfile.TemporaryFile()
+        process = subprocess.Popen(self._args(cmd, use_sudo), cwd=self.cwd,
+                                   stdin=subprocess.PIPE, stdout=output, stderr=errors)
+        try:
+            for chunk in chunks:
+                process.stdin.write(chunk)
+        except IOError:
+            # the command exited without reading everything
+            pass
+        try:
+            process.stdin.close()
+        except IOError:
+            pass
+        process.wait()
+        output.seek(0)
+        errors.seek(0)
+        result = commandresult(output.read().rstrip('\n'), process.returncode,
+                               errors.read().rstrip('\n'), cmd)
+        return _finish(result, kwargs)
+
+    def start(self, cmd, use_sudo=False):
+        if self.latency:
+            time.sleep(self.latency)
+        errors = tempfile.TemporaryFile()
+        # in a process group of its own, so stop() also reaches the commands
+        # the shell started, which hold on to stdout otherwise
+        process = subprocess.Popen(self._args(cmd, use_sudo), cwd=self.cwd,
+                                   stdout=subprocess.PIPE, stderr=errors,
+                                   preexec_fn=os.setsid)
+        def wait():
+            process.stdout.close()
+            return_code = process.wait()
+            errors.seek(0)
+            return commandresult('', return_code, errors.read().rstrip('\n'), cmd)
+        def stop():
+            if process.poll() is None:
+                try:
+                    os.killpg(process.pid, signal.SIGTERM)
+                except OSError:
+                    # not ours to signal when run with sudo
+                    process.terminate()
+        return started(lambda size: os.read(process.stdout.fileno(), size), wait, stop)
+
+    def spawn(self, cmd, use_sudo=False):
+        if self.latency:
+            time.sleep(self.latency)
+        child = subprocess.Popen(self._args(cmd, use_sudo), cwd=self.cwd,
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                 stderr=tempfile.TemporaryFile())
+        def stop():
+            if child.poll() is None:
+                child.terminate()
+            child.wait()
+        return spawned(child.stdin, child.stdout, stop)
+
+class ReplayExecutor(object):
+    """
+    Answers commands from a transcript instead of running them.
+
+    transcript is a list of dicts with command, use_sudo, output,
+    return_code and stderr keys, as written by RecordingExecutor.save().
+    Repeated commands are answered in recorded order, the last answer is
+    reused once they run out. Unknown commands raise KeyError, unless
+    default (an output string) is given.
+    """
+
+    def __init__(self, transcript, latency=0, default=None):
+        if isinstance(transcript, basestring):
+            with open(transcript) as transcript_file:
+                transcript = json.load(transcript_file)
+        self.latency = latency
+        self.default = default
+        self.answers = {}
+        for entry in transcript:
+            key = (entry['command'], bool(entry.get('use_sudo')))
+            self.answers.setdefault(key, []).append(entry)
+
+    def run(self, cmd, use_sudo=False, stdout=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        answers = self.answers.get((prefixed(cmd), bool(use_sudo)))
+        if not answers:
+            if self.default is None:
+                raise KeyError("No recorded answer for %r" % cmd)
+            entry = {'output': self.default}
+        else:
+            entry = answers.pop(0) if len(answers) > 1 else answers[0]
+        output, stderr = entry.get('output', ''), entry.get('stderr', '')
+        result = commandresult(output.encode('utf-8') if isinstance(output, unicode) else output,
+                               entry.get('return_code', 0),
+                               stderr.encode('utf-8') if isinstance(stderr, unicode) else stderr,
+                               cmd)
+        if stdout is not None and result:
+            stdout.write(result + '\n')
+        return _finish(result, kwargs)
+
+    def put(self, local_path, remote_path, use_sudo=False):
+        if self.latency:
+            time.sleep(self.latency)
+        return commandresult('')
+
+    def pipe(self, cmd, chunks, use_sudo=False, **kwargs):
+        for chunk in chunks:
+            pass
+        return self.run(cmd, use_sudo, **kwargs)
+
+    def start(self, cmd, use_sudo=False):
+        result = self.run(cmd, use_sudo, warn_only=True)
+        output = [result + '\n' if result else '']
+        return started(lambda size: output.pop() if output else '',
+                       lambda: commandresult('', result.return_code, result.stderr, cmd),
+                       lambda: output.pop() if output else None)
+
+class RecordingExecutor(object):
+    """Passes commands on to executor and keeps a transcript of them."""
+
+    def __init__(self, executor=None):
+        self.executor = executor or FabricExecutor()
+        self.transcript = []
+
+    def run(self, cmd, use_sudo=False, **kwargs):
+        return self._record(cmd, use_sudo, lambda: self.executor.run(cmd, use_sudo, **kwargs))
+
+    def pipe(self, cmd, chunks, use_sudo=False, **kwargs):
+        func = getattr(self.executor, 'pipe', None) or FabricExecutor().pipe
+        return self._record(cmd, use_sudo, lambda: func(cmd, chunks, use_sudo, **kwargs))
+
+    def start(self, cmd, use_sudo=False):
+        func = getattr(self.executor, 'start', None) or FabricExecutor().start
+        process, command, output = func(cmd, use_sudo), prefixed(cmd), []
+        def read(size):
+            data = process.read(size)
+            output.append(data)
+            return data
+        def wait():
+            def call():
+                result = process.wait()
+                return commandresult(''.join(output).rstrip('\n'), result.return_code,
+                                     result.stderr, cmd)
+            return self._record(cmd, use_sudo, call, command)
+        return started(read, wait, process.stop)
+
+    def spawn(self, cmd, use_sudo=False):
+        # the conversation with a spawned command isn't part of the transcript
+        func = getattr(self.executor, 'spawn', None) or FabricExecutor().spawn
+        return func(cmd, use_sudo)
+
+    def _record(self, cmd, use_sudo, call, command=None):
+        """call() and add its result to the transcript, as command if given."""
+        result = None
+        try:
+            result = call()
+            return result
+        finally:
+            self.transcript.append({
+                'command': command or prefixed(cmd),
+                'use_sudo': use_sudo,
+                'output': str(result) if result is not None else '',
+                'return_code': getattr(result, 'return_code', None),
+                'stderr': getattr(result, 'stderr', ''),
+            })
+
+    def put(self, local_path, remote_path, use_sudo=False):
+        func = getattr(self.executor, 'put', None)
+        if func is None:
+            return put(local_path, remote_path, use_sudo=use_sudo)
+        return func(local_path, remote_path, use_sudo)
+
+    def save(self, path):
+        with open(path, 'w') as transcript_file:
+            json.dump(self.transcript, transcript_file, indent=1)
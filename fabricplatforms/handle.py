@@ -0,0 +1,85 @@
+from __future__ import with_statement
+
+import inspect
+import types
+from contextlib import contextmanager
+
+from fabric.api import settings
+from fabric.network import to_dict
+
+class HostPlatform(object):
+    """
+    The platform of one host, as returned by Platform.for_host(). Its
+    methods are those of the platform, run against the host it was made
+    for whatever env.host_string is, so code can work on several hosts
+    without switching env itself::
+
+        web, db = platform.for_host('web1'), platform.for_host('db1')
+        for path in paths:
+            web.chmod(path, '644')
+            db.chmod(path, '600')
+
+    The platform is looked up once and every method is wrapped on first
+    use, later calls skip the Platform proxy entirely. The blocking
+    methods still run with the global env (fabric's run() and the
+    caches, batches and agents of the platform are keyed by it), so the
+    handle sets env for the length of each call (or each step of a
+    generator like iterwalk(), or the body of batch()), which means
+    handles must not be used from several threads at once. Only the a*()
+    methods are passed the host and don't touch env.
+    """
+
+    def __init__(self, platform, host_string):
+        self.platform = platform
+        self.env = to_dict(host_string)
+        self.host_string = self.env['host_string']
+        self.host = self.env['host']
+
+    def __repr__(self):
+        return '<HostPlatform %s %s>' % (type(self.platform).__name__, self.host_string)
+
+    def __getattr__(self, name):
+        value = getattr(self.platform, name)
+        if name.startswith('_') or not isinstance(value, types.MethodType):
+            return value
+        try:
+            passes_host = 'host' in inspect.getargspec(value).args
+        except TypeError:
+            passes_host = False
+        method = self._hosted(value) if passes_host else self._within(value)
+        # found by normal attribute lookup from now on
+        self.__dict__[name] = method
+        return method
+
+    def _hosted(self, method):
+        def call(*args, **kwargs):
+            kwargs.setdefault('host', self.host_string)
+            return method(*args, **kwargs)
+        return call
+
+    def _within(self, method):
+        def call(*args, **kwargs):
+            with settings(**self.env):
+                result = method(*args, **kwargs)
+            if isinstance(result, types.GeneratorType):
+                return self._steps(result)
+            if hasattr(result, '__enter__') and hasattr(result, '__exit__'):
+                return self._entered(result)
+            return result
+        return call
+
+    def _steps(self, iterator):
+        """iterator advanced with env set for the host, one step at a time."""
+        while True:
+            with settings(**self.env):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    @contextmanager
+    def _entered(self, manager):
+        with settings(**self.env):
+            with manager as value:
+                yield value
@@ -0,0 +1,283 @@
+"""
+The helper agent mode keeps running on a host, see agent.py.
+
+Reads requests from stdin and writes the answers to stdout, each framed as
+a line with the length of a JSON document followed by the document. Only
+uses the standard library, and runs on python 2.6 and later and python 3,
+whatever the host has. The op_* functions are also called in process by
+the local platform.
+"""
+import grp
+import hashlib
+import json
+import os
+import pwd
+import shutil
+import socket
+import stat
+import sys
+
+VERSION = 1
+
+# walk() answers in frames of this many entries
+WALK_CHUNK = 1000
+
+# file type letters as printed by find -printf %y
+FILETYPES = (
+    (stat.S_ISDIR, 'd'),
+    (stat.S_ISREG, 'f'),
+    (stat.S_ISLNK, 'l'),
+    (stat.S_ISFIFO, 'p'),
+    (stat.S_ISSOCK, 's'),
+    (stat.S_ISCHR, 'c'),
+    (stat.S_ISBLK, 'b'),
+)
+
+def _name(lookup, number):
+    try:
+        return lookup(number)[0]
+    except KeyError:
+        return str(number)
+
+def _uid(user):
+    return int(user) if str(user).isdigit() else pwd.getpwnam(user).pw_uid
+
+def _gid(group):
+    return int(group) if str(group).isdigit() else grp.getgrnam(group).gr_gid
+
+def _entry(path, info):
+    """[type letter, octal mode, user, group, [size, atime, mtime, ctime], link target]"""
+    filetype = 'u'
+    for test, letter in FILETYPES:
+        if test(info.st_mode):
+            filetype = letter
+            break
+    return [filetype, '%o' % stat.S_IMODE(info.st_mode),
+            _name(pwd.getpwuid, info.st_uid), _name(grp.getgrgid, info.st_gid),
+            [info.st_size, int(info.st_atime), int(info.st_mtime), int(info.st_ctime)],
+            os.readlink(path) if filetype == 'l' else None]
+
+def _paths(path, recursive):
+    """path, and everything below it if recursive."""
+    yield path
+    if recursive and os.path.isdir(path) and not os.path.islink(path):
+        for directory, dirs, files in os.walk(path):
+            for name in dirs + files:
+                yield os.path.join(directory, name)
+
+def _change(path, recursive, only_changed, differs, change):
+    """change() path (and what's below it), only where differs() if asked to."""
+    changed = 0
+    for name in _paths(path, recursive):
+        info = os.lstat(name)
+        if not only_changed or differs(name, info):
+            change(name)
+            changed += 1
+    return changed if only_changed else None
+
+def op_hello():
+    return {'version': VERSION, 'python': list(sys.version_info[:3])}
+
+def op_stat(paths, link=False):
+    """Entries of paths, None for those that don't exist (or aren't links)."""
+    result = {}
+    for path in paths:
+        try:
+            exists = os.path.islink(path) if link else os.path.exists(path)
+            result[path] = _entry(path, os.lstat(path)) if exists else None
+        except OSError:
+            result[path] = None
+    return result
+
+def op_walk(path, maxdepth=None):
+    """
+    Yield lists of the entries of path and everything below it, with the
+    path in front of each, in the order find prints them.
+    """
+    info = os.lstat(path)
+    chunk, stack = [], [(path, info, 0)]
+    while stack:
+        current, info, depth = stack.pop()
+        chunk.append([current] + _entry(current, info))
+        if len(chunk) >= WALK_CHUNK:
+            yield chunk
+            chunk = []
+        if not stat.S_ISDIR(info.st_mode) or (maxdepth is not None and depth >= maxdepth):
+            continue
+        try:
+            names = os.listdir(current)
+        except OSError:
+            continue
+        children = []
+        for name in names:
+            child = os.path.join(current, name)
+            try:
+                children.append((child, os.lstat(child), depth + 1))
+            except OSError:
+                pass
+        stack.extend(reversed(children))
+    yield chunk
+
+def op_listdir(path, prefix=None, limit=None, offset=0):
+    """Entries directly in path the way walk() gives them, sorted, one page of them."""
+    names = sorted(name for name in os.listdir(path) if not prefix or name.startswith(prefix))
+    result = []
+    for name in names[offset:offset + limit if limit is not None else None]:
+        child = os.path.join(path, name)
+        try:
+            result.append([child] + _entry(child, os.lstat(child)))
+        except OSError:
+            pass
+    return result
+
+def op_digest(paths):
+    """sha256 hex digests of the files at paths, None for unreadable ones."""
+    result = {}
+    for path in paths:
+        try:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as source:
+                for block in iter(lambda: source.read(65536), b''):
+                    digest.update(block)
+            result[path] = digest.hexdigest()
+        except (IOError, OSError):
+            result[path] = None
+    return result
+
+def op_hostname():
+    return socket.gethostname()
+
+def op_accounts():
+    """The passwd and group databases as lines, network accounts included."""
+    passwd = [':'.join([entry.pw_name, 'x', str(entry.pw_uid), str(entry.pw_gid),
+                        entry.pw_gecos, entry.pw_dir, entry.pw_shell])
+              for entry in pwd.getpwall()]
+    group = [':'.join([entry.gr_name, 'x', str(entry.gr_gid), ','.join(entry.gr_mem)])
+             for entry in grp.getgrall()]
+    return {'passwd': passwd, 'group': group}
+
+def op_groups():
+    return [[entry.gr_name, entry.gr_gid, list(entry.gr_mem)] for entry in grp.getgrall()]
+
+def op_groupget(group):
+    try:
+        entry = grp.getgrnam(group)
+    except KeyError:
+        return None
+    return [entry.gr_name, entry.gr_gid, list(entry.gr_mem)]
+
+def op_userget(name):
+    """The fields of a userstruct, groups without the primary group."""
+    try:
+        entry = pwd.getpwnam(name)
+    except KeyError:
+        return None
+    group = _name(grp.getgrgid, entry.pw_gid)
+    groups = sorted(set(other.gr_name for other in grp.getgrall()
+                        if name in other.gr_mem) - set([group]))
+    return [entry.pw_name, entry.pw_uid, entry.pw_gid, group, groups,
+            entry.pw_gecos, entry.pw_dir, entry.pw_shell]
+
+def _owner(path, only_changed, uid, gid):
+    """
+    Change the owner the way chown -R does: links below path themselves,
+    never what they point to. path is followed unless only_changed.
+    """
+    def change(name):
+        if name == path and not only_changed:
+            os.chown(name, uid, gid)
+        else:
+            os.lchown(name, uid, gid)
+    return change
+
+def op_chgrp(path, gid, recursive=False, only_changed=False):
+    gid = _gid(gid)
+    return _change(path, recursive, only_changed,
+                   lambda name, info: info.st_gid != gid, _owner(path, only_changed, -1, gid))
+
+def op_chmod(path, mode, recursive=False, only_changed=False):
+    """mode is an octal string, links are skipped like chmod -R does."""
+    mode = int(str(mode), 8)
+    changed = 0
+    for name in _paths(path, recursive):
+        info = os.lstat(name)
+        if stat.S_ISLNK(info.st_mode) or (only_changed and stat.S_IMODE(info.st_mode) == mode):
+            continue
+        os.chmod(name, mode)
+        changed += 1
+    return changed if only_changed else None
+
+def op_chown(path, uid, gid=None, recursive=False, only_changed=False):
+    uid = _uid(uid)
+    gid = _gid(gid) if gid else -1
+    return _change(path, recursive, only_changed,
+                   lambda name, info: info.st_uid != uid or gid not in (-1, info.st_gid),
+                   _owner(path, only_changed, uid, gid))
+
+def op_link(target, path, absolute=False):
+    """Same as ln -fs run in the directory of target."""
+    head, tail = os.path.split(target)
+    if absolute:
+        target = tail
+    path = os.path.join(head, path)
+    if os.path.isdir(path):
+        path = os.path.join(path, os.path.basename(target))
+    if os.path.lexists(path):
+        os.remove(path)
+    os.symlink(target, path)
+
+def op_mkdir(path, parents=False):
+    if not parents:
+        os.mkdir(path)
+    elif not os.path.isdir(path):
+        os.makedirs(path)
+
+def op_move(path, target):
+    shutil.move(path, target)
+
+def op_remove(path, recursive=False, force=False, link=False):
+    if not (os.path.islink(path) if link else os.path.exists(path)):
+        return
+    if recursive and os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=force)
+    elif not force or os.path.lexists(path):
+        os.remove(path)
+
+def op_rmdir(path):
+    os.rmdir(path)
+
+def op_touch(path):
+    with open(path, 'a'):
+        os.utime(path, None)
+
+def handle(request, send):
+    """Answer a request, a dict with op, args and the cwd to run it in."""
+    try:
+        os.chdir(os.path.expanduser(request.get('cwd') or '~'))
+        result = globals()['op_' + request['op']](**request.get('args', {}))
+        if request['op'] == 'walk':
+            for chunk in result:
+                send({'ok': True, 'result': chunk, 'more': True})
+            result = None
+        send({'ok': True, 'result': result})
+    except Exception:
+        send({'ok': False, 'error': str(sys.exc_info()[1])})
+
+def main():
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    def send(message):
+        data = json.dumps(message).encode('utf-8')
+        stdout.write(('%d\n' % len(data)).encode('ascii') + data)
+        stdout.flush()
+
+    send({'ok': True, 'result': op_hello()})
+    while True:
+        line = stdin.readline()
+        if not line.strip():
+            break
+        handle(json.loads(stdin.read(int(line)).decode('utf-8')), send)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+from __future__ import with_statement
+
+import threading
+
+from common.utils import idranges
+from base import PlatformError
+
+class IdAllocator(object):
+    """
+    Hands out uids and gids that are free on every host of a fleet.
+
+    Built from the accountsnapshots of the hosts (see accounts() and
+    Platform.id_allocator()), which are read once and indexed as idranges
+    per host and for the whole fleet, so finding the lowest free id is a
+    bisect instead of a scan of every account::
+
+        allocator = platform.id_allocator()
+        names = ['alice', 'bob']
+        uids = allocator.reserve(len(names))
+        # then on each host
+        platform.ensure_users([{'name': name, 'uid': uid}
+                               for name, uid in zip(names, uids)])
+
+    Reserved ids count as used from then on, so the ids given out for a
+    batch of accounts never collide and are the same on every host. The
+    primary gids of users count as used gids, whether or not the group
+    exists.
+    """
+
+    # the range ids are taken from unless told otherwise, below the
+    # nobody and nogroup ids at the end of the 16 bit range
+    first_id = 1000
+    last_id = 59999
+
+    def __init__(self, snapshots=None):
+        self.hosts = {}
+        self.fleet = {'uid': idranges(), 'gid': idranges()}
+        self._lock = threading.Lock()
+        for host, snapshot in (snapshots or {}).iteritems():
+            self.add_host(host, snapshot)
+
+    def add_host(self, host, snapshot):
+        """Index the ids used on host, from its accountsnapshot."""
+        users = snapshot.users.values()
+        used = {'uid': idranges(user.uid for user in users),
+                'gid': idranges([group.gid for group in snapshot.groups.itervalues()] +
+                                [user.gid for user in users])}
+        with self._lock:
+            self.hosts[host] = used
+            for kind, ranges in used.iteritems():
+                self.fleet[kind].update(ranges)
+
+    def free(self, kind='uid', low=None, high=None, host=None):
+        """
+        The lowest uid (or gid, with kind='gid') from low to high that is
+        free on host, or on every host if host is None. None if there is
+        no such id. Nothing is reserved.
+        """
+        ranges = self.fleet[kind] if host is None else self.hosts[host][kind]
+        return ranges.lowest_free(self.first_id if low is None else low,
+                                  self.last_id if high is None else high)
+
+    def reserve(self, count=1, kind='uid', low=None, high=None):
+        """
+        Reserve the count lowest ids from low to high that are free on
+        every host and return them in order. Raises PlatformError if there
+        aren't that many.
+        """
+        low = self.first_id if low is None else low
+        high = self.last_id if high is None else high
+        with self._lock:
+            ids, ranges = [], self.fleet[kind]
+            while len(ids) < count:
+                id = ranges.lowest_free(ids[-1] + 1 if ids else low, high)
+                if id is None:
+                    raise PlatformError("Only %d free %ss from %d to %d"
+                                        % (len(ids), kind, low, high))
+                ids.append(id)
+            for id in ids:
+                ranges.add(id)
+                for used in self.hosts.itervalues():
+                    used[kind].add(id)
+        return ids
@@ -0,0 +1,63 @@
+import getpass
+import os
+import socket
+
+from fabric.network import normalize
+
+from agent import InlineAgent
+from base import BasePlatform
+from eventloop import AsyncLocalExecutor
+from executors import LocalExecutor
+
+_local_names = None
+
+def is_local(host_string):
+    """
+    True if host_string names this machine and we would log in as
+    ourselves: as the user of the host string, or env.user without one.
+    """
+    global _local_names
+    if _local_names is None:
+        _local_names = set(['localhost', '127.0.0.1', '::1',
+                            socket.gethostname(), socket.getfqdn()])
+    user, host = normalize(host_string, omit_port=True)
+    return host in _local_names and user == getpass.getuser()
+
+def local_platform(platform_class):
+    """Return an instance of platform_class with the Local methods mixed in."""
+    cls = type('Local%s' % platform_class.__name__, (Local, platform_class), {})
+    return cls()
+
+class Local(BasePlatform):
+    """
+    Platform methods for the machine we run on, done with os, shutil, pwd
+    and grp calls instead of shell commands: the requests the helper agent
+    answers on other hosts (see agent.py) are answered in this process,
+    whatever agent_mode says. Mixed in front of the class of the local os
+    by local_platform(), whose command based methods are used for
+    everything else, run by a LocalExecutor.
+
+    Calls with use_sudo while we aren't root go through the commands
+    too, with sudo. Failures abort like a failed command would, unless
+    warn_only is set.
+    """
+
+    def __init__(self):
+        super(Local, self).__init__()
+        root = os.geteuid() == 0
+        self.executor = LocalExecutor(sudo_prefix=None if root else 'sudo')
+        self.async_executor = AsyncLocalExecutor(sudo_prefix=None if root else 'sudo')
+        self._inline = InlineAgent()
+
+    def _sudo(self, use_sudo):
+        """True if the call has to go through the commands to get sudo."""
+        return use_sudo and os.geteuid() != 0
+
+    def _reads(self):
+        # lookups are cheap here and native changes don't invalidate
+        return None
+
+    def _agent(self, use_sudo=False):
+        if self._sudo(use_sudo):
+            return None
+        return self._inline
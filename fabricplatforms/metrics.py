@@ -0,0 +1,82 @@
+import json
+import math
+
+class callrecord(object):
+    """What happened during a single execute() call, as passed to hooks."""
+    def __init__(self, host, method, template, command, use_sudo, elapsed,
+                 return_code, size):
+        self.host = host
+        self.method = method
+        self.template = template
+        self.command = command
+        self.use_sudo = use_sudo
+        self.elapsed = elapsed
+        self.return_code = return_code
+        self.size = size
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+def percentile(values, percent):
+    """Nearest rank percentile of a sorted list of values."""
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+class Metrics(object):
+    """
+    execute() hook that keeps every callrecord and summarizes them::
+
+        metrics = Metrics()
+        platform.add_hook(metrics)
+        ...
+        metrics.dump('metrics.json')
+
+    Round trips, failures, bytes and p50/p95/p99 wall time are reported per
+    method, per command template and per host.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def clear(self):
+        self.records = []
+
+    def summarize(self, records):
+        times = sorted(record.elapsed for record in records)
+        return {
+            'round_trips': len(records),
+            'failures': len([record for record in records if record.return_code]),
+            'bytes': sum(record.size or 0 for record in records),
+            'total_time': sum(times),
+            'p50': percentile(times, 50),
+            'p95': percentile(times, 95),
+            'p99': percentile(times, 99),
+        }
+
+    def group(self, attribute):
+        """Summaries of the records grouped by a callrecord attribute."""
+        groups = {}
+        for record in self.records:
+            groups.setdefault(str(getattr(record, attribute)), []).append(record)
+        return dict((key, self.summarize(records)) for key, records in groups.iteritems())
+
+    def report(self):
+        return {
+            'total': self.summarize(self.records),
+            'methods': self.group('method'),
+            'templates': self.group('template'),
+            'hosts': self.group('host'),
+        }
+
+    def dump(self, path, records=False):
+        """Write report() as JSON to path, with every record if asked to."""
+        report = self.report()
+        if records:
+            report['records'] = [record.as_dict() for record in self.records]
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, indent=1, sort_keys=True)
@@ -0,0 +1,114 @@
+import cPickle as pickle
+import errno
+import multiprocessing
+import select
+import time
+
+from fabric import state
+from fabric.network import to_dict
+
+from base import PlatformError
+
+class HostTimeout(PlatformError):
+    """Raised for a host that didn't finish before its deadline."""
+    pass
+
+class hostresult(object):
+    """Outcome of running a callable against a single host."""
+    def __init__(self, host, result=None, error=None, elapsed=None):
+        self.host = host
+        self.result = result
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+def _run_on_host(connection, host, fn, args, kwargs):
+    """Body of a worker process, the same setup fabric uses for @parallel."""
+    state.env.update(to_dict(host))
+    state.env.update({'parallel': True, 'linewise': True})
+    # never share the parent's ssh connections
+    state.connections.clear()
+    try:
+        outcome = (fn(*args, **kwargs), None)
+    except BaseException, e:
+        outcome = (None, e)
+    try:
+        data = pickle.dumps(outcome, pickle.HIGHEST_PROTOCOL)
+    except Exception, e:
+        data = pickle.dumps((None, PlatformError("Can't send result back: %r" % e)),
+                            pickle.HIGHEST_PROTOCOL)
+    connection.send_bytes(data)
+    connection.close()
+
+def fanout(hosts, fn, args=(), kwargs=None, workers=None, timeout=None, poll=0.1):
+    """
+    Run fn(*args, **kwargs) once for every host in hosts, each in its own
+    process with env set up for that host, keeping at most workers hosts
+    in flight at once (env.pool_size or all of them by default).
+
+    Return a dict of host -> hostresult. A host still running timeout
+    seconds after it started is killed and gets a HostTimeout error, so a
+    few slow hosts don't hold up the rest.
+    """
+    kwargs = kwargs or {}
+    hosts = list(hosts)
+    hosts = [host for index, host in enumerate(hosts) if host not in hosts[:index]]
+    workers = workers or state.env.get('pool_size') or len(hosts)
+    pending, running, results = list(reversed(hosts)), {}, {}
+
+    def finish(host, result=None, error=None):
+        process, reader, started = running.pop(host)
+        reader.close()
+        results[host] = hostresult(host, result, error, time.time() - started)
+        process.join()
+
+    def receive(host):
+        process, reader, _ = running[host]
+        try:
+            data = reader.recv_bytes()
+        except (EOFError, IOError):
+            # the worker is gone without sending its result
+            process.join()
+            finish(host, error=PlatformError("Worker for %s exited with status %s"
+                                             % (host, process.exitcode)))
+            return
+        try:
+            outcome = pickle.loads(data)
+        except Exception, e:
+            outcome = (None, PlatformError("Can't read result of %s: %r" % (host, e)))
+        finish(host, *outcome)
+
+    while pending or running:
+        while pending and len(running) < workers:
+            host = pending.pop()
+            # a pipe per worker, so killing one while it writes can't
+            # break the results of the others
+            reader, writer = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_run_on_host,
+                                              args=(writer, host, fn, args, kwargs))
+            process.name = host
+            process.start()
+            # the worker holds the only writer now, its exit ends the pipe
+            writer.close()
+            running[host] = (process, reader, time.time())
+
+        readers = dict((reader.fileno(), host) for host, (_, reader, _) in running.items())
+        try:
+            ready = select.select(list(readers), [], [], poll)[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            ready = []
+        for fileno in ready:
+            receive(readers[fileno])
+
+        now = time.time()
+        for host, (process, _, started) in running.items():
+            if timeout is not None and now - started > timeout:
+                process.terminate()
+                finish(host, error=HostTimeout("%s did not finish within %ss"
+                                               % (host, timeout)))
+    return results
@@ -0,0 +1,160 @@
+from __future__ import with_statement
+
+import logging
+import sys
+import threading
+
+# installed packages provide platforms as entry points of this group, e.g.
+# in their setup.py: entry_points={'fabricplatforms.platforms':
+# ['freebsd = bsdplatforms:FreeBSD']}, freebsd being what uname -s says
+ENTRY_POINT_GROUP = 'fabricplatforms.platforms'
+
+def import_object(dotted_path):
+    """
+    Import an object from a dotted path string, 'package.module.Class'
+    or, the way entry points are written, 'package.module:Class'.
+
+    If dotted_path names a module, then the module is returned.
+    """
+    if ':' in dotted_path:
+        module_path, attributes = dotted_path.split(':', 1)
+        parts = module_path.split('.')
+        start = len(parts)
+        parts += attributes.split('.')
+    else:
+        parts = dotted_path.split('.')
+        start = None
+    for index in range(start or len(parts), 0, -1):
+        module_path = '.'.join(parts[:index])
+        try:
+            __import__(module_path)
+        except ImportError, e:
+            # only a missing module means the rest are attributes, not a
+            # module that failed to import something itself
+            if start or index == 1 or str(e) != 'No module named %s' % parts[index - 1]:
+                raise
+            continue
+        obj = sys.modules[module_path]
+        for name in parts[index:]:
+            obj = getattr(obj, name)
+        return obj
+
+class PlatformRegistry(object):
+    """
+    Mapping of platform name -> platform instance, as Platform.PLATFORMS.
+
+    Platforms are registered as classes or dotted paths, which are only
+    imported and instantiated the first time the platform is looked up,
+    so platforms a run never talks to cost nothing. Names that aren't
+    registered are looked up in the ENTRY_POINT_GROUP entry points of the
+    installed packages, if setuptools is there.
+
+    configure() sets attributes on every platform, including those that
+    aren't made yet. Iterating over the values makes all of them, loaded()
+    only returns those made so far.
+    """
+
+    def __init__(self):
+        self._sources = {}
+        self._instances = {}
+        self._settings = {}
+        self._entry_points = None
+        self._lock = threading.RLock()
+
+    def register(self, name, source):
+        """Register source, a platform class or dotted path, under name."""
+        with self._lock:
+            self._sources[name] = source
+            self._instances.pop(name, None)
+
+    def configure(self, **attributes):
+        """Set attributes on every platform, now and as they are made."""
+        with self._lock:
+            self._settings.update(attributes)
+            for platform in self._instances.itervalues():
+                for name, value in attributes.iteritems():
+                    setattr(platform, name, value)
+
+    def loaded(self):
+        """Dict of name -> instance of the platforms made so far."""
+        return dict(self._instances)
+
+    def _discover(self):
+        """Add the platforms of the installed entry points, once."""
+        if self._entry_points is not None:
+            return
+        self._entry_points = {}
+        try:
+            import pkg_resources
+        except ImportError:
+            return
+        for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP):
+            self._entry_points.setdefault(entry_point.name, entry_point)
+
+    def _source(self, name):
+        source = self._sources.get(name)
+        if source is None and name:
+            self._discover()
+            source = self._entry_points.get(name)
+        return source
+
+    def __getitem__(self, name):
+        platform = self._instances.get(name)
+        if platform is not None:
+            return platform
+        with self._lock:
+            if name in self._instances:
+                return self._instances[name]
+            source = self._source(name)
+            if source is None:
+                raise KeyError(name)
+            if isinstance(source, basestring):
+                source = import_object(source)
+            elif hasattr(source, 'load'):
+                logging.info("Loading platform %s from %s", name, source)
+                source = source.load()
+            platform = source()
+            for attribute, value in self._settings.iteritems():
+                setattr(platform, attribute, value)
+            self._instances[name] = platform
+        return platform
+
+    def __setitem__(self, name, platform):
+        """Register an instance that is already made."""
+        with self._lock:
+            self._sources[name] = type(platform)
+            self._instances[name] = platform
+
+    def __contains__(self, name):
+        return self._source(name) is not None
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def iterkeys(self):
+        self._discover()
+        names = set(self._sources)
+        names.update(self._entry_points)
+        return iter(sorted(names))
+
+    __iter__ = iterkeys
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def iteritems(self):
+        for name in self.keys():
+            yield name, self[name]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        for name, platform in self.iteritems():
+            yield platform
+
+    def values(self):
+        return list(self.itervalues())
@@ -10,11 +10,31 @@ class Solaris(BasePlatform):
     untar_cmd = 'cd %(path)s; /bin/tar -xf %(file)s'
     untar_gz_cmd = 'cd %(path)s; /usr/bin/gzcat %(file)s | /usr/bin/tar xf -'
     untar_bz2_cmd = 'cd %(path)s; /usr/bin/bzcat %(file)s | /usr/bin/tar xf -'
-    df_cmd = '/bin/df -h'
-    # FIXME: Warn that /usr/bin/stat is part of gnu tools need third party tools
+    stream_untar_cmd = 'cd %(path)s && /usr/bin/tar xf -'
+    stream_untar_gz_cmd = ('cd %(path)s && if command -v pigz >/dev/null; then pigz -dc; '
+                           'else /usr/bin/gzcat; fi | /usr/bin/tar xf -')
+    stream_untar_bz2_cmd = ('cd %(path)s && if command -v pbzip2 >/dev/null; then pbzip2 -dc; '
+                            'else /usr/bin/bzcat; fi | /usr/bin/tar xf -')
+    stream_untar_zst_cmd = 'cd %(path)s && /usr/bin/zstd -dc -T0 | /usr/bin/tar xf -'
+    df_cmd = '/usr/bin/df -k'
+    df_columns = ('filesystem', 'size', 'used', 'available', 'capacity', 'mountpoint')
+    uname_cmd = '/usr/bin/uname -srm'
     
-    # This is gnu find for solaris 5.11 
-    find_cmd = "/usr/gnu/bin/find %(file)s -printf '%%p:%%y:%%m:%%u:%%g:%%l:%%s,%%A@,%%T@,%%C@\n'"
+    # These are the gnu tools for solaris 5.11 
+    stat_cmd = '/usr/gnu/bin/stat -c %%F:%%a:%%U:%%G:%%s,%%X,%%Y,%%Z %s'
+    readlink_cmd = '/usr/gnu/bin/readlink %s'
+    find_cmd = ("/usr/gnu/bin/find %(file)s %(options)s "
+                "-printf '%%y:%%m:%%u:%%g:%%s,%%A@,%%T@,%%C@:%%p\\t%%l\\n'")
+    tree_signature_cmd = ("cd %(path)s && /usr/gnu/bin/find . -type f "
+                          "-printf '%%s %%T@ %%p\\n' | /usr/bin/sort | /usr/bin/digest -a sha256")
+    digests_cmd = ('/usr/gnu/bin/find . -type f -print0 | /usr/gnu/bin/xargs -0 -r -n 64 '
+                   '-P $(%(nproc)s 2>/dev/null || echo 4) /usr/gnu/bin/sha256sum')
+    nproc_cmd = '/usr/sbin/psrinfo | /usr/bin/wc -l'
+    byte_compile_cmd = "/usr/gnu/bin/find %(path)s -name '*.py' -print0 | %(compile)s"
+    compile_files_cmd = ('/usr/gnu/bin/xargs -0 -r -n 64 -P %(workers)s '
+                         '%(python_exe)s -c %(script)s %(force)s')
+    release_switch_cmd = '/usr/gnu/bin/mv -T %(link)s %(current)s'
+    release_orphans_cmd = '/usr/gnu/bin/find objects -type f -links 1 -print -delete'
     
     groupget_cmd = '/usr/bin/grep ^%(group)s: /etc/group'
     groups_cmd = '/usr/bin/cat /etc/group'
@@ -0,0 +1,39 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from fabric.api import env
+
+from fabricplatforms import bench
+from fabricplatforms.base import add_hook, remove_hook
+
+class SandboxTestCase(unittest.TestCase):
+    """
+    Runs against bench.sandbox_platform() in a temporary directory, with
+    the callrecords of the commands it ran in self.records.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for name in ('passwd', 'group'):
+            open(os.path.join(self.root, name), 'w').close()
+        self.platform = bench.sandbox_platform(self.root)
+        env.host_string = 'localhost'
+        self.records = []
+        add_hook(self.records.append)
+
+    def tearDown(self):
+        remove_hook(self.records.append)
+        shutil.rmtree(self.root)
+
+    def path(self, *names):
+        return os.path.join(self.root, *names)
+
+    def write(self, name, content=''):
+        path = self.path(name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as target:
+            target.write(content)
+        return path
@@ -0,0 +1,67 @@
+import unittest
+
+from fabric.api import env
+
+from fabricplatforms.base import accountsnapshot
+from fabricplatforms.executors import ReplayExecutor
+from fabricplatforms.linux import Linux
+
+PASSWD = """root:x:0:0:root:/root:/bin/bash
+# comment
+app:x:500:500:App user:/srv/app:/bin/sh
+deploy:x:501:100::/home/deploy:/bin/bash
++nisuser::::::
+broken:x:502
+app:x:999:999:shadowed:/nowhere:/bin/false
+orphan:x:503:777::/:/sbin/nologin
+"""
+
+GROUP = """root:x:0:
+users:x:100:app
+app:x:500:deploy,app
+wheel:x:10:deploy
+staff:x:100:
+"""
+
+class AccountSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot = accountsnapshot(PASSWD.splitlines(), GROUP.splitlines())
+
+    def test_users(self):
+        self.assertEqual(sorted(self.snapshot.users), ['app', 'deploy', 'orphan', 'root'])
+        app = self.snapshot.users['app']
+        self.assertEqual((app.uid, app.gid, app.comment, app.home, app.shell),
+                         (500, 500, 'App user', '/srv/app', '/bin/sh'))
+
+    def test_groups_like_id(self):
+        # the primary group isn't repeated in groups, like id -Gn
+        app, deploy = self.snapshot.users['app'], self.snapshot.users['deploy']
+        self.assertEqual((app.group, app.groups), ('app', set(['users'])))
+        self.assertEqual((deploy.group, deploy.groups), ('users', set(['app', 'wheel'])))
+
+    def test_unknown_primary_group_is_left_as_the_gid(self):
+        self.assertEqual(self.snapshot.users['orphan'].group, '777')
+
+    def test_first_entry_wins(self):
+        self.assertEqual(self.snapshot.groups['users'].gid, 100)
+        self.assertEqual(self.snapshot.groups['app'].members, set(['deploy', 'app']))
+        self.assertFalse('staff' in self.snapshot.users['deploy'].groups)
+
+class AccountsTest(unittest.TestCase):
+
+    def setUp(self):
+        env.host_string = 'localhost'
+        self.platform = Linux()
+        self.platform.executor = ReplayExecutor([{
+            'command': self.platform._accounts_cmd(), 'use_sudo': True,
+            'output': PASSWD + accountsnapshot.separator + '\n' + GROUP}])
+
+    def test_one_call_answers_the_lookups(self):
+        snapshot = self.platform.accounts()
+        users = self.platform.users(min_uid=500, snapshot=snapshot)
+        self.assertEqual(sorted(users), ['app', 'deploy', 'orphan'])
+        self.assertEqual(sorted(self.platform.users(max_uid=0, snapshot=snapshot)), ['root'])
+
+if __name__ == '__main__':
+    unittest.main()
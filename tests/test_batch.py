@@ -0,0 +1,87 @@
+from __future__ import with_statement
+
+import cPickle as pickle
+import os
+import unittest
+
+from fabricplatforms.base import Batch, BatchError, accountchange
+from tests import SandboxTestCase
+
+class BatchScriptTest(unittest.TestCase):
+
+    def test_parse_splits_the_output_per_step(self):
+        marker = Batch.marker
+        content = '\n'.join(['%s start 0' % marker, 'one', 'two', '%s end 0 0' % marker,
+                             '%s start 1' % marker, '%s end 1 0' % marker,
+                             '%s start 2' % marker, 'boom', '%s end 2 3' % marker])
+        self.assertEqual(Batch('h').parse(content),
+                         {0: (0, 'one\ntwo'), 1: (0, ''), 2: (3, 'boom')})
+
+    def test_parse_leaves_out_unfinished_steps(self):
+        content = '%s start 0\nhalf' % Batch.marker
+        self.assertEqual(Batch('h').parse(content), {})
+
+    def test_split_keeps_scripts_under_the_limit(self):
+        batch = Batch('h')
+        steps = [(index, 'echo %s' % ('x' * 100)) for index in range(50)]
+        parts = batch.split(steps, 1000)
+        self.assertTrue(len(parts) > 1)
+        self.assertEqual(sum(parts, []), steps)
+        for part in parts:
+            self.assertTrue(len(batch.script(part)) <= 1000)
+
+    def test_split_sends_an_oversized_step_alone(self):
+        batch = Batch('h')
+        steps = [(0, 'true'), (1, 'x' * 2000), (2, 'true')]
+        self.assertEqual(batch.split(steps, 1000), [[(0, 'true')], [(1, 'x' * 2000)], [(2, 'true')]])
+
+class BatchErrorTest(unittest.TestCase):
+
+    def test_pickled_with_its_changes(self):
+        error = BatchError(1, 'useradd app', 9, 'exists')
+        error.changes = {'app': accountchange('app', 'failed', {'uid': 500})}
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(error, protocol))
+            self.assertEqual((copy.step, copy.cmd, copy.return_code, copy.output),
+                             (1, 'useradd app', 9, 'exists'))
+            self.assertEqual(str(copy), str(error))
+            self.assertEqual(copy.changes['app'].action, 'failed')
+            self.assertEqual(copy.changes['app'].changes, {'uid': 500})
+
+class BatchRunTest(SandboxTestCase):
+
+    def test_steps_run_in_one_call(self):
+        with self.platform.batch():
+            self.platform.mkdir(self.path('a'))
+            self.platform.touch(self.path('a', 'b'))
+        self.assertTrue(os.path.isfile(self.path('a', 'b')))
+        self.assertEqual([record.template for record in self.records], ['batch'])
+
+    def test_failing_step_stops_the_batch(self):
+        try:
+            with self.platform.batch():
+                self.platform.mkdir(self.path('a'))
+                self.platform.rmdir(self.path('missing'))
+                self.platform.mkdir(self.path('b'))
+        except BatchError, e:
+            self.assertEqual(e.step, 1)
+            self.assertNotEqual(e.return_code, 0)
+        else:
+            self.fail('BatchError not raised')
+        self.assertTrue(os.path.isdir(self.path('a')))
+        self.assertFalse(os.path.exists(self.path('b')))
+
+    def test_large_batches_are_split(self):
+        # one argument of a command is limited to 128k on linux
+        names = ['file-with-a-rather-long-name-%04d' % number for number in range(1500)]
+        for name in names:
+            self.write(os.path.join('remote', name), name)
+        os.mkdir(self.path('local'))
+        report = self.platform.sync(self.path('local'), self.path('remote'))
+        self.assertEqual(len(report.deleted), 1500)
+        self.assertEqual(os.listdir(self.path('remote')), [])
+        batches = [record for record in self.records if record.template == 'batch']
+        self.assertTrue(len(batches) > 1)
+
+if __name__ == '__main__':
+    unittest.main()
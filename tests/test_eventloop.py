@@ -0,0 +1,157 @@
+import logging
+import subprocess
+import unittest
+
+from fabricplatforms.eventloop import (AsyncLocalExecutor, EventLoop, Future, FutureTimeout,
+                                       _channeltask, _processtask, gather)
+
+def failed():
+    future = Future()
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        future.set_exception()
+    return future
+
+def done(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+class FutureTest(unittest.TestCase):
+
+    def test_result_and_exception(self):
+        self.assertEqual(done(1).result(), 1)
+        self.assertEqual(done(1).exception(), None)
+        self.assertRaises(ValueError, failed().result)
+        self.assertEqual(str(failed().exception()), 'boom')
+
+    def test_result_times_out(self):
+        self.assertRaises(FutureTimeout, Future().result, 0.01)
+
+    def test_callbacks_run_once_done(self):
+        future, called = Future(), []
+        future.add_done_callback(lambda future: called.append('before'))
+        self.assertEqual(called, [])
+        future.set_result(None)
+        future.add_done_callback(lambda future: called.append('after'))
+        self.assertEqual(called, ['before', 'after'])
+
+    def test_failing_callbacks_are_only_logged(self):
+        future = Future()
+        future.add_done_callback(lambda future: 1 / 0)
+        logging.disable(logging.ERROR)
+        try:
+            future.set_result(2)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(future.result(), 2)
+
+    def test_then(self):
+        future = Future()
+        chained = future.then(lambda value: value + 1).then(lambda value: value * 2)
+        future.set_result(1)
+        self.assertEqual(chained.result(), 4)
+
+    def test_then_chains_futures(self):
+        inner = Future()
+        chained = done(1).then(lambda value: inner)
+        self.assertFalse(chained.done())
+        inner.set_result('inner')
+        self.assertEqual(chained.result(), 'inner')
+
+    def test_then_passes_errors_along(self):
+        called = []
+        chained = failed().then(called.append)
+        self.assertRaises(ValueError, chained.result)
+        self.assertEqual(called, [])
+        self.assertRaises(ZeroDivisionError, done(1).then(lambda value: value / 0).result)
+
+class GatherTest(unittest.TestCase):
+
+    def test_results_keep_their_order(self):
+        futures = [Future() for index in range(3)]
+        gathered = gather(futures)
+        for index in (2, 0, 1):
+            self.assertFalse(gathered.done())
+            futures[index].set_result(index)
+        self.assertEqual(gathered.result(), [0, 1, 2])
+
+    def test_nothing_to_gather(self):
+        self.assertEqual(gather([]).result(), [])
+
+    def test_first_error(self):
+        future = Future()
+        gathered = gather([done(1), failed(), future])
+        self.assertRaises(ValueError, gathered.result)
+        # later results don't change it
+        future.set_result(3)
+        self.assertRaises(ValueError, gathered.result)
+
+class fakechannel(object):
+    """A channel whose last output arrives along with the eof."""
+
+    def __init__(self, output, late):
+        self.buffer = list(output)
+        self.late = list(late)
+        self.eof_received = False
+
+    def recv_ready(self):
+        if not self.buffer and self.late:
+            self.buffer, self.late = self.late, []
+            self.eof_received = True
+            return False
+        return bool(self.buffer)
+
+    def recv(self, size):
+        return self.buffer.pop(0)
+
+class PumpTest(unittest.TestCase):
+
+    def test_output_arriving_with_the_eof_is_read(self):
+        task = _channeltask(fakechannel(['a'], ['b']), 'cmd')
+        self.assertFalse(task.pump())
+        self.assertTrue(task.pump())
+        self.assertEqual(''.join(task.output), 'ab')
+
+    def test_process_output(self):
+        process = subprocess.Popen(['/bin/sh', '-c', 'echo one; exit 3'], stdout=subprocess.PIPE)
+        task = _processtask(process, 'cmd')
+        while not task.pump():
+            pass
+        task.close()
+        result = task.result()
+        self.assertEqual((result, result.return_code), ('one', 3))
+
+class EventLoopTest(unittest.TestCase):
+
+    def test_commands(self):
+        executor = AsyncLocalExecutor()
+        futures = [executor.run('localhost', 'echo %d; exit %d' % (index, index % 2))
+                   for index in range(20)]
+        results = gather(futures).result(timeout=30)
+        self.assertEqual(results, [str(index) for index in range(20)])
+        self.assertEqual([result.return_code for result in results], [0, 1] * 10)
+
+    def test_at_most_max_per_host(self):
+        loop, running = EventLoop(max_per_host=2), {'web1': [], 'web2': []}
+        def starter(host):
+            def start():
+                running[host].append(loop._running[host])
+                process = subprocess.Popen(['/bin/sh', '-c', 'sleep 0.05'],
+                                           stdout=subprocess.PIPE)
+                return _processtask(process, 'sleep')
+            return start
+        futures = [loop.submit(host, starter(host)) for host in ['web1'] * 6 + ['web2'] * 2]
+        gather(futures).result(timeout=30)
+        self.assertEqual(len(running['web1']), 6)
+        self.assertEqual(max(running['web1']), 2)
+        self.assertEqual(max(running['web2']), 2)
+
+    def test_commands_that_cannot_start_fail(self):
+        def start():
+            raise OSError('no such shell')
+        self.assertRaises(OSError, EventLoop().submit('web1', start).result, 30)
+
+if __name__ == '__main__':
+    unittest.main()
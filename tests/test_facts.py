@@ -0,0 +1,87 @@
+import unittest
+
+from fabric.api import env
+
+from fabricplatforms.base import accountsnapshot
+from fabricplatforms.darwin import Darwin
+from fabricplatforms.executors import ReplayExecutor
+from fabricplatforms.linux import Linux
+from fabricplatforms.solaris import Solaris
+
+LINUX_DF = """Filesystem     Type     1024-blocks      Used Available Capacity Mounted on
+/dev/sda1      ext4        41152832  20576416  18463704      53% /
+tmpfs          tmpfs        1024000         0   1024000       0% /dev/shm
+/dev/mapper/vg-data xfs   104857600 104857600         0     100% /srv/my data
+proc           proc               -         -         -        - /proc
+"""
+
+SOLARIS_DF = """Filesystem            kbytes    used   avail capacity  Mounted on
+rpool/ROOT/solaris-with-a-very-long-name
+                      20000000 5000000 15000000    25%    /
+swap                   4000000      40 3999960     1%    /tmp
+"""
+
+DARWIN_DF = """Filesystem   1024-blocks      Used Available Capacity  Mounted on
+/dev/disk1s1   488245288 200000000 280000000    42%    /
+map auto_home          0         0         0   100%    /System/Volumes/Data/home
+"""
+
+class ParseDfTest(unittest.TestCase):
+
+    def test_linux(self):
+        mounts = Linux()._parse_df(LINUX_DF)
+        self.assertEqual(sorted(mounts), ['/', '/dev/shm', '/srv/my data'])
+        root = mounts['/']
+        self.assertEqual((root.filesystem, root.fstype, root.size, root.used, root.available,
+                          root.capacity), ('/dev/sda1', 'ext4', 41152832 * 1024,
+                                           20576416 * 1024, 18463704 * 1024, 53))
+        self.assertEqual(mounts['/srv/my data'].capacity, 100)
+
+    def test_solaris_long_names_on_a_line_of_their_own(self):
+        mounts = Solaris()._parse_df(SOLARIS_DF)
+        self.assertEqual(sorted(mounts), ['/', '/tmp'])
+        root = mounts['/']
+        self.assertEqual((root.filesystem, root.fstype, root.size, root.capacity),
+                         ('rpool/ROOT/solaris-with-a-very-long-name', None, 20000000 * 1024, 25))
+
+    def test_darwin(self):
+        mounts = Darwin()._parse_df(DARWIN_DF)
+        self.assertEqual(mounts['/'].available, 280000000 * 1024)
+        # names with spaces are skipped rather than read with the wrong sizes
+        self.assertFalse('/System/Volumes/Data/home' in mounts)
+
+    def test_nothing(self):
+        self.assertEqual(Linux()._parse_df(''), {})
+
+class FactsTest(unittest.TestCase):
+
+    def setUp(self):
+        env.host_string = 'localhost'
+        self.platform = Linux()
+        separator = self.platform.facts_separator
+        output = '\n'.join([
+            '%s hostname' % separator, 'web1.example.com',
+            '%s uname' % separator, 'Linux 5.10.0 x86_64',
+            '%s df' % separator, LINUX_DF,
+            '%s accounts' % separator, 'root:x:0:0::/root:/bin/sh',
+            'app:x:500:500::/srv/app:/bin/sh', accountsnapshot.separator,
+            'root:x:0:', 'app:x:500:'])
+        self.platform.executor = ReplayExecutor([{'command': self.platform._facts_cmd(),
+                                                  'output': output}])
+
+    def test_one_command_answers_everything(self):
+        facts = self.platform.facts()
+        self.assertEqual((facts.hostname, facts.system, facts.release, facts.machine),
+                         ('web1.example.com', 'Linux', '5.10.0', 'x86_64'))
+        self.assertEqual(facts.mounts['/'].capacity, 53)
+        self.assertEqual(facts.user_count, 2)
+        self.assertEqual(sorted(facts.groups), ['app', 'root'])
+
+    def test_facts_are_kept(self):
+        facts = self.platform.facts()
+        # the transcript can't answer a second time
+        self.platform.executor.answers.clear()
+        self.assertTrue(self.platform.facts() is facts)
+
+if __name__ == '__main__':
+    unittest.main()
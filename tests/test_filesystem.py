@@ -0,0 +1,104 @@
+import unittest
+
+from fabricplatforms.common.filesystem import dirnode, filenode, nodestore
+
+class LazyDirnodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.names = ['alpha', 'beta', 'betamax', 'sub']
+        self.calls = []
+        self.node = dirnode('/srv/')
+        self.node.set_loader(self.loader)
+
+    def loader(self, prefix, limit, offset):
+        self.calls.append(prefix)
+        nodes = []
+        for name in self.names:
+            if prefix is None or name.startswith(prefix):
+                if name == 'sub':
+                    nodes.append(dirnode('/srv/sub/'))
+                else:
+                    nodes.append(filenode('/srv/%s' % name))
+        return nodes
+
+    def test_children_are_found_by_attribute(self):
+        self.assertEqual(self.node.alpha.name, 'alpha')
+        self.assertEqual(self.node.sub.path, '/srv/sub/')
+        self.assertEqual(self.calls, ['alpha', 'sub'])
+
+    def test_file_attributes_do_not_load(self):
+        self.assertEqual(self.node.digest, None)
+        self.assertEqual(self.node.target, None)
+        self.assertEqual(self.calls, [])
+
+    def test_names_that_cannot_be_entries_do_not_load(self):
+        self.assertFalse(hasattr(self.node, '_private'))
+        self.assertFalse(hasattr(self.node, 'sub/alpha'))
+        self.assertEqual(self.calls, [])
+
+    def test_misses_are_remembered(self):
+        self.assertFalse(hasattr(self.node, 'gamma'))
+        self.assertFalse(hasattr(self.node, 'gamma'))
+        self.assertFalse(hasattr(self.node, 'gammaray'))
+        self.assertEqual(self.calls, ['gamma'])
+
+    def test_loaded_prefixes_answer_longer_names(self):
+        self.assertEqual(self.node.beta.name, 'beta')
+        self.assertEqual(self.node.betamax.name, 'betamax')
+        self.assertFalse(hasattr(self.node, 'betaray'))
+        self.assertEqual(self.calls, ['beta'])
+
+    def test_refresh_forgets_misses(self):
+        self.assertFalse(hasattr(self.node, 'gamma'))
+        self.names.append('gamma')
+        self.node.refresh()
+        self.assertEqual(self.node.gamma.name, 'gamma')
+        self.assertEqual(self.calls, ['gamma', 'gamma'])
+
+class NodestoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.nodes = [
+            dirnode('/srv/', '755', 'root', 'root', 4096, 1, 2, 3),
+            dirnode('/srv/app/', '750', 'app', 'app', 4096, 1, 2, 3),
+            filenode('/srv/app/a.py', '644', 'app', 'app', 10, 1, 2, 3, digest='abc'),
+            filenode('/srv/app/current', '777', 'app', 'app', 7, 1, 2, 3,
+                     ftype='link', target='releases/1'),
+            dirnode('/srv/app/static/', '755', 'app', 'app', 4096, 1, 2, 3),
+            filenode('/srv/app/static/a.py', '600', 'app', 'app', 20, 4, 5, 6),
+            filenode('/srv/b', None, None, None),
+        ]
+        self.store = nodestore(self.nodes)
+
+    def test_rows_build_the_same_nodes(self):
+        self.assertEqual(len(self.store), len(self.nodes))
+        for node, copy in zip(self.nodes, self.store):
+            self.assertEqual(type(copy), type(node))
+            for attr in ('path', 'ftype', 'mode', 'user', 'group', 'size',
+                         'atime', 'mtime', 'ctime', 'digest', 'target'):
+                self.assertEqual(getattr(copy, attr), getattr(node, attr))
+
+    def test_index(self):
+        self.assertEqual(self.store.index('/srv'), 0)
+        self.assertEqual(self.store.index('/srv/app/'), 1)
+        self.assertEqual(self.store.index('/srv/app/a.py'), 2)
+        # same name in another directory
+        self.assertEqual(self.store.index('/srv/app/static/a.py'), 5)
+        self.assertRaises(KeyError, self.store.index, '/srv/app/missing')
+        self.assertRaises(KeyError, self.store.index, '/elsewhere/a.py')
+
+    def test_children(self):
+        self.assertEqual(self.store.children(0), [1, 6])
+        self.assertEqual(self.store.children(1), [2, 3, 4])
+        self.assertEqual(self.store.children(2), [])
+        self.assertEqual([self.store.path(row) for row in self.store.children(4)],
+                         ['/srv/app/static/a.py'])
+
+    def test_rows_without_a_stored_parent(self):
+        store = nodestore([filenode('/tmp/x'), filenode('/var/x')])
+        self.assertEqual(store.index('/var/x'), 1)
+        self.assertEqual(store.children(-1), [0, 1])
+        self.assertEqual(store[1].path, '/var/x')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import random
+import unittest
+
+from fabricplatforms.base import PlatformError, accountsnapshot
+from fabricplatforms.common.utils import idranges
+from fabricplatforms.ids import IdAllocator
+
+class IdRangesTest(unittest.TestCase):
+
+    def test_runs_are_merged(self):
+        ranges = idranges([5, 1, 2, 3, 7, 2])
+        self.assertEqual((ranges.starts, ranges.ends), ([1, 5, 7], [3, 5, 7]))
+        self.assertEqual((len(ranges), list(ranges)), (5, [1, 2, 3, 5, 7]))
+
+    def test_add(self):
+        ranges = idranges([1, 10])
+        ranges.add(2)
+        ranges.add(4, 6)
+        self.assertEqual((ranges.starts, ranges.ends), ([1, 4, 10], [2, 6, 10]))
+        # bridging runs
+        ranges.add(3, 9)
+        self.assertEqual((ranges.starts, ranges.ends), ([1], [10]))
+        ranges.add(5)
+        self.assertEqual((ranges.starts, ranges.ends), ([1], [10]))
+
+    def test_lowest_free(self):
+        ranges = idranges([1000, 1001, 1003])
+        self.assertEqual(ranges.lowest_free(1000, 2000), 1002)
+        self.assertEqual(ranges.lowest_free(1003, 2000), 1004)
+        self.assertEqual(ranges.lowest_free(500, 2000), 500)
+        self.assertEqual(ranges.lowest_free(1000, 1001), None)
+
+    def test_same_as_a_set(self):
+        generator, ids, ranges = random.Random(23), set(), idranges()
+        for count in range(500):
+            start = generator.randint(0, 200)
+            end = start + generator.choice([0, 0, 1, 5])
+            ids.update(range(start, end + 1))
+            ranges.add(start, end)
+        self.assertEqual(list(ranges), sorted(ids))
+        for id in range(-1, 210):
+            self.assertEqual(id in ranges, id in ids)
+            free = [other for other in range(id, 210) if other not in ids]
+            self.assertEqual(ranges.lowest_free(id, 209), free[0] if free else None)
+        other = idranges()
+        other.update(ranges)
+        self.assertEqual(list(other), list(ranges))
+
+def snapshot(users, groups):
+    """accountsnapshot of (name, uid, gid) users and (name, gid) groups."""
+    return accountsnapshot(['%s:x:%d:%d::/:/bin/sh' % user for user in users],
+                           ['%s:x:%d:' % group for group in groups])
+
+class IdAllocatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.allocator = IdAllocator({
+            'web1': snapshot([('root', 0, 0), ('a', 1000, 1000), ('b', 1001, 1005)],
+                             [('root', 0), ('a', 1000)]),
+            'web2': snapshot([('c', 1002, 100), ('d', 1004, 100)],
+                             [('users', 100), ('e', 1001)]),
+        })
+
+    def test_free(self):
+        self.assertEqual(self.allocator.free(), 1003)
+        self.assertEqual(self.allocator.free(host='web1'), 1002)
+        self.assertEqual(self.allocator.free(host='web2'), 1000)
+        self.assertEqual(self.allocator.free(low=1004), 1005)
+        self.assertEqual(self.allocator.free(low=1000, high=1002), None)
+
+    def test_primary_gids_count_as_used(self):
+        self.assertEqual(self.allocator.free('gid'), 1002)
+        self.assertEqual(self.allocator.free('gid', low=1005), 1006)
+
+    def test_reserve(self):
+        self.assertEqual(self.allocator.reserve(3), [1003, 1005, 1006])
+        self.assertEqual(self.allocator.reserve(1), [1007])
+        self.assertEqual(self.allocator.free(host='web2'), 1000)
+        self.assertEqual(self.allocator.free(low=1003, host='web2'), 1008)
+        self.assertEqual(self.allocator.reserve(kind='gid'), [1002])
+
+    def test_not_enough_ids(self):
+        self.assertRaises(PlatformError, self.allocator.reserve, 3, high=1005)
+        # nothing was taken
+        self.assertEqual(self.allocator.free(), 1003)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+from __future__ import with_statement
+
+import getpass
+import os
+import shutil
+import tempfile
+import unittest
+
+from fabric.api import cd, env, settings
+
+from fabricplatforms.executors import LocalExecutor
+from fabricplatforms.linux import Linux
+from fabricplatforms.local import is_local, local_platform
+
+class LocalCwdTest(unittest.TestCase):
+    """The local platform takes relative paths from cd() like the commands do."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'sub', 'deeper'))
+        with open(os.path.join(self.root, 'a'), 'w') as a:
+            a.write('a')
+        self.local = local_platform(Linux)
+        self.commands = Linux()
+        self.commands.executor = LocalExecutor()
+        env.host_string = 'localhost'
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_changes_are_made_in_cwd(self):
+        with cd(self.root):
+            self.local.mkdir('newdir')
+            self.local.touch('newdir/file')
+            self.local.link('a', 'a-link')
+            self.local.move('newdir/file', 'moved')
+        self.assertTrue(os.path.isdir(os.path.join(self.root, 'newdir')))
+        self.assertTrue(os.path.isfile(os.path.join(self.root, 'moved')))
+        self.assertEqual(os.readlink(os.path.join(self.root, 'a-link')), 'a')
+
+    def test_lookups_match_the_commands(self):
+        with cd(self.root):
+            for platform in (self.local, self.commands):
+                node = platform.stat('a')
+                self.assertEqual(node.path, 'a')
+                self.assertEqual(node.size, 1)
+                self.assertEqual(platform.digest('a'), self.commands.digest('a'))
+                self.assertEqual(sorted(node.path.rstrip('/') for node in platform.iterwalk('sub')),
+                                 ['sub', 'sub/deeper'])
+                self.assertEqual([node.path.rstrip('/') for node in platform.listdir('sub')],
+                                 ['sub/deeper'])
+
+    def test_absolute_paths_ignore_cwd(self):
+        with cd('/nonexistent'):
+            node = self.local.stat(os.path.join(self.root, 'a'))
+        self.assertEqual(node.path, os.path.join(self.root, 'a'))
+
+class IsLocalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.me = getpass.getuser()
+
+    def test_local_names(self):
+        self.assertTrue(is_local('localhost'))
+        self.assertTrue(is_local('127.0.0.1:22'))
+        self.assertFalse(is_local('example.com'))
+
+    def test_user_of_the_host_string(self):
+        self.assertTrue(is_local('%s@localhost' % self.me))
+        self.assertFalse(is_local('%s-deploy@localhost' % self.me))
+        with settings(user='%s-deploy' % self.me):
+            self.assertTrue(is_local('%s@localhost' % self.me))
+
+    def test_env_user_without_one(self):
+        with settings(user='%s-deploy' % self.me):
+            self.assertFalse(is_local('localhost'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import time
+import unittest
+
+from fabric.api import env
+
+from fabricplatforms.base import PlatformError
+from fabricplatforms.parallel import HostTimeout, fanout
+
+def whoami(size=0):
+    """The host env was set up for, padded to size bytes."""
+    if env.host_string == 'slow':
+        time.sleep(30)
+    if env.host_string == 'broken':
+        raise ValueError('broken')
+    if env.host_string == 'gone':
+        os._exit(3)
+    return env.host_string + 'x' * size
+
+class FanoutTest(unittest.TestCase):
+
+    def test_every_host_gets_its_own_env(self):
+        results = fanout(['web1', 'web2', 'deploy@db1:2222', 'web1'], whoami)
+        self.assertEqual(sorted(results), ['deploy@db1:2222', 'web1', 'web2'])
+        for host, result in results.items():
+            self.assertFalse(result.failed)
+            self.assertEqual(result.result, host)
+
+    def test_errors_are_sent_back(self):
+        results = fanout(['web1', 'broken'], whoami)
+        self.assertEqual(str(results['broken'].error), 'broken')
+        self.assertTrue(isinstance(results['broken'].error, ValueError))
+        self.assertEqual(results['web1'].result, 'web1')
+
+    def test_workers_that_exit_early_fail(self):
+        results = fanout(['gone'], whoami)
+        self.assertTrue(isinstance(results['gone'].error, PlatformError))
+        self.assertTrue('status 3' in str(results['gone'].error))
+
+    def test_slow_hosts_time_out_without_holding_up_the_rest(self):
+        started = time.time()
+        # results bigger than a pipe buffer are still being written when
+        # the slow host is killed
+        results = fanout(['slow', 'web1', 'web2'], whoami, kwargs={'size': 1 << 20},
+                         timeout=1)
+        self.assertTrue(time.time() - started < 10)
+        self.assertTrue(isinstance(results['slow'].error, HostTimeout))
+        for host in ('web1', 'web2'):
+            self.assertEqual(results[host].result, host + 'x' * (1 << 20))
+
+    def test_workers_limits_the_hosts_in_flight(self):
+        results = fanout(['slow', 'web1', 'web2'], whoami, workers=1, timeout=1)
+        self.assertTrue(isinstance(results['slow'].error, HostTimeout))
+        self.assertEqual(results['web2'].result, 'web2')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from fabricplatforms.registry import PlatformRegistry, import_object
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SCRIPT = """
+import json, sys
+import fabric.api
+before = set(sys.modules)
+import fabricplatforms
+loaded = sorted(name for name in set(sys.modules) - before
+                if name.startswith('fabricplatforms') and sys.modules[name] is not None)
+from fabricplatforms import Linux, Solaris, Darwin, gather, PlatformError, platform
+print(json.dumps({'loaded': loaded, 'linux': Linux.__module__,
+                  'made': sorted(platform.PLATFORMS.loaded())}))
+"""
+
+class Counted(object):
+    made = 0
+
+    def __init__(self):
+        Counted.made += 1
+
+class RegistryTest(unittest.TestCase):
+
+    def test_import_object(self):
+        self.assertTrue(import_object('os.path.join') is os.path.join)
+        self.assertTrue(import_object('os.path:join') is os.path.join)
+        self.assertTrue(import_object('os.path') is os.path)
+        self.assertRaises(ImportError, import_object, 'fabricplatforms.nonexistent.Thing')
+
+    def test_platforms_are_made_on_first_lookup(self):
+        registry = PlatformRegistry()
+        registry.register('counted', '%s.Counted' % __name__)
+        registry.configure(agent_mode=True)
+        made = Counted.made
+        self.assertTrue('counted' in registry)
+        self.assertEqual(registry.loaded(), {})
+        platform = registry['counted']
+        self.assertTrue(registry['counted'] is platform)
+        self.assertEqual(Counted.made, made + 1)
+        self.assertTrue(platform.agent_mode)
+        self.assertRaises(KeyError, lambda: registry['unknown'])
+
+class PackageImportTest(unittest.TestCase):
+
+    def test_import_loads_nothing_until_used(self):
+        output = subprocess.Popen([sys.executable, '-W', 'ignore', '-c', IMPORT_SCRIPT],
+                                  stdout=subprocess.PIPE, cwd=ROOT).communicate()[0]
+        result = json.loads(output.strip().splitlines()[-1])
+        self.assertEqual(result['loaded'], ['fabricplatforms', 'fabricplatforms.cache',
+                                            'fabricplatforms.registry'])
+        self.assertEqual(result['linux'], 'fabricplatforms.linux')
+        self.assertEqual(result['made'], [])
+
+if __name__ == '__main__':
+    unittest.main()
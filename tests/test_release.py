@@ -0,0 +1,87 @@
+import os
+import stat
+import unittest
+
+from fabricplatforms.base import PlatformError
+from tests import SandboxTestCase
+
+class ReleaseTest(SandboxTestCase):
+
+    def setUp(self):
+        super(ReleaseTest, self).setUp()
+        self.local, self.store = self.path('build'), self.path('store')
+        self.write('build/app.py', 'app')
+        self.write('build/lib/copy.py', 'app')
+        os.chmod(self.write('build/bin/run', 'run'), 0755)
+
+    def release(self, name, **kwargs):
+        return self.platform.release(self.local, self.store, name, **kwargs)
+
+    def test_manifest(self):
+        manifest, sources, directories = self.platform._release_manifest(self.local)
+        self.assertEqual(sorted(manifest), ['app.py', 'bin/run', 'lib/copy.py'])
+        # the same content and mode is one object
+        self.assertEqual(manifest['app.py'], manifest['lib/copy.py'])
+        self.assertEqual(len(sources), 2)
+        self.assertTrue(manifest['app.py'].endswith('.444'))
+        self.assertTrue(manifest['bin/run'].endswith('.555'))
+        self.assertEqual(manifest['app.py'][:2] + '/', manifest['app.py'][:3])
+        self.assertEqual(sorted(directories), ['bin', 'lib'])
+
+    def test_release_links_the_files_to_objects(self):
+        report = self.release('1')
+        self.assertEqual((report.name, report.files, len(report.uploaded)), ('1', 3, 2))
+        self.assertEqual(os.readlink(os.path.join(self.store, 'current')), report.path)
+        app = os.stat(os.path.join(self.store, 'current', 'app.py'))
+        copy = os.stat(os.path.join(self.store, 'current', 'lib', 'copy.py'))
+        self.assertEqual(app.st_ino, copy.st_ino)
+        self.assertEqual(stat.S_IMODE(app.st_mode), 0444)
+        with open(os.path.join(self.store, 'current', 'bin', 'run')) as run:
+            self.assertEqual(run.read(), 'run')
+        self.assertFalse(os.path.exists(os.path.join(self.store, '.lock')))
+
+    def test_only_new_objects_are_sent(self):
+        self.release('1')
+        self.write('build/app.py', 'changed')
+        report = self.release('2')
+        self.assertEqual(len(report.uploaded), 1)
+        self.assertTrue(report.uploaded[0].endswith('.444'))
+        self.assertEqual(os.readlink(os.path.join(self.store, 'current')), report.path)
+        with open(os.path.join(self.store, 'releases', '1', 'app.py')) as old:
+            self.assertEqual(old.read(), 'app')
+
+    def test_existing_releases_are_left_alone(self):
+        self.release('1')
+        self.assertRaises(PlatformError, self.release, '1')
+        # and the store isn't left locked
+        self.release('2')
+
+    def test_locked_store(self):
+        os.makedirs(os.path.join(self.store, '.lock'))
+        try:
+            self.release('1')
+        except PlatformError, e:
+            self.assertTrue('locked' in str(e))
+        else:
+            self.fail('PlatformError not raised')
+        self.assertFalse(os.path.exists(os.path.join(self.store, 'releases', '1')))
+
+    def test_nothing_to_release(self):
+        self.local = self.path('empty')
+        os.mkdir(self.local)
+        self.assertRaises(PlatformError, self.release, '1')
+        self.assertEqual(self.release('1', allow_empty=True).files, 0)
+
+    def test_prune_keeps_the_newest_and_current(self):
+        for name in ('1', '2', '3'):
+            self.write('build/app.py', name)
+            self.release(name)
+        os.remove(os.path.join(self.store, 'current'))
+        os.symlink('releases/1', os.path.join(self.store, 'current'))
+        report = self.platform.prune_releases(self.store, keep=1)
+        self.assertEqual(report.removed, ['2'])
+        self.assertEqual(report.objects, 1)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.store, 'releases'))), ['1', '3'])
+
+if __name__ == '__main__':
+    unittest.main()
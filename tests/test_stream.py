@@ -0,0 +1,73 @@
+import threading
+import unittest
+
+from fabric.api import env
+
+from fabricplatforms.base import PlatformError
+from fabricplatforms.executors import LocalExecutor, ReplayExecutor
+from fabricplatforms.linux import Linux
+
+class FindNodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.platform = Linux()
+
+    def test_file(self):
+        node = self.platform._find_node('f:644:app:staff:12,1,2,3:/srv/a b\t')
+        self.assertEqual((node.path, node.ftype, node.mode, node.user, node.group),
+                         ('/srv/a b', 'file', '644', 'app', 'staff'))
+        self.assertEqual((node.size, node.atime, node.mtime, node.ctime), (12, 1, 2, 3))
+
+    def test_directory(self):
+        node = self.platform._find_node('d:755:root:root:4096,1.5,2.5,3.5:/srv/app\t')
+        self.assertEqual(node.ftype, 'directory')
+        self.assertEqual(node.path, '/srv/app/')
+        self.assertEqual(node.mtime, 2)
+
+    def test_link_keeps_its_target(self):
+        node = self.platform._find_node('l:777:app:app:7,1,2,3:/srv/current\treleases/1')
+        self.assertEqual((node.ftype, node.target), ('link', 'releases/1'))
+
+    def test_colons_in_the_path(self):
+        node = self.platform._find_node('f:644:app:app:1,1,2,3:/srv/a:b:c\t')
+        self.assertEqual(node.path, '/srv/a:b:c')
+
+    def test_malformed_lines(self):
+        self.assertEqual(self.platform._find_node('find: warning'), None)
+        self.assertEqual(self.platform._find_node('f:644:app:app:x,1,2,3:/srv/a\t'), None)
+
+class StreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.platform = Linux()
+        env.host_string = 'localhost'
+
+    def test_lines_arrive_in_order(self):
+        self.platform.executor = LocalExecutor()
+        self.assertEqual(list(self.platform._stream('seq 1 5')), ['1', '2', '3', '4', '5'])
+
+    def test_failures_raise(self):
+        self.platform.executor = LocalExecutor()
+        self.assertRaises(PlatformError, list, self.platform._stream('echo no >&2; exit 1'))
+
+    def test_ignored_errors_are_logged(self):
+        self.platform.executor = ReplayExecutor([{'command': 'walk', 'output': 'a',
+                                                  'return_code': 1,
+                                                  'stderr': 'find: /x: Permission denied'}])
+        self.assertEqual(list(self.platform._stream('walk', ignored=r'Permission denied$')),
+                         ['a'])
+
+    def test_closing_early_stops_the_command(self):
+        self.platform.executor = LocalExecutor()
+        threads = threading.active_count()
+        # the loop runs in a subshell, which the shell doesn't replace itself with
+        lines = self.platform._stream('(while true; do echo x; done)')
+        self.assertEqual(next(lines), 'x')
+        closer = threading.Thread(target=lines.close)
+        closer.start()
+        closer.join(10)
+        self.assertFalse(closer.is_alive())
+        self.assertEqual(threading.active_count(), threads)
+
+if __name__ == '__main__':
+    unittest.main()
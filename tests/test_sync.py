@@ -0,0 +1,76 @@
+import os
+import unittest
+
+from fabricplatforms.base import PlatformError
+from tests import SandboxTestCase
+
+class SyncTest(SandboxTestCase):
+
+    def setUp(self):
+        super(SyncTest, self).setUp()
+        self.local, self.remote = self.path('local'), self.path('remote')
+        self.write('local/a.py', 'a')
+        self.write('local/lib/b.py', 'b')
+        self.write('local/lib/c.py', 'c')
+
+    def sync(self, **kwargs):
+        del self.records[:]
+        return self.platform.sync(self.local, self.remote, **kwargs)
+
+    def remote_files(self):
+        return sorted(os.path.relpath(os.path.join(directory, name), self.remote)
+                      for directory, dirs, files in os.walk(self.remote) for name in files)
+
+    def test_first_sync_uploads_everything(self):
+        report = self.sync()
+        self.assertEqual(report.uploaded, ['a.py', 'lib/b.py', 'lib/c.py'])
+        self.assertEqual((report.renamed, report.deleted, report.unchanged), ([], [], 0))
+        self.assertEqual(self.remote_files(), ['a.py', 'lib/b.py', 'lib/c.py'])
+
+    def test_unchanged_trees_reuse_the_cached_manifest(self):
+        self.sync()
+        report = self.sync()
+        self.assertEqual((report.uploaded, report.unchanged), ([], 3))
+        # the host only sent the signature of the tree, no digests
+        self.assertEqual([record.template for record in self.records], ['manifest_cmd'])
+        self.assertEqual(self.records[0].size, len(self.platform.manifest_separator) + 1 + 64)
+
+    def test_changed_files_are_uploaded(self):
+        self.sync()
+        self.write('local/lib/b.py', 'changed')
+        report = self.sync()
+        self.assertEqual((report.uploaded, report.unchanged), (['lib/b.py'], 2))
+        with open(os.path.join(self.remote, 'lib', 'b.py')) as synced:
+            self.assertEqual(synced.read(), 'changed')
+
+    def test_moved_files_are_moved_on_the_host(self):
+        self.sync()
+        os.rename(self.path('local', 'lib', 'c.py'), self.path('local', 'c.py'))
+        report = self.sync()
+        self.assertEqual((report.uploaded, report.renamed, report.deleted),
+                         ([], [('lib/c.py', 'c.py')], []))
+        self.assertEqual(self.remote_files(), ['a.py', 'c.py', 'lib/b.py'])
+
+    def test_copies_of_one_file_are_moved_once(self):
+        self.write('remote/old1', 'same')
+        self.write('remote/old2', 'same')
+        self.write('local/new', 'same')
+        report = self.sync()
+        self.assertEqual(report.renamed, [('old1', 'new')])
+        self.assertEqual(report.deleted, ['old2'])
+        self.assertEqual(self.remote_files(), ['a.py', 'lib/b.py', 'lib/c.py', 'new'])
+
+    def test_delete(self):
+        self.write('remote/extra', 'x')
+        self.assertEqual(self.sync(delete=False).deleted, [])
+        self.assertTrue('extra' in self.remote_files())
+        self.assertEqual(self.sync().deleted, ['extra'])
+        self.assertFalse('extra' in self.remote_files())
+
+    def test_missing_local_dir_fails_before_asking_the_host(self):
+        self.local = self.path('missing')
+        self.assertRaises(PlatformError, self.sync)
+        self.assertEqual(self.records, [])
+
+if __name__ == '__main__':
+    unittest.main()